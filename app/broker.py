@@ -0,0 +1,220 @@
+"""
+Fan-out brokers behind ConnectionManager.
+
+A broker delivers every update to this process's WebSocket clients and,
+for multi-worker deployments, to the other workers:
+
+- InMemoryBroker: local delivery only (single process, tests)
+- RedisBroker: local delivery plus Redis pub/sub. Position updates are
+  coalesced per vehicle and published in batches every
+  WS_BROKER_FLUSH_MS on WS_BROKER_SHARDS channels (by vehicle id);
+  broadcasts are published immediately. Each worker relays messages
+  from the other workers to its own clients and refreshes its
+  last-position store with relayed positions.
+
+Select with WS_BROKER=memory|redis (Redis address as for the cache).
+"""
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+from .cache import REDIS_URL
+from .live import live_positions
+import asyncio
+import json
+import os
+import uuid
+
+WS_BROKER = os.getenv("WS_BROKER", "memory")
+WS_BROKER_CHANNEL_PREFIX = os.getenv("WS_BROKER_CHANNEL_PREFIX", "fleet:ws:")
+WS_BROKER_SHARDS = int(os.getenv("WS_BROKER_SHARDS", 16))
+WS_BROKER_FLUSH_MS = int(os.getenv("WS_BROKER_FLUSH_MS", 20))
+
+# Max vehicles per published batch message
+WS_BROKER_BATCH_SIZE = int(os.getenv("WS_BROKER_BATCH_SIZE", 500))
+
+PositionHandler = Callable[[int, dict], None]
+BroadcastHandler = Callable[[dict], None]
+
+
+class InMemoryBroker:
+    """Delivers to local clients only"""
+
+    def __init__(self):
+        self.on_position: Optional[PositionHandler] = None
+        self.on_broadcast: Optional[BroadcastHandler] = None
+
+    def bind(self, on_position: PositionHandler, on_broadcast: BroadcastHandler):
+        """Set the local delivery callbacks"""
+        self.on_position = on_position
+        self.on_broadcast = on_broadcast
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish_position(self, vehicle_id: int, data: dict):
+        if self.on_position is not None:
+            self.on_position(vehicle_id, data)
+
+    def publish_broadcast(self, message: dict):
+        if self.on_broadcast is not None:
+            self.on_broadcast(message)
+
+
+class RedisBroker(InMemoryBroker):
+    """Local delivery plus batched Redis pub/sub between workers"""
+
+    def __init__(
+        self,
+        url: str = REDIS_URL,
+        prefix: str = WS_BROKER_CHANNEL_PREFIX,
+        shards: int = WS_BROKER_SHARDS,
+        flush_ms: int = WS_BROKER_FLUSH_MS
+    ):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.shards = shards
+        self.flush_interval = flush_ms / 1000.0
+        self.origin = uuid.uuid4().hex
+        self.published = 0
+        self.relayed = 0
+        self._redis = None
+        self._pending: Dict[int, Dict[int, dict]] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._sends = set()
+        self._failing = False
+
+    def _position_channel(self, shard: int) -> str:
+        return f"{self.prefix}pos:{shard}"
+
+    @property
+    def _broadcast_channel(self) -> str:
+        return f"{self.prefix}broadcast"
+
+    async def start(self):
+        import redis.asyncio as aioredis
+        self._redis = aioredis.Redis.from_url(self.url)
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._publisher()),
+            asyncio.create_task(self._relay())
+        ]
+        print(f"WebSocket broker: Redis pub/sub ({self.shards} shards, batch every "
+              f"{int(self.flush_interval * 1000)}ms)")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._sends, return_exceptions=True)
+        self._tasks = []
+        if self._pending:
+            await self._flush()
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    # ---------- publishing ----------
+
+    def publish_position(self, vehicle_id: int, data: dict):
+        super().publish_position(vehicle_id, data)
+        # Within one flush window only the newest update per vehicle is sent
+        self._pending.setdefault(vehicle_id % self.shards, {})[vehicle_id] = data
+        self._wakeup.set()
+
+    def publish_broadcast(self, message: dict):
+        super().publish_broadcast(message)
+        if self._redis is None:
+            return
+        payload = json.dumps({"o": self.origin, "m": message}, separators=(",", ":"))
+        task = asyncio.create_task(self._publish(self._broadcast_channel, payload))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    def _publish_failed(self, error: Exception):
+        # Local clients already have the message; remote workers miss it
+        if not self._failing:
+            print(f"WebSocket broker: publishing to Redis failed ({error})")
+        self._failing = True
+
+    async def _publish(self, channel: str, payload: str):
+        try:
+            await self._redis.publish(channel, payload)
+            self._failing = False
+        except Exception as e:
+            self._publish_failed(e)
+
+    async def _publisher(self):
+        while True:
+            await self._wakeup.wait()
+            # Let updates accumulate for one window, then publish them together
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            await self._flush()
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for shard, updates in pending.items():
+                    items = list(updates.items())
+                    for i in range(0, len(items), WS_BROKER_BATCH_SIZE):
+                        pipe.publish(self._position_channel(shard), json.dumps(
+                            {"o": self.origin, "p": items[i:i + WS_BROKER_BATCH_SIZE]},
+                            separators=(",", ":")
+                        ))
+                await pipe.execute()
+            self.published += sum(len(updates) for updates in pending.values())
+            self._failing = False
+        except Exception as e:
+            self._publish_failed(e)
+
+    # ---------- relaying ----------
+
+    async def _relay(self):
+        channels = [self._position_channel(shard) for shard in range(self.shards)]
+        channels.append(self._broadcast_channel)
+        backoff = 1.0
+        while True:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(*channels)
+                backoff = 1.0
+                async for message in pubsub.listen():
+                    try:
+                        self._handle(message["data"])
+                    except (ValueError, KeyError, TypeError) as e:
+                        print(f"WebSocket broker: ignoring malformed message: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WebSocket broker: subscription lost ({e}); retrying in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                await pubsub.aclose()
+
+    def _handle(self, raw):
+        message = json.loads(raw)
+        if message.get("o") == self.origin:
+            return
+        if "m" in message:
+            self.on_broadcast(message["m"])
+            return
+        for vehicle_id, data in message["p"]:
+            self.relayed += 1
+            live_positions.update(vehicle_id, {
+                **data,
+                "recorded_at": datetime.fromisoformat(data["recorded_at"])
+            })
+            self.on_position(vehicle_id, data)
+
+
+def create_broker(kind: str = WS_BROKER) -> InMemoryBroker:
+    if kind == "redis":
+        return RedisBroker()
+    if kind != "memory":
+        raise ValueError(f"Unknown WS_BROKER '{kind}'")
+    return InMemoryBroker()
@@ -1,43 +1,326 @@
-import redis
-import json
-from typing import Optional
-import os
-
-# Redis connection
-redis_client = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=int(os.getenv('REDIS_PORT', 6379)),
-    db=0,
-    decode_responses=True
-)
-
-def cache_get(key: str) -> Optional[dict]:
-    """Get cached data"""
-    try:
-        data = redis_client.get(key)
-        return json.loads(data) if data else None
-    except:
-        return None
-
-def cache_set(key: str, value: dict, ttl: int = 300):
-    """Cache data with TTL (default 5 minutes)"""
-    try:
-        redis_client.setex(key, ttl, json.dumps(value))
-    except:
-        pass
-
-def cache_delete(key: str):
-    """Delete cached data"""
-    try:
-        redis_client.delete(key)
-    except:
-        pass
-
-def cache_delete_pattern(pattern: str):
-    """Delete all keys matching pattern"""
-    try:
-        keys = redis_client.keys(pattern)
-        if keys:
-            redis_client.delete(*keys)
-    except:
-        pass
\ No newline at end of file
+"""
+Two-tier response cache: an in-process LRU in front of Redis.
+
+Keys embed the current version of every tag they depend on, e.g.
+    fleet:vehicles.list:vehicles=4:0:100:False
+so invalidating a tag is one INCR and stale entries simply stop being
+addressed (and expire). Tag versions are read from Redis at most every
+CACHE_VERSION_TTL seconds per tag, which bounds how long another worker's
+write can go unnoticed.
+
+Concurrent misses for the same key share one loader call (single-flight).
+When Redis is unreachable the cache keeps working in local-only mode and
+retries Redis after CACHE_REDIS_RETRY_SECONDS.
+"""
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+import asyncio
+import json
+import os
+import time
+
+REDIS_URL = os.getenv(
+    "REDIS_URL",
+    f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}/0"
+)
+
+# "redis" (two tiers) or "local" (in-process only); "off" disables caching
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "redis")
+
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "fleet:")
+CACHE_TTL = int(os.getenv("CACHE_TTL", 300))
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", 30))
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", 2048))
+CACHE_VERSION_TTL = float(os.getenv("CACHE_VERSION_TTL", 1.0))
+CACHE_REDIS_TIMEOUT = float(os.getenv("CACHE_REDIS_TIMEOUT", 0.25))
+CACHE_REDIS_RETRY_SECONDS = float(os.getenv("CACHE_REDIS_RETRY_SECONDS", 30))
+
+# History pages older than this are cached; a later fix for that period
+# (late upload, import) invalidates the vehicle's positions tag
+CACHE_HISTORY_SETTLE_SECONDS = int(os.getenv("CACHE_HISTORY_SETTLE_SECONDS", 300))
+
+_MISSING = object()
+
+
+def positions_tag(vehicle_id: int) -> str:
+    return f"positions:{vehicle_id}"
+
+
+class CacheStats:
+    __slots__ = ("local_hits", "redis_hits", "misses", "coalesced", "invalidations", "redis_errors")
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class TwoTierCache:
+    def __init__(
+        self,
+        backend: str = CACHE_BACKEND,
+        url: str = REDIS_URL,
+        prefix: str = CACHE_PREFIX,
+        local_max_entries: int = CACHE_LOCAL_MAX_ENTRIES
+    ):
+        self.backend = backend
+        self.url = url
+        self.prefix = prefix
+        self.local_max_entries = local_max_entries
+        self.stats = CacheStats()
+        self._local: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._versions: Dict[str, Tuple[int, float]] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._redis = None
+        self._redis_down_until = 0.0
+        self._sync_redis = None
+        self._tasks = set()
+
+    # ---------- redis connection ----------
+
+    def _client(self):
+        """Redis client, or None in local-only mode / while Redis is down"""
+        if self.backend != "redis" or time.monotonic() < self._redis_down_until:
+            return None
+        if self._redis is None:
+            import redis.asyncio as aioredis
+            self._redis = aioredis.Redis.from_url(
+                self.url,
+                socket_timeout=CACHE_REDIS_TIMEOUT,
+                socket_connect_timeout=CACHE_REDIS_TIMEOUT
+            )
+        return self._redis
+
+    def _redis_failed(self, error: Exception):
+        self.stats.redis_errors += 1
+        if self._redis_down_until == 0.0:
+            print(f"Cache: Redis unavailable ({error}); local-only for {CACHE_REDIS_RETRY_SECONDS:.0f}s")
+        self._redis_down_until = time.monotonic() + CACHE_REDIS_RETRY_SECONDS
+
+    def _redis_ok(self):
+        if self._redis_down_until:
+            # Versions bumped while Redis was down may collide with Redis ones
+            print("Cache: Redis reachable again")
+            self._redis_down_until = 0.0
+            self._local.clear()
+            self._versions.clear()
+
+    @property
+    def redis_available(self) -> bool:
+        return self.backend == "redis" and time.monotonic() >= self._redis_down_until
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+        if self._sync_redis is not None:
+            self._sync_redis.close()
+            self._sync_redis = None
+
+    # ---------- local tier ----------
+
+    def _local_get(self, key: str):
+        entry = self._local.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return _MISSING
+        self._local.move_to_end(key)
+        return value
+
+    def _local_put(self, key: str, value, ttl: float):
+        self._local[key] = (time.monotonic() + min(ttl, CACHE_LOCAL_TTL), value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_max_entries:
+            self._local.popitem(last=False)
+
+    # ---------- tags ----------
+
+    def _tag_key(self, tag: str) -> str:
+        return f"{self.prefix}tag:{tag}"
+
+    async def _tag_versions(self, tags: Iterable[str]) -> Dict[str, int]:
+        now = time.monotonic()
+        versions = {}
+        stale = []
+        for tag in tags:
+            cached = self._versions.get(tag)
+            if cached is not None and (cached[1] > now or not self.redis_available):
+                versions[tag] = cached[0]
+            else:
+                stale.append(tag)
+
+        if stale:
+            client = self._client()
+            fetched = None
+            if client is not None:
+                try:
+                    fetched = await client.mget([self._tag_key(tag) for tag in stale])
+                    self._redis_ok()
+                except Exception as e:
+                    self._redis_failed(e)
+            for i, tag in enumerate(stale):
+                if fetched is not None:
+                    version = int(fetched[i] or 0)
+                else:
+                    version = self._versions.get(tag, (0, 0.0))[0]
+                self._versions[tag] = (version, now + CACHE_VERSION_TTL)
+                versions[tag] = version
+        return versions
+
+    def _bump_local(self, tags: Iterable[str]):
+        expires = time.monotonic() + CACHE_VERSION_TTL
+        for tag in tags:
+            version = self._versions.get(tag, (0, 0.0))[0] + 1
+            self._versions[tag] = (version, expires)
+
+    async def _incr(self, tags: Tuple[str, ...]) -> bool:
+        client = self._client()
+        if client is None:
+            return False
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                for tag in tags:
+                    pipe.incr(self._tag_key(tag))
+                versions = await pipe.execute()
+        except Exception as e:
+            self._redis_failed(e)
+            return False
+        self._redis_ok()
+        expires = time.monotonic() + CACHE_VERSION_TTL
+        for tag, version in zip(tags, versions):
+            self._versions[tag] = (int(version), expires)
+        return True
+
+    async def invalidate(self, *tags: str):
+        """Bump tag versions so every key built from them is abandoned"""
+        if self.backend == "off" or not tags:
+            return
+        self.stats.invalidations += len(tags)
+        if not await self._incr(tags):
+            self._bump_local(tags)
+
+    def _incr_sync(self, tags: Tuple[str, ...]):
+        if self.backend != "redis" or time.monotonic() < self._redis_down_until:
+            return
+        if self._sync_redis is None:
+            import redis
+            self._sync_redis = redis.Redis.from_url(
+                self.url,
+                socket_timeout=CACHE_REDIS_TIMEOUT,
+                socket_connect_timeout=CACHE_REDIS_TIMEOUT
+            )
+        try:
+            pipe = self._sync_redis.pipeline(transaction=False)
+            for tag in tags:
+                pipe.incr(self._tag_key(tag))
+            pipe.execute()
+        except Exception as e:
+            self._redis_failed(e)
+
+    def invalidate_soon(self, *tags: str):
+        """
+        invalidate() for sync code. On the event loop Redis is bumped in the
+        background; in worker threads and scripts it is bumped before
+        returning, so a following read sees the write.
+        """
+        if self.backend == "off" or not tags:
+            return
+        self.stats.invalidations += len(tags)
+        self._bump_local(tags)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._incr_sync(tags)
+            return
+        task = loop.create_task(self._incr(tags))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # ---------- lookups ----------
+
+    async def get_or_load(
+        self,
+        name: str,
+        parts: Iterable,
+        tags: Iterable[str],
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int = CACHE_TTL
+    ):
+        """
+        Cached JSON-serialisable value for (name, parts), computed with
+        loader() on a miss. The value is reused until ttl expires or any of
+        the tags is invalidated.
+        """
+        if self.backend == "off":
+            return await loader()
+
+        versions = await self._tag_versions(tags)
+        key = self.prefix + ":".join(
+            [name, ",".join(f"{tag}={version}" for tag, version in sorted(versions.items()))]
+            + [str(part) for part in parts]
+        )
+
+        value = self._local_get(key)
+        if value is not _MISSING:
+            self.stats.local_hits += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._load(key, loader, ttl)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters get the error; nobody else needs to retrieve it
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _load(self, key: str, loader, ttl: int):
+        client = self._client()
+        if client is not None:
+            try:
+                raw = await client.get(key)
+                self._redis_ok()
+                if raw is not None:
+                    self.stats.redis_hits += 1
+                    value = json.loads(raw)
+                    self._local_put(key, value, ttl)
+                    return value
+            except Exception as e:
+                self._redis_failed(e)
+                client = None
+
+        self.stats.misses += 1
+        value = await loader()
+        self._local_put(key, value, ttl)
+        if client is not None:
+            try:
+                await client.set(key, json.dumps(value, separators=(",", ":")), ex=ttl)
+            except Exception as e:
+                self._redis_failed(e)
+        return value
+
+    def snapshot(self) -> dict:
+        return {
+            "backend": self.backend,
+            "redis_available": self.redis_available,
+            "local_entries": len(self._local),
+            **self.stats.to_dict()
+        }
+
+
+response_cache = TwoTierCache()
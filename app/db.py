@@ -1,31 +1,331 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-import os
-
-# Database URL - starts with SQLite for development
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./fleet_tracker.db")
-
-# SQLite needs special connection args
-connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-
-# Create engine
-engine = create_engine(
-    DATABASE_URL,
-    echo=True,
-    future=True,
-    connect_args=connect_args
-)
-
-# Session factory
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
-
-# Base class for models
-Base = declarative_base()
-
-# Dependency for routes
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
\ No newline at end of file
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from typing import Dict, Iterable, List
+from .metrics import METRICS_ENABLED, instrument_engine, pool_gauges, timed_pool_class
+import itertools
+import os
+import time
+
+# Database URL - starts with SQLite for development
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./fleet_tracker.db")
+
+# Log every SQL statement (slow under load; for debugging only)
+SQL_ECHO = os.getenv("SQL_ECHO", "0").lower() in ("1", "true", "yes")
+
+# Read replicas (comma-separated URLs); without any, reads use the primary
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+# Connection pool per engine (ignored for in-memory SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+
+# How far replicas may lag; routes that opt in to read-your-writes use the
+# primary for this long after this worker writes to a table they read
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+
+# SQLite: WAL lets history reads run while ingest writes
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_PRAGMAS = {
+    "journal_mode": SQLITE_JOURNAL_MODE,
+    # Safe with WAL; only the last commits can be lost on power failure
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "cache_size": -int(os.getenv("SQLITE_CACHE_KB", 64000)),
+    "temp_store": "MEMORY",
+}
+
+
+def is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def is_sqlite_memory(url: str) -> bool:
+    return is_sqlite(url) and (url.endswith("://") or ":memory:" in url)
+
+
+def engine_options(url: str, writer: bool = True) -> dict:
+    """Pool settings for an engine; in-memory SQLite keeps its default pool"""
+    if is_sqlite_memory(url):
+        return {}
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+    if writer and is_sqlite(url):
+        # SQLite has a single writer: queue for it in the pool (in order,
+        # up to pool_timeout) rather than in busy_timeout retries
+        options["pool_size"] = 1
+        options["max_overflow"] = 0
+    if not is_sqlite(url):
+        # Drop connections the server closed while they sat in the pool
+        options["pool_pre_ping"] = True
+    return options
+
+
+_SQLITE_READ_STATEMENTS = ("SELECT", "PRAGMA", "EXPLAIN")
+
+
+def apply_sqlite_pragmas(engine, writer: bool):
+    """
+    Set SQLITE_PRAGMAS on every new connection of a (sync) engine.
+
+    Writer connections open their transaction with BEGIN IMMEDIATE, right
+    before the first write: a deferred transaction that reads and then
+    writes fails at once with "database is locked" if another connection
+    committed in between, without waiting for busy_timeout. Reads that come
+    before any write run outside a transaction, so a session that only
+    reads (e.g. a device lookup before handing the fix to the ingest queue)
+    never holds the single write lock.
+    """
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+        if writer:
+            # Let the "begin" event below open transactions instead of the driver
+            dbapi_connection.isolation_level = None
+
+    if writer:
+        @event.listens_for(engine, "begin")
+        def begin_on_first_write(connection):
+            connection.info["sqlite_begin_pending"] = True
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def begin_immediate(connection, cursor, statement, parameters, context, executemany):
+            if not connection.info.get("sqlite_begin_pending"):
+                return
+            if statement.lstrip().upper().startswith(_SQLITE_READ_STATEMENTS):
+                return
+            connection.info["sqlite_begin_pending"] = False
+            cursor.execute("BEGIN IMMEDIATE")
+
+        @event.listens_for(engine, "commit")
+        @event.listens_for(engine, "rollback")
+        def end_transaction(connection):
+            connection.info.pop("sqlite_begin_pending", None)
+
+
+def instrumented_options(url: str, writer: bool, name: str, is_async: bool) -> dict:
+    """engine_options() plus a pool that times checkouts, when metrics are on"""
+    options = engine_options(url, writer)
+    if METRICS_ENABLED and options:
+        options["poolclass"] = timed_pool_class(name, is_async)
+    return options
+
+
+def make_engine(url: str, writer: bool = True, name: str = "primary"):
+    connect_args = {"check_same_thread": False} if is_sqlite(url) else {}
+    new_engine = create_engine(
+        url,
+        echo=SQL_ECHO,
+        future=True,
+        connect_args=connect_args,
+        **instrumented_options(url, writer, name, is_async=False)
+    )
+    if is_sqlite(url):
+        apply_sqlite_pragmas(new_engine, writer)
+    if METRICS_ENABLED:
+        instrument_engine(name, new_engine)
+    return new_engine
+
+
+def replica_urls() -> List[str]:
+    """
+    Databases for read sessions. A file-backed SQLite database gets a
+    separate reader pool on the same file: with WAL its readers never block
+    the writer, which holds its lock for the whole transaction.
+    """
+    if DATABASE_REPLICA_URLS:
+        return DATABASE_REPLICA_URLS
+    if is_sqlite(DATABASE_URL) and not is_sqlite_memory(DATABASE_URL):
+        return [DATABASE_URL]
+    return []
+
+
+# Create engine
+engine = make_engine(DATABASE_URL)
+
+# Session factory
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# Replica session factories, used round-robin
+read_engines = [make_engine(url, writer=False, name=f"replica{i}") for i, url in enumerate(replica_urls())]
+ReadSessionFactories = [
+    sessionmaker(bind=replica, autoflush=False, autocommit=False) for replica in read_engines
+] or [SessionLocal]
+_next_read_session = itertools.cycle(ReadSessionFactories)
+
+
+def to_async_url(url: str) -> str:
+    """Map a sync database URL to its async driver equivalent"""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+# Async engine for routes that run on the event loop
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_url(DATABASE_URL))
+
+
+def make_async_engine(url: str, writer: bool = True, name: str = "primary_async"):
+    new_engine = create_async_engine(
+        url,
+        echo=SQL_ECHO,
+        future=True,
+        **instrumented_options(url, writer, name, is_async=True)
+    )
+    if is_sqlite(url):
+        apply_sqlite_pragmas(new_engine.sync_engine, writer)
+    if METRICS_ENABLED:
+        instrument_engine(name, new_engine.sync_engine)
+    return new_engine
+
+
+async_engine = make_async_engine(ASYNC_DATABASE_URL)
+
+# Async session factory (objects stay usable after commit)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False
+)
+
+async_read_engines = [
+    make_async_engine(to_async_url(url), writer=False, name=f"replica{i}_async")
+    for i, url in enumerate(replica_urls())
+]
+AsyncReadSessionFactories = [
+    async_sessionmaker(bind=replica, autoflush=False, expire_on_commit=False)
+    for replica in async_read_engines
+] or [AsyncSessionLocal]
+_next_async_read_session = itertools.cycle(AsyncReadSessionFactories)
+
+# Base class for models
+Base = declarative_base()
+
+
+# ---------- read-your-writes ----------
+
+# Table name -> monotonic time of this worker's last committed write to it
+_last_write: Dict[str, float] = {}
+
+
+@event.listens_for(Session, "after_flush")
+def _record_flushed_tables(session, flush_context):
+    tables = session.info.setdefault("written_tables", set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        tables.add(obj.__table__.name)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _record_statement_tables(orm_execute_state):
+    # Bulk insert/update/delete statements bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None:
+            orm_execute_state.session.info.setdefault("written_tables", set()).add(table.name)
+
+
+@event.listens_for(Session, "after_commit")
+def _stamp_written_tables(session):
+    tables = session.info.pop("written_tables", None)
+    if tables:
+        now = time.monotonic()
+        for table in tables:
+            _last_write[table] = now
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_written_tables(session):
+    session.info.pop("written_tables", None)
+
+
+def recently_written(tables: Iterable[str]) -> bool:
+    cutoff = time.monotonic() - DB_REPLICA_MAX_LAG
+    return any(_last_write.get(table, 0.0) > cutoff for table in tables)
+
+
+def read_session(fresh: Iterable[str] = ()) -> Session:
+    """
+    Session for read-only work: a replica, or the primary when this worker
+    wrote to any of the fresh tables within DB_REPLICA_MAX_LAG seconds
+    """
+    if not read_engines or recently_written(fresh):
+        return SessionLocal()
+    return next(_next_read_session)()
+
+
+def async_read_session(fresh: Iterable[str] = ()):
+    if not async_read_engines or recently_written(fresh):
+        return AsyncSessionLocal()
+    return next(_next_async_read_session)()
+
+
+def named_engines() -> List[tuple]:
+    """(name, sync engine) for every engine, named as in metrics"""
+    engines = [("primary", engine), ("primary_async", async_engine.sync_engine)]
+    engines += [(f"replica{i}", e) for i, e in enumerate(read_engines)]
+    engines += [(f"replica{i}_async", e.sync_engine) for i, e in enumerate(async_read_engines)]
+    return engines
+
+
+def engine_pools() -> List[dict]:
+    """Pool status of every engine, for /health"""
+    return [{"engine": name, "pool": e.pool.status()} for name, e in named_engines()]
+
+
+pool_gauges(named_engines)
+
+# Dependency for routes
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Dependency for async routes (never blocks the event loop)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def read_db(fresh: Iterable[str] = ()):
+    """
+    Dependency for read-only routes, served by a replica. Routes that must
+    see writes just made (read-your-writes) list the tables they read in
+    fresh, e.g. Depends(read_db(fresh=("vehicles",))).
+    """
+    fresh = tuple(fresh)
+
+    def dependency():
+        db = read_session(fresh)
+        try:
+            yield db
+        finally:
+            db.close()
+    return dependency
+
+
+def async_read_db(fresh: Iterable[str] = ()):
+    """read_db() for async routes"""
+    fresh = tuple(fresh)
+
+    async def dependency():
+        async with async_read_session(fresh) as db:
+            yield db
+    return dependency
+
+
+get_read_db = read_db()
+get_async_read_db = async_read_db()
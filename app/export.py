@@ -0,0 +1,180 @@
+"""
+Streaming bulk export of position history.
+
+Rows are read with a server-side cursor (stream_results/yield_per) as plain
+tuples and encoded chunk by chunk, so memory stays flat no matter how large
+the requested range is.
+
+Formats:
+- ndjson: one JSON object per line
+- csv: header row, then one row per position
+- columnar: little-endian binary blocks
+    header  b"FTCB" + u8 version (1)
+    block   u32 row count n, then
+            i64 id[n], i32 vehicle_id[n], f64 lat[n], f64 lng[n],
+            f32 speed[n], i64 recorded_at[n] (microseconds since epoch, UTC)
+    end     u32 0
+"""
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Sequence
+from sqlalchemy import select
+from .db import read_session
+from .segments import has_segments, iter_segment_points, merge_tracks
+from . import models
+import csv
+import io
+import itertools
+import json
+import os
+import struct
+import numpy as np
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 5000))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "columnar": "application/vnd.fleet.columnar",
+}
+
+COLUMNS = ("id", "vehicle_id", "lat", "lng", "speed", "recorded_at")
+
+COLUMNAR_MAGIC = b"FTCB"
+COLUMNAR_VERSION = 1
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def iter_position_chunks(
+    vehicle_ids: Optional[Sequence[int]] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+    chunk_rows: int = EXPORT_CHUNK_ROWS
+) -> Iterator[List[tuple]]:
+    """Yield lists of (id, vehicle_id, lat, lng, speed, recorded_at) tuples"""
+    stmt = select(
+        models.Position.id,
+        models.Position.vehicle_id,
+        models.Position.lat,
+        models.Position.lng,
+        models.Position.speed,
+        models.Position.recorded_at
+    )
+    if vehicle_ids:
+        stmt = stmt.where(models.Position.vehicle_id.in_(list(vehicle_ids)))
+    if from_time:
+        stmt = stmt.where(models.Position.recorded_at >= from_time)
+    if to_time:
+        stmt = stmt.where(models.Position.recorded_at <= to_time)
+    stmt = stmt.order_by(
+        models.Position.vehicle_id,
+        models.Position.recorded_at,
+        models.Position.id
+    ).execution_options(stream_results=True, yield_per=chunk_rows)
+
+    db = read_session()
+    try:
+        if not has_segments(db, vehicle_ids or None, from_time, to_time):
+            for partition in db.execute(stmt).partitions():
+                yield [tuple(row) for row in partition]
+            return
+
+        # Interleave compressed segments with the raw rows, in the same order
+        rows = merge_tracks(
+            (tuple(row) for partition in db.execute(stmt).partitions() for row in partition),
+            iter_segment_points(db, vehicle_ids or None, from_time, to_time)
+        )
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        db.close()
+
+
+def encode_ndjson(chunks: Iterator[List[tuple]]) -> Iterator[bytes]:
+    dumps = json.JSONEncoder(separators=(",", ":")).encode
+    for rows in chunks:
+        yield "".join(
+            dumps({
+                "id": r[0],
+                "vehicle_id": r[1],
+                "lat": r[2],
+                "lng": r[3],
+                "speed": r[4],
+                "recorded_at": r[5].isoformat()
+            }) + "\n"
+            for r in rows
+        ).encode()
+
+
+def encode_csv(chunks: Iterator[List[tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue().encode()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            (r[0], r[1], r[2], r[3], r[4], r[5].isoformat()) for r in rows
+        )
+        yield buffer.getvalue().encode()
+
+
+def encode_columnar(chunks: Iterator[List[tuple]]) -> Iterator[bytes]:
+    yield COLUMNAR_MAGIC + struct.pack("<B", COLUMNAR_VERSION)
+    for rows in chunks:
+        if not rows:
+            continue
+        ids, vehicle_ids, lats, lngs, speeds, times = zip(*rows)
+        micros = [(t - _EPOCH) // _MICROSECOND for t in times]
+        yield b"".join((
+            struct.pack("<I", len(rows)),
+            np.asarray(ids, dtype="<i8").tobytes(),
+            np.asarray(vehicle_ids, dtype="<i4").tobytes(),
+            np.asarray(lats, dtype="<f8").tobytes(),
+            np.asarray(lngs, dtype="<f8").tobytes(),
+            np.asarray([s or 0.0 for s in speeds], dtype="<f4").tobytes(),
+            np.asarray(micros, dtype="<i8").tobytes(),
+        ))
+    yield struct.pack("<I", 0)
+
+
+def decode_columnar(data: bytes) -> Iterator[dict]:
+    """Reference decoder for the columnar format (yields one dict per block)"""
+    view = memoryview(data)
+    if bytes(view[:4]) != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar position export")
+    offset = 5
+    while True:
+        (n,) = struct.unpack_from("<I", view, offset)
+        offset += 4
+        if n == 0:
+            return
+        block = {}
+        for name, dtype in (("id", "<i8"), ("vehicle_id", "<i4"), ("lat", "<f8"),
+                            ("lng", "<f8"), ("speed", "<f4"), ("recorded_at", "<i8")):
+            size = np.dtype(dtype).itemsize * n
+            block[name] = np.frombuffer(view[offset:offset + size], dtype=dtype)
+            offset += size
+        yield block
+
+
+_ENCODERS = {
+    "ndjson": encode_ndjson,
+    "csv": encode_csv,
+    "columnar": encode_columnar,
+}
+
+
+def export_positions(
+    fmt: str,
+    vehicle_ids: Optional[Sequence[int]] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None
+) -> Iterator[bytes]:
+    """Byte stream of the export in the requested format"""
+    return _ENCODERS[fmt](iter_position_chunks(vehicle_ids, from_time, to_time))
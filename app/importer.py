@@ -0,0 +1,372 @@
+"""
+High-throughput bulk import of historical tracks.
+
+Accepts NDJSON or CSV records spanning many devices, resolves device ids to
+vehicles in bulk and inserts positions in chunks with executemany (COPY on
+PostgreSQL/psycopg2). Fixes already stored are skipped, so overlapping
+files (or re-running an import) do not duplicate history. Each chunk is
+its own transaction; a job records the number of records fully committed
+so a failed import can be resumed with skip_records. When a job completes,
+the imported vehicles' trips and rollups are rebuilt (live ingest only
+derives them from fixes it stores itself).
+
+CLI:
+    python -m app.importer tracks.ndjson
+    python -m app.importer tracks.csv --resume
+"""
+from datetime import datetime
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+from . import models
+from .cache import response_cache, positions_tag
+from .ingest import INSERTED_COLUMNS, drop_compacted, insert_positions, match_inserted, validate_fix
+from .live import live_positions
+from .resolver import device_resolver
+from .rollups import backfill_rollups
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", 5000))
+
+IMPORT_FORMATS = ("ndjson", "csv")
+
+# Per-record errors kept on a job (the count is always exact)
+MAX_REPORTED_ERRORS = 100
+
+_POSITION_COLUMNS = ("vehicle_id", "lat", "lng", "speed", "recorded_at")
+
+# Client-chosen job ids, so an upload can be polled while it streams
+JOB_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class ImportJob:
+    """Progress and resume state of one bulk import"""
+
+    def __init__(
+        self,
+        fmt: str,
+        skip_records: int = 0,
+        chunk_rows: int = IMPORT_CHUNK_ROWS,
+        job_id: Optional[str] = None
+    ):
+        if fmt not in IMPORT_FORMATS:
+            raise ValueError(f"Unsupported import format '{fmt}'")
+        if job_id is not None and not JOB_ID_PATTERN.fullmatch(job_id):
+            raise ValueError("job_id must be 1-64 letters, digits, '-' or '_'")
+        self.id = job_id or uuid.uuid4().hex
+        self.format = fmt
+        self.chunk_rows = chunk_rows
+        self.skip_records = skip_records
+        self.status = "running"
+        self.records_read = 0
+        self.rows_imported = 0
+        self.rows_rejected = 0
+        self.rows_duplicate = 0
+        self.vehicle_ids: Set[int] = set()
+        self.committed_records = skip_records
+        self.errors: List[dict] = []
+        self.error: Optional[str] = None
+        self.started_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self._pending: List[Tuple[int, dict]] = []
+        self._csv_header: Optional[List[str]] = None
+
+    # ---------- parsing ----------
+
+    def _reject(self, record_no: int, message: str):
+        self.rows_rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"record": record_no, "error": message})
+
+    def _parse_line(self, line: str) -> Optional[dict]:
+        if self.format == "ndjson":
+            return json.loads(line)
+        values = next(csv.reader([line]))
+        if self._csv_header is None:
+            self._csv_header = [v.strip() for v in values]
+            return None
+        return dict(zip(self._csv_header, values))
+
+    def add_line(self, line: str) -> bool:
+        """Parse one input line; True when a chunk is ready to flush"""
+        line = line.strip()
+        if not line:
+            return False
+        try:
+            record = self._parse_line(line)
+        except (ValueError, csv.Error) as e:
+            if self.format == "csv" and self._csv_header is None:
+                raise
+            self.records_read += 1
+            if self.records_read > self.skip_records:
+                self._reject(self.records_read, f"Unparseable record: {e}")
+            return False
+        if record is None:
+            return False
+
+        self.records_read += 1
+        if self.records_read <= self.skip_records:
+            return False
+        self._pending.append((self.records_read, record))
+        return len(self._pending) >= self.chunk_rows
+
+    # ---------- writing ----------
+
+    def flush(self, db: Session):
+        """Resolve, insert and commit the pending chunk"""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        fixes = []
+        for record_no, record in pending:
+            try:
+                fixes.append((record_no, validate_fix(record)))
+            except ValueError as e:
+                self._reject(record_no, str(e))
+
+        vehicle_ids = device_resolver.resolve_many(db, {fix[0] for _, fix in fixes})
+        rows = []
+        for record_no, (device_id, lat, lng, speed, recorded_at) in fixes:
+            if device_id not in vehicle_ids:
+                # Auto-create is off and no vehicle matches
+                self._reject(record_no, f"Unknown device '{device_id}'")
+                continue
+            rows.append({
+                "vehicle_id": vehicle_ids[device_id],
+                "lat": lat,
+                "lng": lng,
+                "speed": speed,
+                "recorded_at": recorded_at
+            })
+
+        try:
+            stored = insert_rows(db, rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Nothing from this chunk is committed; resume from its first record
+            self._pending = pending + self._pending
+            raise
+
+        self.rows_imported += len(stored)
+        self.rows_duplicate += len(rows) - len(stored)
+        self.committed_records = pending[-1][0]
+        self.vehicle_ids.update(row["vehicle_id"] for row in stored)
+        update_live_positions(stored)
+        response_cache.invalidate_soon(*(positions_tag(v) for v in set(vehicle_ids.values())))
+
+    def backfill(self, db: Session):
+        """
+        Rebuild trips and rollups of the vehicles that got new history.
+        Also worth running for a failed job: its committed chunks stay.
+        """
+        if not self.vehicle_ids:
+            return
+        if self.status == "running":
+            self.status = "backfilling"
+        backfill_rollups(db, sorted(self.vehicle_ids), trips=True)
+
+    def backfill_after_failure(self, db: Session):
+        try:
+            self.backfill(db)
+        except Exception as e:
+            print(f"Import {self.id}: rebuilding trips and rollups failed: {e}")
+
+    def finish(self, status: str = "completed", error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.finished_at = datetime.utcnow()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "format": self.format,
+            "records_read": self.records_read,
+            "rows_imported": self.rows_imported,
+            "rows_rejected": self.rows_rejected,
+            "rows_duplicate": self.rows_duplicate,
+            "committed_records": self.committed_records,
+            "resume_skip_records": self.committed_records,
+            "errors": self.errors,
+            "error": self.error,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+def insert_rows(db: Session, rows: List[dict]) -> List[dict]:
+    """
+    executemany insert, or COPY when running on PostgreSQL with psycopg2,
+    skipping fixes that are already stored (raw or compacted). Sets
+    row["id"] on the stored rows and returns them.
+    """
+    rows = drop_compacted(db, rows)
+    if not rows:
+        return []
+    bind = db.get_bind()
+    if bind.dialect.name == "postgresql" and bind.dialect.driver == "psycopg2":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[c] for c in _POSITION_COLUMNS])
+        buffer.seek(0)
+        columns = ", ".join(_POSITION_COLUMNS)
+        cursor = db.connection().connection.cursor()
+        # COPY cannot skip conflicts, so stage the chunk and insert from there
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS positions_import ON COMMIT DELETE ROWS "
+            f"AS SELECT {columns} FROM positions WITH NO DATA"
+        )
+        cursor.copy_expert(f"COPY positions_import ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO positions ({columns}) SELECT {columns} FROM positions_import "
+            f"ON CONFLICT DO NOTHING RETURNING {', '.join(INSERTED_COLUMNS)}"
+        )
+        return match_inserted(rows, cursor.fetchall())
+    return insert_positions(db, rows)
+
+
+def update_live_positions(rows: List[dict]):
+    """Newest imported fix per vehicle (stored rows, with ids), if newer than what is live"""
+    latest: Dict[int, dict] = {}
+    for row in rows:
+        current = latest.get(row["vehicle_id"])
+        if current is None or row["recorded_at"] >= current["recorded_at"]:
+            latest[row["vehicle_id"]] = row
+    for vehicle_id, row in latest.items():
+        live_positions.update(vehicle_id, row)
+
+
+def _split_lines(remainder: bytes, chunk: bytes) -> Tuple[List[str], bytes]:
+    lines = (remainder + chunk).split(b"\n")
+    remainder = lines.pop()
+    return [line.decode("utf-8-sig") for line in lines], remainder
+
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Split a stream of byte chunks into decoded lines"""
+    remainder = b""
+    for chunk in chunks:
+        lines, remainder = _split_lines(remainder, chunk)
+        yield from lines
+    if remainder:
+        yield remainder.decode("utf-8-sig")
+
+
+async def aiter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """Async variant of iter_lines for streaming request bodies"""
+    remainder = b""
+    async for chunk in chunks:
+        lines, remainder = _split_lines(remainder, chunk)
+        for line in lines:
+            yield line
+    if remainder:
+        yield remainder.decode("utf-8-sig")
+
+
+# ==================== JOB REGISTRY ====================
+
+_jobs: Dict[str, ImportJob] = {}
+_jobs_lock = threading.Lock()
+
+# Finished jobs kept for status lookups
+MAX_TRACKED_JOBS = 100
+
+
+def register_job(job: ImportJob):
+    """Track a job for status lookups; a job id still in use raises ValueError"""
+    with _jobs_lock:
+        current = _jobs.get(job.id)
+        if current is not None and current.finished_at is None:
+            raise ValueError(f"Import job {job.id} is still running")
+        _jobs[job.id] = job
+        if len(_jobs) > MAX_TRACKED_JOBS:
+            finished = [j for j in _jobs.values() if j.finished_at is not None]
+            for old in sorted(finished, key=lambda j: j.started_at)[:len(_jobs) - MAX_TRACKED_JOBS]:
+                del _jobs[old.id]
+
+
+def get_job(job_id: str) -> Optional[ImportJob]:
+    return _jobs.get(job_id)
+
+
+# ==================== CLI ====================
+
+def _checkpoint_path(path: str) -> str:
+    return path + ".import-checkpoint"
+
+
+def import_file(db: Session, path: str, fmt: str, skip_records: int = 0) -> ImportJob:
+    """Import a file, writing a checkpoint after every committed chunk"""
+    job = ImportJob(fmt, skip_records=skip_records)
+    checkpoint = _checkpoint_path(path)
+    started = time.perf_counter()
+
+    def flush():
+        job.flush(db)
+        with open(checkpoint, "w") as f:
+            json.dump({"committed_records": job.committed_records}, f)
+        rate = job.rows_imported / max(time.perf_counter() - started, 1e-9)
+        print(f"  {job.committed_records} records committed "
+              f"({job.rows_imported} imported, {job.rows_duplicate} duplicate, {job.rows_rejected} rejected, "
+              f"{rate:.0f} rows/s)")
+
+    try:
+        with open(path, "rb") as f:
+            for line in iter_lines(iter(lambda: f.read(1 << 20), b"")):
+                if job.add_line(line):
+                    flush()
+        flush()
+    except Exception as e:
+        job.finish("failed", str(e))
+        print(f"Import failed: {e}")
+        job.backfill_after_failure(db)
+        print(f"Re-run with --resume to continue after record {job.committed_records}")
+        return job
+
+    print(f"Imported {job.rows_imported} positions in {time.perf_counter() - started:.1f}s")
+    print(f"Rebuilding trips and rollups for {len(job.vehicle_ids)} vehicles")
+    job.backfill(db)
+    job.finish()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return job
+
+
+def main():
+    from .db import SessionLocal, engine
+
+    parser = argparse.ArgumentParser(description="Bulk import historical GPS tracks")
+    parser.add_argument("path", help="NDJSON or CSV file")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="Defaults to the file extension")
+    parser.add_argument("--resume", action="store_true", help="Continue from the last checkpoint")
+    parser.add_argument("--skip-records", type=int, default=0, help="Skip this many records")
+    args = parser.parse_args()
+
+    fmt = args.format or ("csv" if args.path.lower().endswith(".csv") else "ndjson")
+    skip = args.skip_records
+    if args.resume and os.path.exists(_checkpoint_path(args.path)):
+        with open(_checkpoint_path(args.path)) as f:
+            skip = json.load(f)["committed_records"]
+        print(f"Resuming after record {skip}")
+
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        job = import_file(db, args.path, fmt, skip_records=skip)
+    finally:
+        db.close()
+    raise SystemExit(0 if job.status == "completed" else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,539 @@
+"""
+Write-behind ingestion pipeline for device positions.
+
+In "queued" mode device pings are put on a bounded in-process queue and a
+background writer drains it in micro-batches: one bulk INSERT and one commit
+per batch instead of one transaction per ping.
+
+Devices on flaky links resend fixes, so every path skips duplicates: a fix
+is identified by (vehicle, recorded_at, lat, lng), enforced by a unique
+index, with an in-memory set of recently stored keys (plus device sequence
+numbers) in front so most resends never reach the database.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .db import SessionLocal, AsyncSessionLocal
+from . import models
+from .websocket import manager
+from .live import live_positions
+from .cache import response_cache, positions_tag, CACHE_HISTORY_SETTLE_SECONDS
+from .trips import record_trips
+from .rollups import record_rollups
+from .segments import compacted_fixes, segment_key
+from .metrics import Gauge, ingest_batch_size, ingest_duplicates, ingest_queue_lag, ingest_rejected, positions_stored
+import asyncio
+import os
+import threading
+import time
+
+# "direct" writes every ping in its own transaction, "queued" uses the pipeline
+INGEST_MODE = os.getenv("INGEST_MODE", "direct")
+
+# Default acknowledgement for queued mode: "enqueue" or "durable"
+INGEST_ACK = os.getenv("INGEST_ACK", "durable")
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", 50))
+
+# How long a caller waits for queue space before being rejected
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv("INGEST_ENQUEUE_TIMEOUT", 2.0))
+
+# Recently stored fix keys remembered to drop resends without a query (0 disables)
+DEDUP_RECENT_KEYS = int(os.getenv("DEDUP_RECENT_KEYS", 100000))
+
+# A repeated device seq only marks a resend this close to the fix stored
+# with it: counters restart on reboot and 16-bit ones wrap
+DEDUP_SEQ_WINDOW_SECONDS = float(os.getenv("DEDUP_SEQ_WINDOW_SECONDS", 600))
+
+# Columns of an inserted position row
+POSITION_COLUMNS = ("vehicle_id", "lat", "lng", "speed", "recorded_at")
+
+ACK_ENQUEUE = "enqueue"
+ACK_DURABLE = "durable"
+
+
+class IngestQueueFull(Exception):
+    """Raised when the ingest queue has no room (or is shutting down)"""
+    pass
+
+
+def naive_utc(value: datetime) -> datetime:
+    """Convert an aware datetime to naive UTC, the form stored in the DB"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def parse_timestamp(value) -> datetime:
+    """Parse a device timestamp into a naive UTC datetime (now if missing/invalid)"""
+    if value:
+        try:
+            return naive_utc(datetime.fromisoformat(str(value).replace('Z', '+00:00')))
+        except ValueError:
+            pass
+    return datetime.utcnow()
+
+
+def _first(payload: dict, keys):
+    for key in keys:
+        value = payload.get(key)
+        if value is not None and value != "":
+            return value
+    return None
+
+
+def extract_fix(payload: dict):
+    """
+    Pull (device_id, lat, lng, speed, timestamp) out of a device payload,
+    accepting the field aliases used by the various GPS protocols.
+    device_id, lat or lng is None when missing.
+    """
+    return (
+        _first(payload, ("device_id", "imei", "deviceId", "id")),
+        _first(payload, ("lat", "latitude")),
+        _first(payload, ("lng", "longitude", "lon")),
+        _first(payload, ("speed",)) or 0,
+        _first(payload, ("timestamp",))
+    )
+
+
+def extract_seq(payload: dict) -> Optional[int]:
+    """Device sequence number ("seq" or "sequence"); None if absent or not an integer"""
+    value = _first(payload, ("seq", "sequence"))
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def validate_fix(record) -> tuple:
+    """
+    Normalised (device_id, lat, lng, speed, recorded_at) for one batch or
+    import record. Raises ValueError describing why a record is rejected.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("Record is not an object")
+    device_id, lat, lng, speed, timestamp = extract_fix(record)
+    if not device_id or lat is None or lng is None:
+        raise ValueError("Missing required fields: device_id, lat, lng")
+    try:
+        lat, lng, speed = float(lat), float(lng), float(speed)
+    except (TypeError, ValueError):
+        raise ValueError("lat, lng and speed must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("lat/lng out of range")
+    if timestamp is None:
+        recorded_at = datetime.utcnow()
+    else:
+        try:
+            recorded_at = naive_utc(datetime.fromisoformat(str(timestamp).replace('Z', '+00:00')))
+        except ValueError:
+            raise ValueError(f"Invalid timestamp '{timestamp}'")
+    return str(device_id), lat, lng, speed, recorded_at
+
+
+def position_payload(row: dict) -> dict:
+    """WebSocket payload for a stored position row"""
+    return {
+        "id": row.get("id"),
+        "lat": row["lat"],
+        "lng": row["lng"],
+        "speed": row["speed"],
+        "recorded_at": row["recorded_at"].isoformat()
+    }
+
+
+def fix_key(row: dict) -> tuple:
+    """What makes a position unique (the uq_positions_fix index)"""
+    return (row["vehicle_id"], row["recorded_at"], row["lat"], row["lng"])
+
+
+def fix_keys(row: dict) -> List[tuple]:
+    """Identities of a position row: the fix itself, and the device sequence number if sent"""
+    keys = [fix_key(row)]
+    if row.get("seq") is not None:
+        keys.append((row["vehicle_id"], "seq", row["seq"]))
+    return keys
+
+
+def find_resend(known: Dict[tuple, datetime], keys: Iterable[tuple], recorded_at: datetime) -> Optional[tuple]:
+    """
+    The first of a fix's keys that marks it a resend, given known keys
+    mapped to the recorded_at they were stored with. A fix key always
+    does; a seq key only within DEDUP_SEQ_WINDOW_SECONDS.
+    """
+    for key in keys:
+        stored_at = known.get(key)
+        if stored_at is None:
+            continue
+        if key[1] != "seq" or abs((recorded_at - stored_at).total_seconds()) <= DEDUP_SEQ_WINDOW_SECONDS:
+            return key
+    return None
+
+
+class RecentFixes:
+    """
+    Bounded LRU of fix keys that are known to be in the database, with
+    the recorded_at of the fix each was stored with (see find_resend).
+
+    Keys are added only after a commit (see publish_positions), so a
+    rolled-back batch can be retried. A miss proves nothing; the unique
+    index has the final word.
+    """
+
+    def __init__(self, maxsize: int = DEDUP_RECENT_KEYS):
+        self.maxsize = maxsize
+        self._keys: "OrderedDict[tuple, datetime]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, keys: Iterable[tuple], recorded_at: datetime) -> bool:
+        with self._lock:
+            key = find_resend(self._keys, keys, recorded_at)
+            if key is None:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def add(self, rows: Iterable[dict]):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            for row in rows:
+                for key in fix_keys(row):
+                    self._keys[key] = row["recorded_at"]
+                    self._keys.move_to_end(key)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+recent_fixes = RecentFixes()
+
+
+def insert_ignoring_duplicates(db: Session):
+    """INSERT into positions that skips rows hitting the unique fix index"""
+    table = models.Position.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+
+# Columns an insert returns so its ids can be matched back to rows (match_inserted)
+INSERTED_COLUMNS = ("id", "vehicle_id", "recorded_at", "lat", "lng")
+
+
+def match_inserted(rows: List[dict], inserted: Iterable[tuple]) -> List[dict]:
+    """
+    Set row["id"] from the INSERTED_COLUMNS tuples returned by an insert
+    that skipped duplicates. Rows without an id (already stored, or a
+    repeat of an earlier row) get row["duplicate"] = True.
+    Returns the stored rows.
+    """
+    ids = {
+        (vehicle_id, recorded_at, lat, lng): position_id
+        for position_id, vehicle_id, recorded_at, lat, lng in inserted
+    }
+    stored = []
+    for row in rows:
+        row["id"] = ids.pop(fix_key(row), None)
+        if row["id"] is None:
+            row["duplicate"] = True
+        else:
+            stored.append(row)
+    return stored
+
+
+def insert_positions(db: Session, rows: List[dict]) -> List[dict]:
+    """Insert rows, skipping stored fixes; returns the stored rows (see match_inserted)"""
+    if not rows:
+        return []
+    # RETURNING skips conflicting rows, so the ids are matched back by fix
+    columns = models.Position.__table__.c
+    result = db.execute(
+        insert_ignoring_duplicates(db).returning(*(columns[name] for name in INSERTED_COLUMNS)),
+        [{column: row[column] for column in POSITION_COLUMNS if column in row} for row in rows]
+    )
+    return match_inserted(rows, result)
+
+
+def drop_compacted(db: Session, rows: List[dict]) -> List[dict]:
+    """
+    Rows whose fix is not already packed into a track segment. The unique
+    index only covers the positions table, so compacted fixes are checked
+    here; dropped rows are marked like other duplicates.
+    """
+    compacted = compacted_fixes(db, rows)
+    if not compacted:
+        return rows
+    kept = []
+    for row in rows:
+        if segment_key(row["vehicle_id"], row["recorded_at"], row["lat"], row["lng"]) in compacted:
+            row["id"] = None
+            row["duplicate"] = True
+        else:
+            kept.append(row)
+    ingest_duplicates.inc("segment", amount=len(rows) - len(kept))
+    return kept
+
+
+def store_positions(db: Session, rows: List[dict]) -> List[dict]:
+    """
+    Bulk insert position rows in the caller's transaction and update the
+    derived per-vehicle state (trips, rollups) alongside them.
+    Duplicates (already stored, or repeated within rows) are skipped and
+    get row["duplicate"] = True and row["id"] = None; stored rows get
+    their new row["id"]. Returns the stored rows.
+    """
+    fresh = []
+    batch_keys: Dict[tuple, datetime] = {}
+    for row in rows:
+        keys = fix_keys(row)
+        recorded_at = row["recorded_at"]
+        if find_resend(batch_keys, keys, recorded_at) or recent_fixes.seen(keys, recorded_at):
+            row["id"] = None
+            row["duplicate"] = True
+            ingest_duplicates.inc("memory")
+            continue
+        batch_keys.update((key, recorded_at) for key in keys)
+        fresh.append(row)
+    fresh = drop_compacted(db, fresh)
+    if not fresh:
+        return []
+
+    stored = insert_positions(db, fresh)
+    ingest_duplicates.inc("database", amount=len(fresh) - len(stored))
+    positions_stored.inc(amount=len(stored))
+    steps = record_trips(db, stored)
+    record_rollups(db, steps)
+    return stored
+
+
+def remove_duplicate_positions(db: Session) -> int:
+    """Delete all but the first copy of each fix (rows stored before the unique index)"""
+    first = (
+        select(func.min(models.Position.id))
+        .group_by(
+            models.Position.vehicle_id, models.Position.recorded_at,
+            models.Position.lat, models.Position.lng
+        )
+    )
+    result = db.execute(delete(models.Position).where(models.Position.id.not_in(first)))
+    return result.rowcount
+
+
+def publish_positions(rows: List[dict]):
+    """
+    After commit: remember the rows' fix keys, update the last-position
+    store and notify WebSocket subscribers with the newest committed row
+    per vehicle. Duplicates and out-of-order fixes are not broadcast.
+    """
+    recent_fixes.add(rows)
+    rows = [row for row in rows if not row.get("duplicate")]
+
+    latest: Dict[int, dict] = {}
+    for row in rows:
+        current = latest.get(row["vehicle_id"])
+        if current is None or row["recorded_at"] >= current["recorded_at"]:
+            latest[row["vehicle_id"]] = row
+
+    for vehicle_id, row in latest.items():
+        # False when the vehicle already has a newer fix
+        if live_positions.update(vehicle_id, row):
+            asyncio.create_task(manager.notify_vehicle_update(
+                vehicle_id,
+                position_payload(row)
+            ))
+
+    # Late fixes land in history pages that may already be cached
+    settled = datetime.utcnow() - timedelta(seconds=CACHE_HISTORY_SETTLE_SECONDS)
+    late = {row["vehicle_id"] for row in rows if row["recorded_at"] < settled}
+    if late:
+        response_cache.invalidate_soon(*(positions_tag(vehicle_id) for vehicle_id in late))
+
+
+class IngestPipeline:
+    """Bounded queue plus a background writer doing group commits"""
+
+    def __init__(
+        self,
+        maxsize: int = INGEST_QUEUE_SIZE,
+        batch_size: int = INGEST_BATCH_SIZE,
+        flush_interval_ms: int = INGEST_FLUSH_INTERVAL_MS
+    ):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Submits between the running check and their put landing in the queue
+        self._putting = 0
+        self._puts_done: Optional[asyncio.Event] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    async def start(self):
+        """Start the background writer (call from the app's startup event)"""
+        if self._task is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._closing = False
+        self._puts_done = asyncio.Event()
+        self._puts_done.set()
+        self._task = asyncio.create_task(self._run())
+        print(f"Ingest pipeline started (batch={self.batch_size}, "
+              f"interval={int(self.flush_interval * 1000)}ms)")
+
+    async def stop(self):
+        """Stop accepting pings and flush everything already queued"""
+        if self._task is None:
+            return
+        self._closing = True
+        # Submits still waiting for room go in ahead of the sentinel, so the
+        # writer stores them before it exits
+        await self._puts_done.wait()
+        await self.queue.put(None)
+        try:
+            await self._task
+        finally:
+            self._task = None
+            # Only left over if the writer was cancelled; don't leave a
+            # durable caller waiting forever
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is not None and item[1] is not None and not item[1].done():
+                    item[1].set_exception(IngestQueueFull("Ingest pipeline stopped"))
+        print("Ingest pipeline stopped")
+
+    async def submit(self, row: dict, ack: str = ACK_DURABLE) -> Optional[int]:
+        """
+        Queue a position row.
+        With ack="durable" waits until the batch is committed and returns the
+        position id (None, with row["duplicate"] set, for a duplicate); with
+        ack="enqueue" returns None as soon as it is queued.
+        Raises IngestQueueFull when the queue stays full (backpressure).
+        """
+        if not self.running:
+            raise IngestQueueFull("Ingest pipeline is not accepting positions")
+
+        future = asyncio.get_running_loop().create_future() if ack == ACK_DURABLE else None
+        item = (row, future, time.perf_counter())
+        self._putting += 1
+        self._puts_done.clear()
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(
+                    self.queue.put(item),
+                    timeout=INGEST_ENQUEUE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                ingest_rejected.inc()
+                raise IngestQueueFull("Ingest queue is full")
+        finally:
+            self._putting -= 1
+            if not self._putting:
+                self._puts_done.set()
+
+        if future is None:
+            return None
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+
+            # Fill the batch until it is full or the deadline passes
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        rows = [row for row, _, _ in batch]
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except Exception as e:
+            print(f"Error flushing ingest batch of {len(rows)}: {e}")
+            for _, future, _ in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+
+        committed = time.perf_counter()
+        ingest_batch_size.observe(len(rows))
+        for row, future, queued_at in batch:
+            ingest_queue_lag.observe(committed - queued_at)
+            if future is not None and not future.done():
+                future.set_result(row["id"])
+        publish_positions(rows)
+
+    def _write(self, rows: List[dict]):
+        db = SessionLocal()
+        try:
+            store_positions(db, rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+ingest_pipeline = IngestPipeline()
+
+Gauge("ingest_queue_depth", "Positions waiting in the write-behind queue", ingest_pipeline.depth)
+
+
+async def ingest_positions(rows: List[dict]):
+    """
+    Store rows outside a request the way device_position_update does:
+    through the pipeline when it is running (waiting for the commit),
+    otherwise in a transaction of their own.
+    """
+    if not rows:
+        return
+    if ingest_pipeline.running:
+        await asyncio.gather(*(ingest_pipeline.submit(row) for row in rows))
+        return
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(store_positions, rows)
+        await db.commit()
+    publish_positions(rows)
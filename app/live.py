@@ -0,0 +1,298 @@
+"""
+In-memory last-known-position store and fleet change log.
+
+Kept up to date by the ingest paths so fleet snapshots are served in
+O(fleet size) instead of a GROUP BY over the whole positions table.
+The change log numbers every change to a vehicle's last position or
+metadata so pollers can fetch only what changed since their last token,
+and fleet stats keep moving/idle/stale counts current as fixes arrive.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from . import models
+from .segments import latest_points
+import os
+import threading
+import time
+import uuid
+
+# Deleted vehicles remembered for delta polls; older tokens get a full snapshot
+FLEET_CHANGE_TOMBSTONES = int(os.getenv("FLEET_CHANGE_TOMBSTONES", 10000))
+
+# Fleet stats: above this speed (km/h) a vehicle counts as moving
+FLEET_MOVING_SPEED_KMH = float(os.getenv("FLEET_MOVING_SPEED_KMH", 5))
+
+# Fleet stats: vehicles without a fix for this long count as stale
+FLEET_STALE_MINUTES = float(os.getenv("FLEET_STALE_MINUTES", 10))
+
+
+class FleetChangeLog:
+    """
+    Monotonic change sequence for the fleet snapshot.
+
+    Each vehicle keeps the sequence number of its latest change, in an
+    OrderedDict ordered by that number, so changes since a token are found
+    by walking back from the newest one. Tokens are "<epoch>.<seq>"; the
+    epoch is per process, so tokens from a restarted or different worker
+    are not valid and callers send a full snapshot instead.
+    """
+
+    def __init__(self, max_tombstones: int = FLEET_CHANGE_TOMBSTONES):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.max_tombstones = max_tombstones
+        self._changed: "OrderedDict[int, int]" = OrderedDict()
+        self._deleted: "OrderedDict[int, int]" = OrderedDict()
+        # Deltas since tokens below this would miss pruned tombstones
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def token(self) -> str:
+        return f"{self.epoch}.{self.seq}"
+
+    def touch(self, vehicle_id: int):
+        """Record a change to a vehicle's metadata or last position"""
+        with self._lock:
+            self.seq += 1
+            self._changed[vehicle_id] = self.seq
+            self._changed.move_to_end(vehicle_id)
+            self._deleted.pop(vehicle_id, None)
+
+    def delete(self, vehicle_id: int):
+        with self._lock:
+            self.seq += 1
+            self._changed.pop(vehicle_id, None)
+            self._deleted[vehicle_id] = self.seq
+            self._deleted.move_to_end(vehicle_id)
+            while len(self._deleted) > self.max_tombstones:
+                _, pruned = self._deleted.popitem(last=False)
+                self._floor = pruned
+
+    def parse(self, token: str) -> Optional[int]:
+        """Sequence number of a token from this process, else None"""
+        epoch, _, seq = (token or "").partition(".")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq < self._floor or seq > self.seq:
+            return None
+        return seq
+
+    def since(self, seq: int) -> Tuple[List[int], List[int]]:
+        """(changed vehicle ids, deleted vehicle ids) after seq, newest first"""
+        with self._lock:
+            changed = []
+            for vehicle_id in reversed(self._changed):
+                if self._changed[vehicle_id] <= seq:
+                    break
+                changed.append(vehicle_id)
+            deleted = []
+            for vehicle_id in reversed(self._deleted):
+                if self._deleted[vehicle_id] <= seq:
+                    break
+                deleted.append(vehicle_id)
+        return changed, deleted
+
+
+class FleetStats:
+    """
+    Fleet-wide counts maintained as fixes arrive, so reading them is O(1).
+
+    Each vehicle with a recent fix is moving (speed above
+    FLEET_MOVING_SPEED_KMH) or idle; vehicles whose last fix arrived more
+    than FLEET_STALE_MINUTES ago are stale. Recent vehicles sit in an
+    OrderedDict by arrival time, so expiring them only looks at the
+    oldest entries (amortized O(1) per fix).
+    """
+
+    def __init__(self, moving_speed: float = FLEET_MOVING_SPEED_KMH, stale_minutes: float = FLEET_STALE_MINUTES):
+        self.moving_speed = moving_speed
+        self.stale_after = stale_minutes * 60
+        self._known: Set[int] = set()
+        # vehicle_id -> (monotonic arrival time, speed), oldest arrival first
+        self._recent: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+        self._stale: Set[int] = set()
+        self._moving = 0
+        self._speed_sum = 0.0
+        self._lock = threading.Lock()
+
+    def _leave(self, vehicle_id: int):
+        """Drop a vehicle's current classification (caller holds the lock)"""
+        entry = self._recent.pop(vehicle_id, None)
+        if entry is not None:
+            speed = entry[1]
+            self._speed_sum -= speed
+            if speed > self.moving_speed:
+                self._moving -= 1
+            if not self._recent:
+                self._speed_sum = 0.0
+        else:
+            self._stale.discard(vehicle_id)
+
+    def _enter(self, vehicle_id: int, speed: float, arrived: float):
+        self._known.add(vehicle_id)
+        self._recent[vehicle_id] = (arrived, speed)
+        self._speed_sum += speed
+        if speed > self.moving_speed:
+            self._moving += 1
+
+    def _expire(self, now: float):
+        cutoff = now - self.stale_after
+        while self._recent:
+            vehicle_id, (arrived, _) = next(iter(self._recent.items()))
+            if arrived >= cutoff:
+                break
+            self._leave(vehicle_id)
+            self._stale.add(vehicle_id)
+
+    def observe(self, vehicle_id: int, speed: Optional[float], recorded_at: datetime):
+        """A newer fix for a vehicle arrived"""
+        # A backfilled fix that was already old when it arrived stays stale
+        backfilled = (datetime.utcnow() - recorded_at).total_seconds() > self.stale_after
+        with self._lock:
+            self._leave(vehicle_id)
+            if backfilled:
+                self._known.add(vehicle_id)
+                self._stale.add(vehicle_id)
+            else:
+                self._enter(vehicle_id, speed or 0.0, time.monotonic())
+
+    def vehicle_added(self, vehicle_id: int):
+        with self._lock:
+            self._known.add(vehicle_id)
+
+    def vehicle_removed(self, vehicle_id: int):
+        with self._lock:
+            self._leave(vehicle_id)
+            self._known.discard(vehicle_id)
+
+    def load(self, vehicle_ids: Iterable[int], positions: Dict[int, dict]):
+        """Rebuild from the vehicle list and last positions (at startup)"""
+        now, utcnow = time.monotonic(), datetime.utcnow()
+        with self._lock:
+            self._known = set(vehicle_ids) | set(positions)
+            self._recent = OrderedDict()
+            self._stale = set()
+            self._moving = 0
+            self._speed_sum = 0.0
+            # Treat recorded_at as the arrival time of each vehicle's last fix
+            for position in sorted(positions.values(), key=lambda p: p["recorded_at"]):
+                age = (utcnow - position["recorded_at"]).total_seconds()
+                self._enter(position["vehicle_id"], position["speed"] or 0.0, now - max(age, 0.0))
+            self._expire(now)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            active = len(self._recent)
+            return {
+                "total": len(self._known),
+                "active": active,
+                "moving": self._moving,
+                "idle": active - self._moving,
+                "stale": len(self._stale),
+                "never_reported": len(self._known) - active - len(self._stale),
+                "avg_speed": round(self._speed_sum / active, 1) if active else 0.0,
+                "moving_speed_kmh": self.moving_speed,
+                "stale_after_minutes": self.stale_after / 60
+            }
+
+
+class LastPositionStore:
+    """Newest known position per vehicle; older timestamps are ignored"""
+
+    def __init__(self):
+        self._positions: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def update(self, vehicle_id: int, position: dict) -> bool:
+        """
+        Record a position (keys: id, lat, lng, speed, recorded_at).
+        Returns False if it is older than what is already known.
+        """
+        with self._lock:
+            current = self._positions.get(vehicle_id)
+            if current is not None and position["recorded_at"] < current["recorded_at"]:
+                return False
+            self._positions[vehicle_id] = {
+                "id": position.get("id"),
+                "vehicle_id": vehicle_id,
+                "lat": position["lat"],
+                "lng": position["lng"],
+                "speed": position.get("speed") or 0.0,
+                "recorded_at": position["recorded_at"]
+            }
+        fleet_changes.touch(vehicle_id)
+        fleet_stats.observe(vehicle_id, position.get("speed"), position["recorded_at"])
+        return True
+
+    def get(self, vehicle_id: int) -> Optional[dict]:
+        return self._positions.get(vehicle_id)
+
+    def remove(self, vehicle_id: int):
+        with self._lock:
+            self._positions.pop(vehicle_id, None)
+
+    def snapshot(self) -> Dict[int, dict]:
+        with self._lock:
+            return dict(self._positions)
+
+    def load(self, db: Session):
+        """Rebuild the store from the database (run once at startup)"""
+        latest = (
+            db.query(
+                models.Position.vehicle_id,
+                func.max(models.Position.recorded_at).label('max_time')
+            )
+            .group_by(models.Position.vehicle_id)
+            .subquery()
+        )
+        rows = (
+            db.query(models.Position)
+            .join(
+                latest,
+                (models.Position.vehicle_id == latest.c.vehicle_id) &
+                (models.Position.recorded_at == latest.c.max_time)
+            )
+            .all()
+        )
+
+        positions = {}
+        for position in rows:
+            current = positions.get(position.vehicle_id)
+            # Ties on recorded_at: keep the highest id
+            if current is None or position.id > current["id"]:
+                positions[position.vehicle_id] = {
+                    "id": position.id,
+                    "vehicle_id": position.vehicle_id,
+                    "lat": position.lat,
+                    "lng": position.lng,
+                    "speed": position.speed or 0.0,
+                    "recorded_at": position.recorded_at
+                }
+
+        # Vehicles whose newest fixes were compressed into track segments
+        for vehicle_id, (row_id, _, lat, lng, speed, recorded_at) in latest_points(db).items():
+            current = positions.get(vehicle_id)
+            if current is None or (recorded_at, row_id) > (current["recorded_at"], current["id"]):
+                positions[vehicle_id] = {
+                    "id": row_id,
+                    "vehicle_id": vehicle_id,
+                    "lat": lat,
+                    "lng": lng,
+                    "speed": speed,
+                    "recorded_at": recorded_at
+                }
+
+        with self._lock:
+            self._positions = positions
+        fleet_stats.load((vid for (vid,) in db.query(models.Vehicle.id)), positions)
+        print(f"Loaded last positions for {len(positions)} vehicles")
+
+
+fleet_changes = FleetChangeLog()
+fleet_stats = FleetStats()
+live_positions = LastPositionStore()
@@ -1,51 +1,151 @@
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from .db import Base, engine
-from . import models
-from .routes import router
-
-app = FastAPI(
-    title="Fleet Tracker API",
-    description="Real-time vehicle tracking system",
-    version="1.0.0"
-)
-
-# CORS Configuration
-origins = [
-    "http://localhost:5173",  # Vite dev server
-    "http://localhost:3000",  # Alternative React dev
-    "http://127.0.0.1:5173",
-    # Add your GitHub Pages URL later:
-    # "https://<your-username>.github.io",
-]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Create tables on startup
-@app.on_event("startup")
-def on_startup():
-    print("Creating database tables...")
-    Base.metadata.create_all(bind=engine)
-    print("Database ready!")
-
-# Include API routes
-app.include_router(router, prefix="/api", tags=["Fleet Tracking"])
-
-# Root endpoint
-@app.get("/")
-def root():
-    return {
-        "message": "Fleet Tracker API",
-        "version": "1.0.0",
-        "docs": "/docs"
-    }
-
-@app.get("/health")
-def health():
-    return {"status": "ok", "database": "connected"}
\ No newline at end of file
+from fastapi import FastAPI
+from fastapi.responses import Response
+from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.exc import IntegrityError
+from .db import Base, engine, SessionLocal, async_engine, async_read_engines, engine_pools
+from . import models
+from .routes import router
+from .ingest import ingest_pipeline, remove_duplicate_positions, INGEST_MODE
+from .tracker import tracker_server, TRACKER_TCP_PORT, TRACKER_UDP_PORT
+from .live import live_positions, fleet_stats
+from .trips import trip_engine
+from .cache import response_cache
+from .websocket import manager
+from .segments import compaction_loop, TRACK_SEGMENT_AFTER_HOURS
+from .retention import retention_loop, RETENTION_POLICY
+from .metrics import MetricsMiddleware, METRICS_ENABLED, CONTENT_TYPE, render as render_metrics
+import asyncio
+
+app = FastAPI(
+    title="Fleet Tracker API",
+    description="Real-time vehicle tracking system",
+    version="1.0.0"
+)
+
+# CORS Configuration
+origins = [
+    "http://localhost:5173",  # Vite dev server
+    "http://localhost:3000",  # Alternative React dev
+    "http://127.0.0.1:5173",
+    # Add your GitHub Pages URL later:
+    # "https://<your-username>.github.io",
+]
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Change-Seq", "ETag"],
+)
+
+# Request latency per route for /metrics
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# Create tables on startup
+@app.on_event("startup")
+def on_startup():
+    print("Creating database tables...")
+    Base.metadata.create_all(bind=engine)
+    
+    # create_all skips existing tables, so add indexes introduced later
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError:
+                # Duplicate fixes stored before the unique index existed
+                db = SessionLocal()
+                try:
+                    removed = remove_duplicate_positions(db)
+                    db.commit()
+                finally:
+                    db.close()
+                print(f"Removed {removed} duplicate positions")
+                index.create(bind=engine, checkfirst=True)
+    print("Database ready!")
+    
+    # Rebuild the last-known-position store
+    db = SessionLocal()
+    try:
+        live_positions.load(db)
+        trip_engine.load(live_positions.snapshot())
+    finally:
+        db.close()
+
+# Start the write-behind ingest pipeline when enabled
+@app.on_event("startup")
+async def start_ingest_pipeline():
+    if INGEST_MODE == "queued":
+        await ingest_pipeline.start()
+
+# Connect WebSocket fan-out to the broker (Redis with WS_BROKER=redis)
+@app.on_event("startup")
+async def start_broker():
+    await manager.start()
+
+# Push fleet stats to WebSocket clients that sent subscribe_stats
+@app.on_event("startup")
+async def start_stats_push():
+    app.state.stats_push = asyncio.create_task(manager.stats_push_loop(fleet_stats.snapshot))
+
+# Compress old positions into track segments, when enabled
+@app.on_event("startup")
+async def start_segment_compaction():
+    if TRACK_SEGMENT_AFTER_HOURS > 0:
+        app.state.compaction = asyncio.create_task(compaction_loop())
+
+# Downsample and delete old history, when retention tiers are configured
+@app.on_event("startup")
+async def start_retention():
+    if RETENTION_POLICY:
+        app.state.retention = asyncio.create_task(retention_loop())
+
+# Raw TCP/UDP tracker listeners, when a port is configured
+@app.on_event("startup")
+async def start_tracker_listeners():
+    if TRACKER_TCP_PORT or TRACKER_UDP_PORT:
+        await tracker_server.start()
+
+# Flush queued positions before the process exits
+@app.on_event("shutdown")
+async def stop_ingest_pipeline():
+    for name in ("compaction", "retention", "stats_push"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
+    await tracker_server.stop()
+    await ingest_pipeline.stop()
+    await manager.stop()
+    await response_cache.close()
+    await async_engine.dispose()
+    for replica in async_read_engines:
+        await replica.dispose()
+
+# Include API routes
+app.include_router(router, prefix="/api", tags=["Fleet Tracking"])
+
+# Root endpoint
+@app.get("/")
+def root():
+    return {
+        "message": "Fleet Tracker API",
+        "version": "1.0.0",
+        "docs": "/docs"
+    }
+
+@app.get("/health")
+def health():
+    return {
+        "status": "ok",
+        "database": "connected",
+        "pools": engine_pools(),
+        "cache": response_cache.snapshot()
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint (this worker's metrics)"""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
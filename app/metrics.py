@@ -0,0 +1,299 @@
+"""
+In-process metrics in the Prometheus text format, served on /metrics.
+
+Counters and histograms are updated on the hot paths (one dict lookup,
+a bisect and a few additions under a lock); gauges are read from their
+owners only when /metrics is scraped. Instrumented:
+
+- HTTP: request latency per method and route template, requests by status
+- Database: statement latency per engine and statement type (SQLAlchemy
+  cursor events), errors, pool checkout wait and pool usage
+- Ingest: positions stored, duplicates skipped, write-behind queue depth,
+  queue lag (enqueue to commit), batch sizes
+- WebSocket: connections, send-queue depth, messages sent, coalesced
+  position updates and slow-client disconnects
+
+Set METRICS_ENABLED=0 to skip the HTTP and database instrumentation.
+"""
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "no")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; request latency
+HTTP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds; statements and pool checkouts are mostly sub-millisecond
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label combination"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        if not self.label_names:
+            self._values[()] = 0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Histogram:
+    """Cumulative buckets, sum and count per label combination"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = HTTP_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values: Dict[LabelValues, list] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+class Gauge:
+    """Value read at scrape time: a number, or [(label values, number)]"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read: Callable, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.read = read
+        REGISTRY.append(self)
+
+    def samples(self) -> Iterable[str]:
+        value = self.read()
+        if not self.label_names:
+            value = [((), value)]
+        for labels, number in value:
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(number)}"
+
+
+REGISTRY: List = []
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print(f"Metrics: reading {metric.name} failed: {e}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# ==================== METRICS ====================
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ("method", "route")
+)
+http_requests = Counter("http_requests_total", "HTTP responses by route template and status", ("method", "route", "status"))
+
+db_statement_duration = Histogram(
+    "db_statement_duration_seconds", "Database statement latency by engine and statement type",
+    ("engine", "statement"), DB_BUCKETS
+)
+db_errors = Counter("db_errors_total", "Failed database statements", ("engine",))
+db_pool_wait = Histogram(
+    "db_pool_checkout_wait_seconds", "Time to get a connection from the pool (including connecting)",
+    ("engine",), DB_BUCKETS
+)
+
+positions_stored = Counter("ingest_positions_stored_total", "Positions written to the database")
+ingest_queue_lag = Histogram(
+    "ingest_queue_lag_seconds", "Time from enqueue to commit in the write-behind pipeline"
+)
+ingest_batch_size = Histogram(
+    "ingest_batch_size", "Positions per write-behind commit", (),
+    (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+ingest_rejected = Counter("ingest_rejected_total", "Positions refused because the ingest queue was full")
+ingest_duplicates = Counter(
+    "ingest_duplicates_total", "Resent positions skipped, by where they were caught (memory, segment or database)", ("stage",)
+)
+
+ws_messages_sent = Counter("websocket_messages_sent_total", "Messages written to WebSocket clients")
+ws_positions_coalesced = Counter(
+    "websocket_positions_coalesced_total", "Position updates replaced by a newer one before being sent"
+)
+ws_slow_disconnects = Counter("websocket_slow_disconnects_total", "Clients disconnected for falling behind")
+
+
+# ==================== HTTP ====================
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing HTTP requests. Routes are labelled by their
+    template (/api/positions/{vehicle_id}); unmatched paths share one label.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_request_duration.observe(time.perf_counter() - started, method, template)
+            http_requests.inc(method, template, str(status[0]))
+
+
+# ==================== DATABASE ====================
+
+_STATEMENT_TYPES = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def statement_type(statement: str) -> str:
+    word = statement.lstrip()[:6].upper()
+    return word.lower() if word in _STATEMENT_TYPES else "other"
+
+
+def instrument_engine(name: str, engine):
+    """Time statements of a (sync) engine with cursor events"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is not None:
+            db_statement_duration.observe(time.perf_counter() - started, name, statement_type(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def count_error(exception_context):
+        db_errors.inc(name)
+
+
+class _TimedCheckout:
+    """Pool mixin observing how long getting a connection took"""
+
+    metrics_name = "db"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started, self.metrics_name)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def timed_pool_class(name: str, is_async: bool):
+    """A pool class labelled with the engine name (for create_engine(poolclass=...))"""
+    base = TimedAsyncQueuePool if is_async else TimedQueuePool
+    return type(base.__name__, (base,), {"metrics_name": name})
+
+
+def pool_gauges(engines: Callable[[], List[Tuple[str, object]]]):
+    """Pool usage gauges over (name, sync engine) pairs returned by engines()"""
+
+    def read(attribute):
+        def values():
+            result = []
+            for name, engine in engines():
+                pool = engine.pool
+                method = getattr(pool, attribute, None)
+                if method is not None:
+                    result.append(((name,), method()))
+            return result
+        return values
+
+    Gauge("db_pool_size", "Configured pool size", read("size"), ("engine",))
+    Gauge("db_pool_checked_out", "Connections in use", read("checkedout"), ("engine",))
+    Gauge("db_pool_overflow", "Connections above pool size (negative: unopened)", read("overflow"), ("engine",))
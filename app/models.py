@@ -1,76 +1,196 @@
-from sqlalchemy import (
-    Column,
-    Integer,
-    String,
-    Float,
-    DateTime,
-    ForeignKey,
-    Boolean
-)
-from sqlalchemy.orm import relationship
-from datetime import datetime
-from .db import Base
-
-
-class Vehicle(Base):
-    """Vehicle model - represents a tracked vehicle"""
-    __tablename__ = "vehicles"
-
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, index=True, nullable=False)
-    plate_no = Column(String, unique=True, index=True, nullable=True)
-
-    # Relationships
-    positions = relationship(
-        "Position",
-        back_populates="vehicle",
-        cascade="all, delete-orphan"
-    )
-    devices = relationship(
-        "Device",
-        back_populates="vehicle"
-    )
-
-    def __repr__(self):
-        return f"<Vehicle(id={self.id}, name={self.name}, plate={self.plate_no})>"
-
-
-class Device(Base):
-    """GPS Device model - track device information"""
-    __tablename__ = "devices"
-
-    id = Column(Integer, primary_key=True, index=True)
-    device_id = Column(String, unique=True, index=True, nullable=False)  # IMEI or unique ID
-    device_type = Column(String, nullable=True)  # GPS Tracker, Mobile App
-    firmware_version = Column(String, nullable=True)
-
-    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=True)
-
-    last_seen = Column(DateTime, default=datetime.utcnow)
-    is_active = Column(Boolean, default=True)
-
-    # Relationship
-    vehicle = relationship("Vehicle", back_populates="devices")
-
-    def __repr__(self):
-        return f"<Device(device_id={self.device_id}, active={self.is_active})>"
-
-
-class Position(Base):
-    """Position model - GPS location of a vehicle at a point in time"""
-    __tablename__ = "positions"
-
-    id = Column(Integer, primary_key=True, index=True)
-    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False, index=True)
-
-    lat = Column(Float, nullable=False)
-    lng = Column(Float, nullable=False)
-    speed = Column(Float, default=0.0)
-
-    recorded_at = Column(DateTime, default=datetime.utcnow, index=True)
-
-    # Relationship
-    vehicle = relationship("Vehicle", back_populates="positions")
-
-    def __repr__(self):
-        return f"<Position(vehicle_id={self.vehicle_id}, lat={self.lat}, lng={self.lng})>"
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Float,
+    DateTime,
+    ForeignKey,
+    Boolean,
+    Index,
+    LargeBinary
+)
+from sqlalchemy.orm import relationship
+from datetime import datetime
+from .db import Base
+
+
+class Vehicle(Base):
+    """Vehicle model - represents a tracked vehicle"""
+    __tablename__ = "vehicles"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, index=True, nullable=False)
+    plate_no = Column(String, unique=True, index=True, nullable=True)
+
+    # Relationships
+    positions = relationship(
+        "Position",
+        back_populates="vehicle",
+        cascade="all, delete-orphan"
+    )
+    devices = relationship(
+        "Device",
+        back_populates="vehicle"
+    )
+    trips = relationship(
+        "Trip",
+        back_populates="vehicle",
+        cascade="all, delete-orphan"
+    )
+    track_segments = relationship(
+        "TrackSegment",
+        back_populates="vehicle",
+        cascade="all, delete-orphan"
+    )
+
+    def __repr__(self):
+        return f"<Vehicle(id={self.id}, name={self.name}, plate={self.plate_no})>"
+
+
+class Device(Base):
+    """GPS Device model - track device information"""
+    __tablename__ = "devices"
+
+    id = Column(Integer, primary_key=True, index=True)
+    device_id = Column(String, unique=True, index=True, nullable=False)  # IMEI or unique ID
+    device_type = Column(String, nullable=True)  # GPS Tracker, Mobile App
+    firmware_version = Column(String, nullable=True)
+
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=True)
+
+    last_seen = Column(DateTime, default=datetime.utcnow)
+    is_active = Column(Boolean, default=True)
+
+    # Relationship
+    vehicle = relationship("Vehicle", back_populates="devices")
+
+    def __repr__(self):
+        return f"<Device(device_id={self.device_id}, active={self.is_active})>"
+
+
+class Position(Base):
+    """Position model - GPS location of a vehicle at a point in time"""
+    __tablename__ = "positions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False, index=True)
+
+    lat = Column(Float, nullable=False)
+    lng = Column(Float, nullable=False)
+    speed = Column(Float, default=0.0)
+
+    recorded_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    # Relationship
+    vehicle = relationship("Vehicle", back_populates="positions")
+
+    __table_args__ = (
+        # Per-vehicle history in time order (keyset pagination, time windows)
+        Index("ix_positions_vehicle_recorded_at", "vehicle_id", "recorded_at", "id"),
+        # One row per fix; resent copies are skipped (ON CONFLICT DO NOTHING)
+        Index("uq_positions_fix", "vehicle_id", "recorded_at", "lat", "lng", unique=True),
+    )
+
+    def __repr__(self):
+        return f"<Position(vehicle_id={self.vehicle_id}, lat={self.lat}, lng={self.lng})>"
+
+
+class TrackSegment(Base):
+    """Compressed positions of one vehicle for a closed time window (see segments.py)"""
+    __tablename__ = "track_segments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False)
+
+    start_at = Column(DateTime, nullable=False)
+    end_at = Column(DateTime, nullable=False)
+    point_count = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False, default=1)
+    data = Column(LargeBinary, nullable=False)
+
+    # Relationship
+    vehicle = relationship("Vehicle", back_populates="track_segments")
+
+    __table_args__ = (
+        Index("ix_track_segments_vehicle_end_at", "vehicle_id", "end_at"),
+        Index("ix_track_segments_vehicle_start_at", "vehicle_id", "start_at"),
+    )
+
+    def __repr__(self):
+        return f"<TrackSegment(vehicle_id={self.vehicle_id}, start={self.start_at}, points={self.point_count})>"
+
+
+class RetentionMark(Base):
+    """How far a retention tier has been applied (see retention.py)"""
+    __tablename__ = "retention_marks"
+
+    name = Column(String, primary_key=True)
+    done_before = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<RetentionMark(name={self.name}, done_before={self.done_before})>"
+
+
+class Trip(Base):
+    """Trip model - a finished stretch of movement between two stops"""
+    __tablename__ = "trips"
+
+    id = Column(Integer, primary_key=True, index=True)
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False)
+
+    start_at = Column(DateTime, nullable=False)
+    end_at = Column(DateTime, nullable=False)
+    start_lat = Column(Float, nullable=False)
+    start_lng = Column(Float, nullable=False)
+    end_lat = Column(Float, nullable=False)
+    end_lng = Column(Float, nullable=False)
+
+    distance_km = Column(Float, default=0.0)
+    max_speed = Column(Float, default=0.0)
+    point_count = Column(Integer, default=0)
+
+    # Relationship
+    vehicle = relationship("Vehicle", back_populates="trips")
+
+    __table_args__ = (
+        Index("ix_trips_vehicle_start_at", "vehicle_id", "start_at"),
+    )
+
+    def __repr__(self):
+        return f"<Trip(vehicle_id={self.vehicle_id}, start={self.start_at}, km={self.distance_km:.2f})>"
+
+
+class VehicleHourlyRollup(Base):
+    """Per-vehicle aggregates for one UTC hour, maintained on ingest"""
+    __tablename__ = "vehicle_rollups_hourly"
+
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+
+    point_count = Column(Integer, nullable=False, default=0)
+    distance_km = Column(Float, nullable=False, default=0.0)
+    max_speed = Column(Float, nullable=False, default=0.0)
+    speed_sum = Column(Float, nullable=False, default=0.0)
+    moving_seconds = Column(Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        Index("ix_vehicle_rollups_hourly_bucket", "bucket_start"),
+    )
+
+
+class VehicleDailyRollup(Base):
+    """Per-vehicle aggregates for one UTC day, maintained on ingest"""
+    __tablename__ = "vehicle_rollups_daily"
+
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id"), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+
+    point_count = Column(Integer, nullable=False, default=0)
+    distance_km = Column(Float, nullable=False, default=0.0)
+    max_speed = Column(Float, nullable=False, default=0.0)
+    speed_sum = Column(Float, nullable=False, default=0.0)
+    moving_seconds = Column(Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        Index("ix_vehicle_rollups_daily_bucket", "bucket_start"),
+    )
@@ -0,0 +1,30 @@
+"""
+Opaque keyset cursors for position history.
+
+A cursor encodes the (recorded_at, id) of the last row of a page, so the
+next page is a range scan on the (vehicle_id, recorded_at, id) index
+instead of an OFFSET that re-reads every skipped row.
+"""
+from datetime import datetime
+from typing import Tuple
+import base64
+import json
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor cannot be decoded"""
+    pass
+
+
+def encode_cursor(recorded_at: datetime, position_id: int) -> str:
+    raw = json.dumps([recorded_at.isoformat(), position_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        recorded_at, position_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(recorded_at), int(position_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
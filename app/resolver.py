@@ -0,0 +1,305 @@
+"""
+Cached device_id -> vehicle_id resolution for the ingest path.
+
+Devices are matched against Vehicle.plate_no first and Vehicle.name second,
+each with its own query so both unique indexes are used.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from . import models
+from .cache import response_cache
+from .live import fleet_changes, fleet_stats
+import asyncio
+import os
+import threading
+import time
+
+DEVICE_CACHE_SIZE = int(os.getenv("DEVICE_CACHE_SIZE", 10000))
+
+# Whether devices that match no vehicle get one auto-created on first
+# contact; when off, their fixes are rejected
+DEVICE_AUTO_CREATE = os.getenv("DEVICE_AUTO_CREATE", "1").lower() in ("1", "true", "yes")
+
+# Seconds an unknown device_id is remembered as "no such vehicle"
+DEVICE_NEGATIVE_TTL = float(os.getenv("DEVICE_NEGATIVE_TTL", 30))
+
+# Auto-create is serialized per device through a fixed set of striped locks
+_CREATE_LOCK_STRIPES = 64
+
+# Device ids per bulk lookup query (keeps bound parameters under DB limits)
+_BULK_LOOKUP_CHUNK = 500
+
+
+class DeviceResolver:
+    """Bounded LRU of device_id -> vehicle_id plus a short negative cache"""
+
+    def __init__(
+        self,
+        max_size: int = DEVICE_CACHE_SIZE,
+        negative_ttl: float = DEVICE_NEGATIVE_TTL,
+        auto_create: bool = DEVICE_AUTO_CREATE
+    ):
+        self.max_size = max_size
+        self.auto_create = auto_create
+        self.negative_ttl = negative_ttl
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._negative: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._create_locks = [threading.Lock() for _ in range(_CREATE_LOCK_STRIPES)]
+        self._async_create_locks: Optional[list] = None
+
+    # ---------- cache primitives ----------
+
+    def get(self, device_id: str) -> Optional[int]:
+        """Cached vehicle id for device_id, or None"""
+        with self._lock:
+            vehicle_id = self._cache.get(device_id)
+            if vehicle_id is not None:
+                self._cache.move_to_end(device_id)
+            return vehicle_id
+
+    def put(self, device_id: str, vehicle_id: int):
+        with self._lock:
+            self._negative.pop(device_id, None)
+            self._cache[device_id] = vehicle_id
+            self._cache.move_to_end(device_id)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def is_known_missing(self, device_id: str) -> bool:
+        with self._lock:
+            expires = self._negative.get(device_id)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._negative[device_id]
+                return False
+            return True
+
+    def mark_missing(self, device_id: str):
+        with self._lock:
+            # Keep the negative cache bounded too
+            if len(self._negative) >= self.max_size:
+                now = time.monotonic()
+                self._negative = {k: v for k, v in self._negative.items() if v >= now}
+                if len(self._negative) >= self.max_size:
+                    self._negative.clear()
+            self._negative[device_id] = time.monotonic() + self.negative_ttl
+
+    def invalidate(self, *device_ids: Optional[str]):
+        """Forget positive and negative entries for the given keys"""
+        with self._lock:
+            for device_id in device_ids:
+                if device_id:
+                    self._cache.pop(device_id, None)
+                    self._negative.pop(device_id, None)
+
+    def invalidate_vehicle(self, vehicle_id: int):
+        """Forget every device mapped to vehicle_id"""
+        with self._lock:
+            stale = [k for k, v in self._cache.items() if v == vehicle_id]
+            for device_id in stale:
+                del self._cache[device_id]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._negative.clear()
+
+    # ---------- resolution ----------
+
+    def _lookup(self, db: Session, device_id: str) -> Optional[int]:
+        """Find the vehicle by plate_no, then by name (one indexed query each)"""
+        vehicle_id = db.query(models.Vehicle.id).filter(
+            models.Vehicle.plate_no == device_id
+        ).scalar()
+        if vehicle_id is None:
+            vehicle_id = db.query(models.Vehicle.id).filter(
+                models.Vehicle.name == device_id
+            ).scalar()
+        return vehicle_id
+
+    def _find(self, db: Session, device_id: str) -> Optional[int]:
+        """Cache, then the database unless the device is known missing"""
+        vehicle_id = self.get(device_id)
+        if vehicle_id is None and not self.is_known_missing(device_id):
+            vehicle_id = self._lookup(db, device_id)
+            if vehicle_id is not None:
+                self.put(device_id, vehicle_id)
+        return vehicle_id
+
+    def _creates(self, create: Optional[bool]) -> bool:
+        return self.auto_create if create is None else create
+
+    def resolve(self, db: Session, device_id: str, create: Optional[bool] = None) -> Optional[int]:
+        """
+        Return the vehicle id for device_id.
+        If create (default: DEVICE_AUTO_CREATE) an unknown device gets a
+        vehicle auto-created (committed on db); otherwise None is returned
+        and remembered briefly.
+        """
+        vehicle_id = self._find(db, device_id)
+        if vehicle_id is not None:
+            return vehicle_id
+        if not self._creates(create):
+            self.mark_missing(device_id)
+            return None
+
+        with self._create_locks[hash(device_id) % _CREATE_LOCK_STRIPES]:
+            return self._create(db, device_id)
+
+    def _create(self, db: Session, device_id: str) -> int:
+        """
+        Auto-create a vehicle for device_id. Callers serialize this per
+        device where they can; losing a race to another worker/process is
+        handled here either way.
+        """
+        # Another request may have created it while we waited
+        vehicle_id = self.get(device_id) or self._lookup(db, device_id)
+        if vehicle_id is not None:
+            self.put(device_id, vehicle_id)
+            return vehicle_id
+
+        vehicle = models.Vehicle(
+            name=f"Device-{device_id}",
+            plate_no=device_id
+        )
+        db.add(vehicle)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Lost the race against another worker/process
+            db.rollback()
+            vehicle_id = self._lookup(db, device_id)
+            if vehicle_id is None:
+                raise
+        else:
+            vehicle_id = vehicle.id
+            self._announce_created([vehicle_id])
+            print(f"Auto-created vehicle for device {device_id}")
+
+        self.put(device_id, vehicle_id)
+        return vehicle_id
+
+    def _announce_created(self, vehicle_ids: List[int]):
+        response_cache.invalidate_soon("vehicles")
+        for vehicle_id in vehicle_ids:
+            fleet_changes.touch(vehicle_id)
+            fleet_stats.vehicle_added(vehicle_id)
+
+    # ---------- bulk resolution ----------
+
+    def _match_many(self, found: Dict[str, int], rows, wanted: set):
+        """Map (id, plate_no, name) rows to device ids; plate_no wins over name"""
+        by_name = {}
+        for vehicle_id, plate_no, name in rows:
+            if plate_no in wanted:
+                found[plate_no] = vehicle_id
+            if name in wanted:
+                by_name[name] = vehicle_id
+        for name, vehicle_id in by_name.items():
+            found.setdefault(name, vehicle_id)
+
+    def _bulk_lookup(self, db: Session, found: Dict[str, int], missing: List[str]):
+        """One OR-of-IN query per chunk (a single query for typical batches)"""
+        wanted = set(missing)
+        for i in range(0, len(missing), _BULK_LOOKUP_CHUNK):
+            chunk = missing[i:i + _BULK_LOOKUP_CHUNK]
+            query = select(models.Vehicle.id, models.Vehicle.plate_no, models.Vehicle.name).where(
+                or_(models.Vehicle.plate_no.in_(chunk), models.Vehicle.name.in_(chunk))
+            )
+            self._match_many(found, db.execute(query).all(), wanted)
+
+    def _split_cached(self, device_ids: Iterable[str], create: bool) -> Tuple[Dict[str, int], List[str]]:
+        """(cached matches, device ids that need a lookup)"""
+        found: Dict[str, int] = {}
+        missing = []
+        for device_id in set(device_ids):
+            vehicle_id = self.get(device_id)
+            if vehicle_id is not None:
+                found[device_id] = vehicle_id
+            elif create or not self.is_known_missing(device_id):
+                missing.append(device_id)
+        return found, missing
+
+    def resolve_many(self, db: Session, device_ids: Iterable[str], create: Optional[bool] = None) -> Dict[str, int]:
+        """
+        Resolve many device ids with one query for all cache misses.
+        If create (default: DEVICE_AUTO_CREATE) unknown devices get vehicles
+        (one commit for all); otherwise they are left out of the result.
+        """
+        create = self._creates(create)
+        found, missing = self._split_cached(device_ids, create)
+        if missing:
+            self._bulk_lookup(db, found, missing)
+
+        unknown = []
+        for device_id in missing:
+            if device_id in found:
+                self.put(device_id, found[device_id])
+            else:
+                unknown.append(device_id)
+        if not unknown:
+            return found
+        if not create:
+            for device_id in unknown:
+                self.mark_missing(device_id)
+            return found
+
+        db.add_all([
+            models.Vehicle(name=f"Device-{device_id}", plate_no=device_id)
+            for device_id in unknown
+        ])
+        try:
+            db.commit()
+        except IntegrityError:
+            # Someone else created some of them; fall back to one at a time
+            db.rollback()
+            for device_id in unknown:
+                found[device_id] = self._create(db, device_id)
+            return found
+
+        self._bulk_lookup(db, found, unknown)
+        for device_id in unknown:
+            self.put(device_id, found[device_id])
+        self._announce_created([found[device_id] for device_id in unknown])
+        print(f"Auto-created {len(unknown)} vehicles for new devices")
+        return found
+
+    # ---------- async resolution ----------
+    #
+    # The async variants run the sync code on the AsyncSession's connection
+    # (run_sync) and only swap the per-device lock: a threading lock held
+    # across a query would block the event loop for every other request.
+
+    async def aresolve(self, db: AsyncSession, device_id: str, create: Optional[bool] = None) -> Optional[int]:
+        """Async variant of resolve() for AsyncSession callers"""
+        vehicle_id = self.get(device_id)
+        if vehicle_id is None:
+            vehicle_id = await db.run_sync(self._find, device_id)
+        if vehicle_id is not None:
+            return vehicle_id
+        if not self._creates(create):
+            self.mark_missing(device_id)
+            return None
+
+        # Created lazily so the locks belong to the running event loop
+        if self._async_create_locks is None:
+            self._async_create_locks = [asyncio.Lock() for _ in range(_CREATE_LOCK_STRIPES)]
+        async with self._async_create_locks[hash(device_id) % _CREATE_LOCK_STRIPES]:
+            return await db.run_sync(self._create, device_id)
+
+    async def aresolve_many(self, db: AsyncSession, device_ids: Iterable[str], create: Optional[bool] = None) -> Dict[str, int]:
+        """Async variant of resolve_many() for AsyncSession callers"""
+        create = self._creates(create)
+        found, missing = self._split_cached(device_ids, create)
+        if missing:
+            found.update(await db.run_sync(self.resolve_many, missing, create))
+        return found
+
+
+device_resolver = DeviceResolver()
@@ -0,0 +1,361 @@
+"""
+Retention tiers for position history.
+
+RETENTION_TIERS lists age limits in increasing order, each with the
+resolution kept up to that age, e.g.
+
+    RETENTION_TIERS="30d:full,365d:1m"
+
+keeps every fix for 30 days, one fix per vehicle per minute up to a year,
+and deletes anything older. End with a "forever" tier to never delete
+("30d:full,365d:1m,forever:1h"). Ages and resolutions take s, m, h, d or w.
+
+Downsampling keeps the first fix of each resolution bucket, so running it
+again changes nothing. Raw positions and compressed track segments are
+both covered. Work is done per vehicle in batches of RETENTION_BATCH_SIZE
+rows, one short transaction each. A mark per tier records how far it has
+been applied, so later runs only scan data that has aged into a tier since
+(pass --full to rescan, e.g. after importing old history).
+
+Rollups and trips are kept, so analytics still cover deleted history.
+
+Run `python -m app.retention run` by hand; with RETENTION_TIERS set the app
+also runs it every RETENTION_INTERVAL_SECONDS.
+"""
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import and_, delete, or_
+from sqlalchemy.orm import Session
+from . import models
+from .segments import encode_segment, segment_rows, TrackRow
+import argparse
+import asyncio
+import os
+import time
+
+# Comma-separated "max_age:resolution" tiers (empty = keep everything)
+RETENTION_TIERS = os.getenv("RETENTION_TIERS", "")
+
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", 3600))
+
+# Rows read (and at most deleted) per transaction
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 5000))
+
+# (max age, or None for forever; resolution in seconds, 0 = every fix)
+Tier = Tuple[Optional[timedelta], int]
+
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+_EPOCH = datetime(1970, 1, 1)
+
+# Delete by id in chunks (SQLite limits bound parameters per statement)
+_DELETE_CHUNK = 500
+
+
+def parse_duration(text: str) -> int:
+    """'90s', '1m', '12h', '30d', '2w' -> seconds"""
+    text = text.strip().lower()
+    if len(text) < 2 or text[-1] not in _UNITS or not text[:-1].isdigit():
+        raise ValueError(f"Bad duration '{text}' (expected e.g. 30d, 12h, 1m)")
+    return int(text[:-1]) * _UNITS[text[-1]]
+
+
+def parse_tiers(spec: str) -> List[Tier]:
+    """Parse RETENTION_TIERS; ages must increase and only the last may be forever"""
+    tiers: List[Tier] = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        age, sep, resolution = part.partition(":")
+        if not sep:
+            raise ValueError(f"Bad retention tier '{part}' (expected age:resolution)")
+        if tiers and tiers[-1][0] is None:
+            raise ValueError("Only the last retention tier can be 'forever'")
+        max_age = None if age.strip().lower() == "forever" else timedelta(seconds=parse_duration(age))
+        if tiers and max_age is not None and max_age <= tiers[-1][0]:
+            raise ValueError(f"Retention tier ages must increase ('{part}')")
+        seconds = 0 if resolution.strip().lower() == "full" else parse_duration(resolution)
+        tiers.append((max_age, seconds))
+    return tiers
+
+
+RETENTION_POLICY = parse_tiers(RETENTION_TIERS)
+
+
+def _bucket(recorded_at: datetime, resolution: int) -> int:
+    return int((recorded_at - _EPOCH).total_seconds()) // resolution
+
+
+def _bucket_start(value: datetime, resolution: int) -> datetime:
+    return _EPOCH + timedelta(seconds=_bucket(value, resolution) * resolution)
+
+
+def _empty_stats() -> dict:
+    return {
+        "downsampled": 0,
+        "expired": 0,
+        "segments_rewritten": 0,
+        "segments_deleted": 0,
+        "vehicles": set(),
+        "seconds": 0.0
+    }
+
+
+def _delete_positions(db: Session, ids: List[int]):
+    for i in range(0, len(ids), _DELETE_CHUNK):
+        db.execute(delete(models.Position).where(models.Position.id.in_(ids[i:i + _DELETE_CHUNK])))
+
+
+def _rewrite_segment(db: Session, segment: models.TrackSegment, rows: List[TrackRow]):
+    """Replace a segment's points with rows (ordered), or drop it when none are left"""
+    if not rows:
+        db.delete(segment)
+        return
+    segment.data = encode_segment(rows)
+    segment.point_count = len(rows)
+    segment.start_at = rows[0][5]
+    segment.end_at = rows[-1][5]
+
+
+# ==================== DELETION ====================
+
+def expire_before(db: Session, cutoff: datetime, stats: dict, batch_size: int = RETENTION_BATCH_SIZE):
+    """Delete positions and segment points recorded before cutoff"""
+    while True:
+        rows = (
+            db.query(models.Position.id, models.Position.vehicle_id)
+            .filter(models.Position.recorded_at < cutoff)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        _delete_positions(db, [row.id for row in rows])
+        db.commit()
+        stats["expired"] += len(rows)
+        stats["vehicles"].update(row.vehicle_id for row in rows)
+        if len(rows) < batch_size:
+            break
+
+    while True:
+        segments = (
+            db.query(models.TrackSegment.id, models.TrackSegment.vehicle_id, models.TrackSegment.point_count)
+            .filter(models.TrackSegment.end_at < cutoff)
+            .limit(batch_size)
+            .all()
+        )
+        if not segments:
+            break
+        ids = [segment.id for segment in segments]
+        for i in range(0, len(ids), _DELETE_CHUNK):
+            db.execute(delete(models.TrackSegment).where(models.TrackSegment.id.in_(ids[i:i + _DELETE_CHUNK])))
+        db.commit()
+        stats["expired"] += sum(segment.point_count for segment in segments)
+        stats["segments_deleted"] += len(segments)
+        stats["vehicles"].update(segment.vehicle_id for segment in segments)
+
+    # Segments straddling the cutoff keep their newer points
+    straddling = [
+        segment_id for (segment_id,) in
+        db.query(models.TrackSegment.id)
+        .filter(models.TrackSegment.start_at < cutoff, models.TrackSegment.end_at >= cutoff)
+    ]
+    db.commit()
+    for segment_id in straddling:
+        segment = db.get(models.TrackSegment, segment_id)
+        rows = segment_rows(segment)
+        kept = [row for row in rows if row[5] >= cutoff]
+        stats["expired"] += len(rows) - len(kept)
+        stats["segments_rewritten"] += 1
+        stats["vehicles"].add(segment.vehicle_id)
+        _rewrite_segment(db, segment, kept)
+        db.commit()
+
+
+# ==================== DOWNSAMPLING ====================
+
+def downsample_positions(
+    db: Session,
+    vehicle_id: int,
+    resolution: int,
+    from_time: Optional[datetime],
+    to_time: datetime,
+    stats: dict,
+    batch_size: int = RETENTION_BATCH_SIZE
+):
+    """Keep the first raw position per resolution bucket in [from_time, to_time)"""
+    position = models.Position
+    query = db.query(position.id, position.recorded_at).filter(
+        position.vehicle_id == vehicle_id, position.recorded_at < to_time
+    )
+    if from_time is not None:
+        query = query.filter(position.recorded_at >= from_time)
+    query = query.order_by(position.recorded_at, position.id)
+
+    last_bucket = None
+    after = None
+    while True:
+        page = query
+        if after is not None:
+            page = page.filter(or_(
+                position.recorded_at > after[0],
+                and_(position.recorded_at == after[0], position.id > after[1])
+            ))
+        rows = page.limit(batch_size).all()
+        if not rows:
+            break
+        dropped = []
+        for row_id, recorded_at in rows:
+            bucket = _bucket(recorded_at, resolution)
+            if bucket == last_bucket:
+                dropped.append(row_id)
+            last_bucket = bucket
+        after = (rows[-1][1], rows[-1][0])
+        if dropped:
+            _delete_positions(db, dropped)
+            stats["downsampled"] += len(dropped)
+            stats["vehicles"].add(vehicle_id)
+        # Ends the read transaction too, so no lock outlives a batch
+        db.commit()
+        if len(rows) < batch_size:
+            break
+
+
+def downsample_segments(
+    db: Session,
+    vehicle_id: int,
+    resolution: int,
+    from_time: Optional[datetime],
+    to_time: datetime,
+    stats: dict
+):
+    """Keep the first segment point per resolution bucket in [from_time, to_time)"""
+    query = db.query(models.TrackSegment.id).filter(
+        models.TrackSegment.vehicle_id == vehicle_id,
+        models.TrackSegment.start_at < to_time
+    )
+    if from_time is not None:
+        query = query.filter(models.TrackSegment.end_at >= from_time)
+    segment_ids = [segment_id for (segment_id,) in query.order_by(models.TrackSegment.start_at)]
+    db.commit()
+
+    for segment_id in segment_ids:
+        segment = db.get(models.TrackSegment, segment_id)
+        rows = segment_rows(segment)
+        kept = []
+        last_bucket = None
+        for row in rows:
+            if (from_time is None or row[5] >= from_time) and row[5] < to_time:
+                bucket = _bucket(row[5], resolution)
+                if bucket == last_bucket:
+                    continue
+                last_bucket = bucket
+            kept.append(row)
+        if len(kept) < len(rows):
+            _rewrite_segment(db, segment, kept)
+            stats["downsampled"] += len(rows) - len(kept)
+            stats["segments_rewritten"] += 1
+            stats["vehicles"].add(vehicle_id)
+        db.commit()
+
+
+# ==================== RUNNING ====================
+
+def _mark_name(resolution: int) -> str:
+    return f"downsample:{resolution}s"
+
+
+def apply_retention(
+    db: Session,
+    tiers: List[Tier],
+    now: Optional[datetime] = None,
+    full: bool = False,
+    batch_size: int = RETENTION_BATCH_SIZE
+) -> dict:
+    """
+    Apply tiers to all vehicles: delete what is older than the last tier,
+    then downsample each tier's age range. Returns counts of removed points
+    (downsampled / expired), touched segments and vehicles, and seconds taken.
+    """
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+    stats = _empty_stats()
+
+    horizon = tiers[-1][0] if tiers else None
+    if horizon is not None:
+        expire_before(db, now - horizon, stats, batch_size)
+
+    vehicle_ids = [vid for (vid,) in db.query(models.Vehicle.id).order_by(models.Vehicle.id)]
+    db.commit()
+    previous_age = timedelta(0)
+    for max_age, resolution in tiers:
+        if resolution:
+            # Whole buckets only, so the next run starts on a bucket boundary
+            to_time = _bucket_start(now - previous_age, resolution)
+            from_time = None if max_age is None else now - max_age
+            mark = None if full else db.get(models.RetentionMark, _mark_name(resolution))
+            # Everything before the mark was already downsampled at this resolution
+            if mark is not None and (from_time is None or mark.done_before > from_time):
+                from_time = mark.done_before
+            if from_time is None or from_time < to_time:
+                for vehicle_id in vehicle_ids:
+                    downsample_positions(db, vehicle_id, resolution, from_time, to_time, stats, batch_size)
+                    downsample_segments(db, vehicle_id, resolution, from_time, to_time, stats)
+                db.merge(models.RetentionMark(name=_mark_name(resolution), done_before=to_time))
+                db.commit()
+        previous_age = max_age
+
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+
+def run_retention(now: Optional[datetime] = None, full: bool = False, tiers: Optional[List[Tier]] = None) -> dict:
+    """One retention pass in its own session (for the app's periodic task)"""
+    from .cache import response_cache, positions_tag
+    from .db import SessionLocal
+
+    db = SessionLocal()
+    try:
+        stats = apply_retention(db, RETENTION_POLICY if tiers is None else tiers, now, full)
+    finally:
+        db.close()
+    if stats["vehicles"]:
+        response_cache.invalidate_soon(*(positions_tag(vid) for vid in stats["vehicles"]))
+    return stats
+
+
+def describe(stats: dict) -> str:
+    removed = stats["downsampled"] + stats["expired"]
+    return (
+        f"removed {removed} positions ({stats['downsampled']} downsampled, {stats['expired']} expired) "
+        f"of {len(stats['vehicles'])} vehicles, rewrote {stats['segments_rewritten']} and deleted "
+        f"{stats['segments_deleted']} segments in {stats['seconds']:.1f}s"
+    )
+
+
+async def retention_loop():
+    """Apply RETENTION_TIERS every RETENTION_INTERVAL_SECONDS (started by the app)"""
+    while True:
+        try:
+            stats = await asyncio.to_thread(run_retention)
+            print(f"Retention: {describe(stats)}")
+        except Exception as e:
+            print(f"Retention: pass failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+
+def main():
+    from .db import engine as db_engine
+
+    parser = argparse.ArgumentParser(description="Downsample and delete old positions")
+    parser.add_argument("command", choices=["run"])
+    parser.add_argument("--tiers", default=RETENTION_TIERS, help="Override RETENTION_TIERS, e.g. 30d:full,365d:1m")
+    parser.add_argument("--full", action="store_true", help="Ignore tier marks and rescan all history")
+    args = parser.parse_args()
+
+    tiers = parse_tiers(args.tiers)
+    if not tiers:
+        parser.error("no retention tiers (set RETENTION_TIERS or pass --tiers)")
+    models.Base.metadata.create_all(bind=db_engine)
+    print(f"Retention: {describe(run_retention(full=args.full, tiers=tiers))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Materialized hourly/daily per-vehicle rollups.
+
+Maintained incrementally from the ingest path (one upsert per touched
+bucket per batch) so Analytics range queries never scan positions.
+Run `python -m app.rollups backfill` once to build them for existing data
+(add --trips to rebuild the vehicles' trips from the same pass).
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import case, delete, insert
+from sqlalchemy.orm import Session
+from . import models
+from .segments import iter_segment_points, merge_tracks
+from .trips import TripEngine
+import argparse
+import time
+
+ROLLUP_MODELS = (models.VehicleHourlyRollup, models.VehicleDailyRollup)
+
+
+def hour_bucket(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+_BUCKETS = {
+    models.VehicleHourlyRollup: hour_bucket,
+    models.VehicleDailyRollup: day_bucket,
+}
+
+
+def fold_step(buckets: Dict[Tuple[int, datetime], dict], step: dict, bucket_fn):
+    """Add one step to {(vehicle_id, bucket_start): aggregates}"""
+    key = (step["vehicle_id"], bucket_fn(step["recorded_at"]))
+    agg = buckets.get(key)
+    if agg is None:
+        agg = buckets[key] = {
+            "vehicle_id": key[0],
+            "bucket_start": key[1],
+            "point_count": 0,
+            "distance_km": 0.0,
+            "max_speed": 0.0,
+            "speed_sum": 0.0,
+            "moving_seconds": 0.0
+        }
+    speed = step["speed"]
+    agg["point_count"] += 1
+    agg["distance_km"] += step["distance_km"]
+    agg["speed_sum"] += speed
+    agg["moving_seconds"] += step["moving_seconds"]
+    if speed > agg["max_speed"]:
+        agg["max_speed"] = speed
+
+
+def aggregate_steps(steps: Iterable[dict], bucket_fn) -> Dict[Tuple[int, datetime], dict]:
+    """Fold per-row steps into {(vehicle_id, bucket_start): aggregates}"""
+    buckets: Dict[Tuple[int, datetime], dict] = {}
+    for step in steps:
+        fold_step(buckets, step, bucket_fn)
+    return buckets
+
+
+def _dialect_insert(db: Session):
+    name = db.get_bind().dialect.name
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        return dialect_insert
+    if name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        return dialect_insert
+    return None
+
+
+def upsert_rollups(db: Session, model, rows: List[dict]):
+    """Add aggregates onto existing bucket rows (or create them)"""
+    if not rows:
+        return
+    dialect_insert = _dialect_insert(db)
+    table = model.__table__
+
+    if dialect_insert is None:
+        # Portable fallback: read-modify-write per bucket
+        for row in rows:
+            existing = db.get(model, (row["vehicle_id"], row["bucket_start"]))
+            if existing is None:
+                db.add(model(**row))
+                continue
+            existing.point_count += row["point_count"]
+            existing.distance_km += row["distance_km"]
+            existing.speed_sum += row["speed_sum"]
+            existing.moving_seconds += row["moving_seconds"]
+            existing.max_speed = max(existing.max_speed, row["max_speed"])
+        return
+
+    stmt = dialect_insert(table)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.vehicle_id, table.c.bucket_start],
+        set_={
+            "point_count": table.c.point_count + excluded.point_count,
+            "distance_km": table.c.distance_km + excluded.distance_km,
+            "speed_sum": table.c.speed_sum + excluded.speed_sum,
+            "moving_seconds": table.c.moving_seconds + excluded.moving_seconds,
+            "max_speed": case(
+                (excluded.max_speed > table.c.max_speed, excluded.max_speed),
+                else_=table.c.max_speed
+            ),
+        }
+    )
+    db.execute(stmt, rows)
+
+
+def record_rollups(db: Session, steps: List[dict]):
+    """
+    Fold a batch of ingest steps into the hourly and daily rollups.
+    Steps come from the trip engine, whose state is undone if db's
+    transaction does not commit (record_trips), so a retried batch gets
+    its distance and moving time again rather than zero-length steps.
+    """
+    if not steps:
+        return
+    for model, bucket_fn in _BUCKETS.items():
+        upsert_rollups(db, model, list(aggregate_steps(steps, bucket_fn).values()))
+
+
+def delete_vehicle_rollups(db: Session, vehicle_id: int):
+    for model in ROLLUP_MODELS:
+        db.execute(delete(model).where(model.vehicle_id == vehicle_id))
+
+
+# ==================== QUERIES ====================
+
+def pick_model(from_time: datetime, to_time: datetime):
+    """Hourly buckets for short ranges, daily buckets otherwise"""
+    if to_time - from_time <= timedelta(days=2):
+        return models.VehicleHourlyRollup
+    return models.VehicleDailyRollup
+
+
+def summarize(rows: Iterable) -> dict:
+    """Combine rollup rows into one summary"""
+    point_count = 0
+    distance_km = 0.0
+    speed_sum = 0.0
+    moving_seconds = 0.0
+    max_speed = 0.0
+    for row in rows:
+        point_count += row.point_count
+        distance_km += row.distance_km
+        speed_sum += row.speed_sum
+        moving_seconds += row.moving_seconds
+        max_speed = max(max_speed, row.max_speed)
+    return {
+        "point_count": point_count,
+        "distance_km": round(distance_km, 3),
+        "max_speed": max_speed,
+        "avg_speed": round(speed_sum / point_count, 2) if point_count else 0.0,
+        "moving_hours": round(moving_seconds / 3600, 3)
+    }
+
+
+def query_rollups(
+    db: Session,
+    from_time: datetime,
+    to_time: datetime,
+    vehicle_id: Optional[int] = None
+) -> dict:
+    """Fleet-wide (or single vehicle) analytics for a time range"""
+    model = pick_model(from_time, to_time)
+    bucket_fn = _BUCKETS[model]
+
+    query = db.query(model).filter(
+        model.bucket_start >= bucket_fn(from_time),
+        model.bucket_start <= to_time
+    )
+    if vehicle_id is not None:
+        query = query.filter(model.vehicle_id == vehicle_id)
+    rows = query.all()
+
+    by_vehicle = defaultdict(list)
+    by_bucket = defaultdict(list)
+    for row in rows:
+        by_vehicle[row.vehicle_id].append(row)
+        by_bucket[row.bucket_start].append(row)
+
+    return {
+        "from": from_time,
+        "to": to_time,
+        "granularity": "hour" if model is models.VehicleHourlyRollup else "day",
+        "totals": {**summarize(rows), "vehicle_count": len(by_vehicle)},
+        "vehicles": [
+            {"vehicle_id": vid, **summarize(vehicle_rows)}
+            for vid, vehicle_rows in sorted(by_vehicle.items())
+        ],
+        "series": [
+            {"bucket_start": bucket, **summarize(bucket_rows)}
+            for bucket, bucket_rows in sorted(by_bucket.items())
+        ]
+    }
+
+
+# ==================== BACKFILL ====================
+
+def backfill_rollups(
+    db: Session,
+    vehicle_ids: Optional[List[int]] = None,
+    chunk_size: int = 10000,
+    trips: bool = False
+) -> int:
+    """
+    Rebuild rollups from the positions table, one vehicle at a time.
+    Uses a fresh TripEngine so distance/moving time match live ingest;
+    with trips=True the vehicle's finished trips are replaced by the ones
+    it produces (a trip still open at the end is left to live ingest).
+    Returns the number of positions processed.
+    """
+    if vehicle_ids is None:
+        vehicle_ids = [vid for (vid,) in db.query(models.Vehicle.id).all()]
+
+    processed = 0
+    for vehicle_id in vehicle_ids:
+        engine = TripEngine()
+        buckets = {model: {} for model in _BUCKETS}
+        finished_trips = []
+        count = 0
+        raw = (
+            tuple(row) for row in
+            db.query(
+                models.Position.id,
+                models.Position.vehicle_id,
+                models.Position.lat,
+                models.Position.lng,
+                models.Position.speed,
+                models.Position.recorded_at
+            )
+            .filter(models.Position.vehicle_id == vehicle_id)
+            .order_by(models.Position.recorded_at, models.Position.id)
+            .yield_per(chunk_size)
+        )
+        # Compressed history counts too
+        positions = merge_tracks(raw, iter_segment_points(db, (vehicle_id,)))
+        for _, vid, lat, lng, speed, recorded_at in positions:
+            finished, steps = engine.observe_many([{
+                "vehicle_id": vid, "lat": lat, "lng": lng, "speed": speed, "recorded_at": recorded_at
+            }])
+            finished_trips.extend(finished)
+            for model, bucket_fn in _BUCKETS.items():
+                fold_step(buckets[model], steps[0], bucket_fn)
+            count += 1
+
+        for model, model_buckets in buckets.items():
+            db.execute(delete(model).where(model.vehicle_id == vehicle_id))
+            if model_buckets:
+                db.execute(insert(model), list(model_buckets.values()))
+        if trips:
+            db.execute(delete(models.Trip).where(models.Trip.vehicle_id == vehicle_id))
+            if finished_trips:
+                db.execute(insert(models.Trip), finished_trips)
+        db.commit()
+        processed += count
+        print(f"Backfilled rollups for vehicle {vehicle_id}: {count} positions"
+              + (f", {len(finished_trips)} trips" if trips else ""))
+    return processed
+
+
+def main():
+    from .db import SessionLocal, engine as db_engine
+
+    parser = argparse.ArgumentParser(description="Maintain analytics rollups")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--vehicle", type=int, action="append", help="Limit to vehicle id (repeatable)")
+    parser.add_argument("--trips", action="store_true", help="Also rebuild trips")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=db_engine)
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        processed = backfill_rollups(db, args.vehicle, trips=args.trips)
+        print(f"Processed {processed} positions in {time.perf_counter() - started:.1f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,524 +1,1138 @@
-from fastapi import APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
-from typing import List, Optional
-from datetime import datetime
-from .db import get_db
-from . import models
-from .schemas import VehicleCreate, VehicleOut, PositionCreate, PositionOut
-from .websocket import manager
-from .auth import verify_device_token
-import asyncio
-
-router = APIRouter()
-
-# ==================== VEHICLE ENDPOINTS ====================
-
-@router.post("/vehicles", response_model=VehicleOut, status_code=status.HTTP_201_CREATED)
-def create_vehicle(payload: VehicleCreate, db: Session = Depends(get_db)):
-    """Create a new vehicle"""
-    # Check if vehicle with same name exists
-    existing = db.query(models.Vehicle).filter(models.Vehicle.name == payload.name).first()
-    if existing:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Vehicle with name '{payload.name}' already exists"
-        )
-    
-    # Check if plate number exists (if provided)
-    if payload.plate_no:
-        existing_plate = db.query(models.Vehicle).filter(
-            models.Vehicle.plate_no == payload.plate_no
-        ).first()
-        if existing_plate:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Vehicle with plate '{payload.plate_no}' already exists"
-            )
-    
-    # Create vehicle
-    vehicle = models.Vehicle(**payload.model_dump())
-    db.add(vehicle)
-    db.commit()
-    db.refresh(vehicle)
-    return vehicle
-
-
-@router.get("/vehicles", response_model=List[VehicleOut])
-def list_vehicles(
-    skip: int = 0, 
-    limit: int = 100, 
-    active_only: bool = False,
-    db: Session = Depends(get_db)
-):
-    """Get all vehicles with optional filtering"""
-    query = db.query(models.Vehicle)
-    
-    # Filter for active vehicles only if requested
-    if active_only:
-        query = query.filter(models.Vehicle.is_active == True)
-    
-    vehicles = query.offset(skip).limit(limit).all()
-    return vehicles
-
-
-@router.get("/vehicles/with-last-position")
-def vehicles_with_last_position(db: Session = Depends(get_db)):
-    """
-    Get all vehicles with their latest position in ONE query
-    Much faster than making separate queries per vehicle
-    """
-    # Subquery to get latest position timestamp for each vehicle
-    subquery = (
-        db.query(
-            models.Position.vehicle_id,
-            func.max(models.Position.recorded_at).label('max_time')
-        )
-        .group_by(models.Position.vehicle_id)
-        .subquery()
-    )
-    
-    # Join vehicles with their latest positions
-    results = (
-        db.query(models.Vehicle, models.Position)
-        .outerjoin(
-            subquery,
-            models.Vehicle.id == subquery.c.vehicle_id
-        )
-        .outerjoin(
-            models.Position,
-            (models.Position.vehicle_id == models.Vehicle.id) &
-            (models.Position.recorded_at == subquery.c.max_time)
-        )
-        .all()
-    )
-    
-    # Format response
-    output = []
-    for vehicle, position in results:
-        vehicle_data = {
-            "id": vehicle.id,
-            "name": vehicle.name,
-            "plate_no": vehicle.plate_no,
-            "is_active": getattr(vehicle, 'is_active', True),
-            "last_position": None
-        }
-        
-        if position:
-            vehicle_data["last_position"] = {
-                "id": position.id,
-                "lat": position.lat,
-                "lng": position.lng,
-                "speed": position.speed,
-                "recorded_at": position.recorded_at.isoformat()
-            }
-        
-        output.append(vehicle_data)
-    
-    return output
-
-
-@router.get("/vehicles/{vehicle_id}", response_model=VehicleOut)
-def get_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
-    """Get a specific vehicle by ID"""
-    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
-    if not vehicle:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Vehicle with id {vehicle_id} not found"
-        )
-    return vehicle
-
-
-@router.put("/vehicles/{vehicle_id}", response_model=VehicleOut)
-def update_vehicle(
-    vehicle_id: int, 
-    payload: VehicleCreate, 
-    db: Session = Depends(get_db)
-):
-    """Update a vehicle"""
-    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
-    if not vehicle:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Vehicle with id {vehicle_id} not found"
-        )
-    
-    # Check if new name conflicts with another vehicle
-    if payload.name != vehicle.name:
-        existing = db.query(models.Vehicle).filter(
-            models.Vehicle.name == payload.name,
-            models.Vehicle.id != vehicle_id
-        ).first()
-        if existing:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Vehicle with name '{payload.name}' already exists"
-            )
-    
-    # Check if new plate conflicts with another vehicle
-    if payload.plate_no and payload.plate_no != vehicle.plate_no:
-        existing_plate = db.query(models.Vehicle).filter(
-            models.Vehicle.plate_no == payload.plate_no,
-            models.Vehicle.id != vehicle_id
-        ).first()
-        if existing_plate:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Vehicle with plate '{payload.plate_no}' already exists"
-            )
-    
-    # Update fields
-    vehicle.name = payload.name
-    vehicle.plate_no = payload.plate_no
-    
-    db.commit()
-    db.refresh(vehicle)
-    return vehicle
-
-
-@router.delete("/vehicles/{vehicle_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
-    """Delete a vehicle"""
-    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
-    if not vehicle:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Vehicle with id {vehicle_id} not found"
-        )
-    db.delete(vehicle)
-    db.commit()
-    return None
-
-
-# ==================== POSITION ENDPOINTS ====================
-
-@router.post("/positions", response_model=PositionOut, status_code=status.HTTP_201_CREATED)
-async def add_position(payload: PositionCreate, db: Session = Depends(get_db)):
-    """Add a new GPS position for a vehicle"""
-    # Verify vehicle exists
-    vehicle = db.query(models.Vehicle).filter(
-        models.Vehicle.id == payload.vehicle_id
-    ).first()
-    if not vehicle:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Vehicle with id {payload.vehicle_id} not found"
-        )
-    
-    # Create position
-    position = models.Position(**payload.model_dump())
-    db.add(position)
-    db.commit()
-    db.refresh(position)
-    
-    # Broadcast to WebSocket clients
-    asyncio.create_task(manager.notify_vehicle_update(
-        payload.vehicle_id,
-        {
-            "id": position.id,
-            "lat": position.lat,
-            "lng": position.lng,
-            "speed": position.speed,
-            "recorded_at": position.recorded_at.isoformat()
-        }
-    ))
-    
-    return position
-
-
-@router.get("/positions/{vehicle_id}", response_model=List[PositionOut])
-def get_positions(
-    vehicle_id: int,
-    limit: int = 1000,
-    skip: int = 0,
-    db: Session = Depends(get_db)
-):
-    """Get position history for a vehicle (most recent first)"""
-    # Verify vehicle exists
-    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
-    if not vehicle:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Vehicle with id {vehicle_id} not found"
-        )
-    
-    # Get positions
-    positions = (
-        db.query(models.Position)
-        .filter(models.Position.vehicle_id == vehicle_id)
-        .order_by(models.Position.recorded_at.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
-    )
-    return positions
-
-
-@router.get("/positions/{vehicle_id}/latest", response_model=PositionOut)
-def get_latest_position(vehicle_id: int, db: Session = Depends(get_db)):
-    """Get the most recent position for a vehicle"""
-    position = (
-        db.query(models.Position)
-        .filter(models.Position.vehicle_id == vehicle_id)
-        .order_by(models.Position.recorded_at.desc())
-        .first()
-    )
-    if not position:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No positions found for vehicle {vehicle_id}"
-        )
-    return position
-
-
-# ==================== GPS DEVICE ENDPOINTS ====================
-
-@router.post("/device/position", status_code=status.HTTP_201_CREATED)
-async def device_position_update(
-    payload: dict,
-    token: str = Depends(verify_device_token),
-    db: Session = Depends(get_db)
-):
-    """
-    Endpoint for GPS devices to send position updates
-    
-    Expected payload formats:
-    1. Simple format:
-       {
-         "device_id": "ABC123",
-         "lat": 6.5244,
-         "lng": 3.3792,
-         "speed": 45.5,
-         "timestamp": "2024-01-01T12:00:00Z"  (optional)
-       }
-    
-    2. Standard GPS format (various protocols):
-       {
-         "imei": "123456789012345",
-         "latitude": 6.5244,
-         "longitude": 3.3792,
-         "speed": 45.5,
-         "heading": 90,
-         "altitude": 100,
-         "timestamp": "2024-01-01T12:00:00Z",
-         "satellites": 8
-       }
-    """
-    
-    try:
-        # Parse different field names from various GPS devices
-        device_id = (
-            payload.get("device_id") or 
-            payload.get("imei") or 
-            payload.get("deviceId") or
-            payload.get("id")
-        )
-        
-        lat = payload.get("lat") or payload.get("latitude")
-        lng = payload.get("lng") or payload.get("longitude") or payload.get("lon")
-        speed = payload.get("speed", 0)
-        timestamp = payload.get("timestamp")
-        
-        if not device_id or lat is None or lng is None:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Missing required fields: device_id, lat, lng"
-            )
-        
-        # Find vehicle by device_id (stored in plate_no or name)
-        vehicle = db.query(models.Vehicle).filter(
-            (models.Vehicle.plate_no == device_id) | 
-            (models.Vehicle.name == device_id)
-        ).first()
-        
-        if not vehicle:
-            # Auto-create vehicle if not exists
-            vehicle = models.Vehicle(
-                name=f"Device-{device_id}",
-                plate_no=device_id
-            )
-            db.add(vehicle)
-            db.commit()
-            db.refresh(vehicle)
-            print(f"Auto-created vehicle for device {device_id}")
-        
-        # Parse timestamp if provided
-        recorded_at = datetime.utcnow()
-        if timestamp:
-            try:
-                recorded_at = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-            except:
-                pass
-        
-        # Create position
-        position = models.Position(
-            vehicle_id=vehicle.id,
-            lat=float(lat),
-            lng=float(lng),
-            speed=float(speed),
-            recorded_at=recorded_at
-        )
-        db.add(position)
-        db.commit()
-        db.refresh(position)
-        
-        # Broadcast to WebSocket clients
-        asyncio.create_task(manager.notify_vehicle_update(
-            vehicle.id,
-            {
-                "id": position.id,
-                "lat": position.lat,
-                "lng": position.lng,
-                "speed": position.speed,
-                "recorded_at": position.recorded_at.isoformat()
-            }
-        ))
-        
-        return {
-            "status": "success",
-            "message": "Position recorded",
-            "vehicle_id": vehicle.id,
-            "position_id": position.id
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error processing device position: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to process position: {str(e)}"
-        )
-
-
-@router.post("/device/batch", status_code=status.HTTP_201_CREATED)
-async def device_batch_update(
-    payload: dict,
-    token: str = Depends(verify_device_token),
-    db: Session = Depends(get_db)
-):
-    """
-    Batch endpoint for GPS devices to send multiple positions at once
-    
-    Payload:
-    {
-      "device_id": "ABC123",
-      "positions": [
-        {"lat": 6.5244, "lng": 3.3792, "speed": 45, "timestamp": "..."},
-        {"lat": 6.5245, "lng": 3.3793, "speed": 46, "timestamp": "..."}
-      ]
-    }
-    """
-    
-    device_id = payload.get("device_id")
-    positions_data = payload.get("positions", [])
-    
-    if not device_id or not positions_data:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Missing device_id or positions"
-        )
-    
-    # Find or create vehicle
-    vehicle = db.query(models.Vehicle).filter(
-        (models.Vehicle.plate_no == device_id) | 
-        (models.Vehicle.name == device_id)
-    ).first()
-    
-    if not vehicle:
-        vehicle = models.Vehicle(
-            name=f"Device-{device_id}",
-            plate_no=device_id
-        )
-        db.add(vehicle)
-        db.commit()
-        db.refresh(vehicle)
-    
-    # Create all positions
-    created_count = 0
-    latest_position = None
-    
-    for pos_data in positions_data:
-        try:
-            lat = pos_data.get("lat")
-            lng = pos_data.get("lng")
-            
-            if lat is None or lng is None:
-                continue
-            
-            timestamp = pos_data.get("timestamp")
-            recorded_at = datetime.utcnow()
-            if timestamp:
-                try:
-                    recorded_at = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                except:
-                    pass
-            
-            position = models.Position(
-                vehicle_id=vehicle.id,
-                lat=float(lat),
-                lng=float(lng),
-                speed=float(pos_data.get("speed", 0)),
-                recorded_at=recorded_at
-            )
-            db.add(position)
-            created_count += 1
-            latest_position = position
-            
-        except Exception as e:
-            print(f"Error processing batch position: {e}")
-            continue
-    
-    db.commit()
-    
-    # Broadcast latest position
-    if latest_position:
-        asyncio.create_task(manager.notify_vehicle_update(
-            vehicle.id,
-            {
-                "id": latest_position.id,
-                "lat": latest_position.lat,
-                "lng": latest_position.lng,
-                "speed": latest_position.speed,
-                "recorded_at": latest_position.recorded_at.isoformat()
-            }
-        ))
-    
-    return {
-        "status": "success",
-        "message": f"Recorded {created_count} positions",
-        "vehicle_id": vehicle.id,
-        "count": created_count
-    }
-
-
-# ==================== WEBSOCKET ENDPOINT ====================
-
-@router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time updates"""
-    await manager.connect(websocket)
-    try:
-        while True:
-            # Receive messages from client
-            data = await websocket.receive_json()
-            
-            # Handle different message types
-            if data.get("type") == "subscribe":
-                vehicle_id = data.get("vehicle_id")
-                if vehicle_id:
-                    manager.subscribe_to_vehicle(vehicle_id, websocket)
-                    await manager.send_personal_message({
-                        "type": "subscribed",
-                        "vehicle_id": vehicle_id
-                    }, websocket)
-            
-            elif data.get("type") == "ping":
-                await manager.send_personal_message({"type": "pong"}, websocket)
-                
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-    except Exception as e:
-        print(f"WebSocket error: {e}")
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, desc, select
+from typing import List, Optional
+from datetime import datetime, timedelta
+from .db import get_db, get_async_db, get_read_db, read_db, async_read_db, SessionLocal
+from . import models
+from .schemas import VehicleCreate, VehicleOut, PositionCreate, PositionOut, TripOut, DistanceOut
+from .websocket import manager, parse_bbox
+from .auth import verify_device_token
+from .resolver import device_resolver
+from .cache import response_cache, positions_tag, CACHE_HISTORY_SETTLE_SECONDS
+from .live import live_positions, fleet_changes, fleet_stats
+from .pagination import encode_cursor, decode_cursor, InvalidCursor
+from .simplify import simplify_mask, tolerance_for_zoom
+from .trips import trip_engine
+from .segments import merge_history
+from .rollups import delete_vehicle_rollups, query_rollups
+from .export import export_positions, EXPORT_FORMATS
+from .binary import decode_fixes, BinaryFormatError, BINARY_CONTENT_TYPE
+from .importer import ImportJob, aiter_lines, register_job, get_job
+from .ingest import (
+    ingest_pipeline, IngestQueueFull, INGEST_ACK, ACK_ENQUEUE, ACK_DURABLE,
+    extract_fix, extract_seq, validate_fix, naive_utc, parse_timestamp, store_positions, publish_positions
+)
+import asyncio
+import os
+import numpy as np
+
+router = APIRouter()
+
+# Upper bound on raw points read for one simplified history response
+SIMPLIFY_MAX_POINTS = int(os.getenv("SIMPLIFY_MAX_POINTS", 200000))
+
+# Columns returned by position history
+HISTORY_COLUMNS = (
+    models.Position.id,
+    models.Position.vehicle_id,
+    models.Position.lat,
+    models.Position.lng,
+    models.Position.speed,
+    models.Position.recorded_at
+)
+HISTORY_KEYS = ("id", "vehicle_id", "lat", "lng", "speed", "recorded_at")
+
+# Upper bound on positions in one gateway batch
+GATEWAY_BATCH_MAX_ITEMS = int(os.getenv("GATEWAY_BATCH_MAX_ITEMS", 5000))
+
+# ==================== VEHICLE ENDPOINTS ====================
+
+@router.post("/vehicles", response_model=VehicleOut, status_code=status.HTTP_201_CREATED)
+def create_vehicle(payload: VehicleCreate, db: Session = Depends(get_db)):
+    """Create a new vehicle"""
+    # Check if vehicle with same name exists
+    existing = db.query(models.Vehicle).filter(models.Vehicle.name == payload.name).first()
+    if existing:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Vehicle with name '{payload.name}' already exists"
+        )
+    
+    # Check if plate number exists (if provided)
+    if payload.plate_no:
+        existing_plate = db.query(models.Vehicle).filter(
+            models.Vehicle.plate_no == payload.plate_no
+        ).first()
+        if existing_plate:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Vehicle with plate '{payload.plate_no}' already exists"
+            )
+    
+    # Create vehicle
+    vehicle = models.Vehicle(**payload.model_dump())
+    db.add(vehicle)
+    db.commit()
+    db.refresh(vehicle)
+    
+    # Devices previously seen as unknown may now resolve to this vehicle
+    device_resolver.invalidate(vehicle.name, vehicle.plate_no)
+    response_cache.invalidate_soon("vehicles")
+    fleet_changes.touch(vehicle.id)
+    fleet_stats.vehicle_added(vehicle.id)
+    return vehicle
+
+
+@router.get("/vehicles", response_model=List[VehicleOut])
+async def list_vehicles(
+    skip: int = 0, 
+    limit: int = 100, 
+    active_only: bool = False,
+    db: Session = Depends(read_db(fresh=("vehicles",)))
+):
+    """Get all vehicles with optional filtering"""
+    def load():
+        query = db.query(models.Vehicle)
+        
+        # Filter for active vehicles only if requested
+        if active_only:
+            query = query.filter(models.Vehicle.is_active == True)
+        
+        vehicles = query.offset(skip).limit(limit).all()
+        return [VehicleOut.model_validate(v).model_dump(mode="json") for v in vehicles]
+    
+    return await response_cache.get_or_load(
+        "vehicles.list", (skip, limit, active_only), ("vehicles",),
+        lambda: run_in_threadpool(load)
+    )
+
+
+def fleet_entry(vehicle: models.Vehicle, position: Optional[dict]) -> dict:
+    """One vehicle of the fleet snapshot"""
+    vehicle_data = {
+        "id": vehicle.id,
+        "name": vehicle.name,
+        "plate_no": vehicle.plate_no,
+        "is_active": getattr(vehicle, 'is_active', True),
+        "last_position": None
+    }
+    if position:
+        vehicle_data["last_position"] = {
+            "id": position["id"],
+            "lat": position["lat"],
+            "lng": position["lng"],
+            "speed": position["speed"],
+            "recorded_at": position["recorded_at"].isoformat()
+        }
+    return vehicle_data
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+# Deltas with more changed vehicles than this read the whole table
+FLEET_DELTA_MAX_IDS = 500
+
+
+@router.get("/vehicles/with-last-position")
+async def vehicles_with_last_position(
+    request: Request,
+    response: Response,
+    since: Optional[str] = None,
+    db: AsyncSession = Depends(async_read_db(fresh=("vehicles",)))
+):
+    """
+    Get all vehicles with their latest position
+    Positions come from the in-memory last-position store, so the cost is
+    O(fleet size) no matter how much history is recorded
+    
+    Every response carries the current change token in X-Change-Seq (also
+    the ETag; If-None-Match with it answers 304 while nothing changed).
+    With ?since=<token> the response is a delta:
+    {"seq": token, "full": false, "vehicles": [changed], "deleted": [ids]}
+    An unknown or expired token (e.g. from another worker or before a
+    restart), or since=0, returns every vehicle with "full": true.
+    """
+    # Read the token before the data so no change can fall between them
+    token = fleet_changes.token()
+    etag = f'"{token}"'
+    headers = {"ETag": etag, "X-Change-Seq": token, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    
+    seq = fleet_changes.parse(since) if since else None
+    changed, deleted = fleet_changes.since(seq) if seq is not None else (None, [])
+    
+    query = select(models.Vehicle)
+    if changed is not None and len(changed) <= FLEET_DELTA_MAX_IDS:
+        query = query.where(models.Vehicle.id.in_(changed))
+    vehicles = (await db.scalars(query)).all()
+    if changed is not None:
+        wanted = set(changed)
+        vehicles = [vehicle for vehicle in vehicles if vehicle.id in wanted]
+    positions = live_positions.snapshot()
+    
+    output = [fleet_entry(vehicle, positions.get(vehicle.id)) for vehicle in vehicles]
+    if since is None:
+        return output
+    return {
+        "seq": token,
+        "full": changed is None,
+        "vehicles": output,
+        "deleted": deleted
+    }
+
+
+@router.get("/fleet/stats")
+async def get_fleet_stats():
+    """
+    Fleet counts: total, active (fix within the stale window), moving/idle
+    by speed, stale, never reported, and average speed of active vehicles
+    Maintained as positions arrive, so this does no database work; counts
+    are per worker and rebuilt from the database at startup. WebSocket
+    clients can send {"type": "subscribe_stats"} to get them pushed instead.
+    """
+    return fleet_stats.snapshot()
+
+
+@router.get("/vehicles/{vehicle_id}", response_model=VehicleOut)
+async def get_vehicle(vehicle_id: int, db: Session = Depends(read_db(fresh=("vehicles",)))):
+    """Get a specific vehicle by ID"""
+    def load():
+        vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
+        return VehicleOut.model_validate(vehicle).model_dump(mode="json") if vehicle else None
+    
+    vehicle = await response_cache.get_or_load(
+        "vehicles.get", (vehicle_id,), ("vehicles",),
+        lambda: run_in_threadpool(load)
+    )
+    if not vehicle:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Vehicle with id {vehicle_id} not found"
+        )
+    return vehicle
+
+
+@router.put("/vehicles/{vehicle_id}", response_model=VehicleOut)
+def update_vehicle(
+    vehicle_id: int, 
+    payload: VehicleCreate, 
+    db: Session = Depends(get_db)
+):
+    """Update a vehicle"""
+    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
+    if not vehicle:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Vehicle with id {vehicle_id} not found"
+        )
+    
+    # Check if new name conflicts with another vehicle
+    if payload.name != vehicle.name:
+        existing = db.query(models.Vehicle).filter(
+            models.Vehicle.name == payload.name,
+            models.Vehicle.id != vehicle_id
+        ).first()
+        if existing:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Vehicle with name '{payload.name}' already exists"
+            )
+    
+    # Check if new plate conflicts with another vehicle
+    if payload.plate_no and payload.plate_no != vehicle.plate_no:
+        existing_plate = db.query(models.Vehicle).filter(
+            models.Vehicle.plate_no == payload.plate_no,
+            models.Vehicle.id != vehicle_id
+        ).first()
+        if existing_plate:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Vehicle with plate '{payload.plate_no}' already exists"
+            )
+    
+    # Update fields
+    old_keys = (vehicle.name, vehicle.plate_no)
+    vehicle.name = payload.name
+    vehicle.plate_no = payload.plate_no
+    
+    db.commit()
+    db.refresh(vehicle)
+    
+    # Drop cached device mappings for both the old and new identifiers
+    device_resolver.invalidate(*old_keys, vehicle.name, vehicle.plate_no)
+    device_resolver.invalidate_vehicle(vehicle_id)
+    response_cache.invalidate_soon("vehicles")
+    fleet_changes.touch(vehicle_id)
+    return vehicle
+
+
+@router.delete("/vehicles/{vehicle_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
+    """Delete a vehicle"""
+    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
+    if not vehicle:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Vehicle with id {vehicle_id} not found"
+        )
+    old_keys = (vehicle.name, vehicle.plate_no)
+    delete_vehicle_rollups(db, vehicle_id)
+    db.delete(vehicle)
+    db.commit()
+    
+    device_resolver.invalidate(*old_keys)
+    device_resolver.invalidate_vehicle(vehicle_id)
+    live_positions.remove(vehicle_id)
+    fleet_changes.delete(vehicle_id)
+    fleet_stats.vehicle_removed(vehicle_id)
+    trip_engine.forget(vehicle_id)
+    response_cache.invalidate_soon("vehicles", positions_tag(vehicle_id))
+    return None
+
+
+# ==================== POSITION ENDPOINTS ====================
+
+@router.post("/positions", response_model=PositionOut, status_code=status.HTTP_201_CREATED)
+async def add_position(payload: PositionCreate, db: AsyncSession = Depends(get_async_db)):
+    """Add a new GPS position for a vehicle"""
+    # Verify vehicle exists
+    vehicle_id = await db.scalar(
+        select(models.Vehicle.id).where(models.Vehicle.id == payload.vehicle_id)
+    )
+    if vehicle_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Vehicle with id {payload.vehicle_id} not found"
+        )
+    
+    # Create position
+    row = payload.model_dump()
+    row["recorded_at"] = datetime.utcnow()
+    await db.run_sync(store_positions, [row])
+    await db.commit()
+    
+    # Update last position and broadcast to WebSocket clients
+    publish_positions([row])
+    
+    return row
+
+
+@router.get("/positions/{vehicle_id}", response_model=List[PositionOut])
+async def get_positions(
+    vehicle_id: int,
+    response: Response,
+    limit: int = Query(1000, ge=1, le=10000),
+    skip: int = 0,
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    cursor: Optional[str] = None,
+    tolerance: Optional[float] = Query(None, gt=0, description="Simplification tolerance in metres"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description="Map zoom to simplify for"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Get position history for a vehicle (most recent first)
+    
+    - from / to: optional time window (ISO 8601)
+    - cursor: value of the X-Next-Cursor header from the previous page;
+      pages by keyset on (recorded_at, id) so deep pages stay fast
+    - tolerance / zoom: return a simplified track instead of raw rows;
+      covers up to SIMPLIFY_MAX_POINTS raw points and ignores limit
+    
+    Pages that end more than CACHE_HISTORY_SETTLE_SECONDS ago are cached.
+    """
+    from_time = naive_utc(from_time) if from_time else None
+    to_time = naive_utc(to_time) if to_time else None
+    
+    cursor_time = cursor_id = None
+    if cursor:
+        try:
+            cursor_time, cursor_id = decode_cursor(cursor)
+        except InvalidCursor as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
+    
+    if tolerance is None and zoom is not None:
+        tolerance = tolerance_for_zoom(zoom)
+    
+    def load():
+        # Verify vehicle exists
+        vehicle_exists = db.query(models.Vehicle.id).filter(models.Vehicle.id == vehicle_id).first()
+        if not vehicle_exists:
+            return None
+        
+        query = db.query(*HISTORY_COLUMNS).filter(models.Position.vehicle_id == vehicle_id)
+        
+        if from_time:
+            query = query.filter(models.Position.recorded_at >= from_time)
+        if to_time:
+            query = query.filter(models.Position.recorded_at <= to_time)
+        
+        if cursor:
+            query = query.filter(
+                (models.Position.recorded_at < cursor_time) |
+                ((models.Position.recorded_at == cursor_time) & (models.Position.id < cursor_id))
+            )
+        
+        query = query.order_by(models.Position.recorded_at.desc(), models.Position.id.desc())
+        before = (cursor_time, cursor_id) if cursor else None
+        
+        if tolerance is not None:
+            rows = merge_history(
+                db, vehicle_id, query.limit(SIMPLIFY_MAX_POINTS).all(), SIMPLIFY_MAX_POINTS,
+                from_time, to_time, before
+            )
+            return simplified_positions(rows, tolerance)
+        
+        # Legacy offset paging; prefer the cursor
+        offset = skip if skip and not cursor else 0
+        
+        # Get positions, merged with compressed segments of the same range
+        rows = merge_history(
+            db, vehicle_id, query.limit(offset + limit).all(), offset + limit,
+            from_time, to_time, before
+        )[offset:]
+        
+        # A full page means there may be more
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = encode_cursor(last[5], last[0])
+        
+        return {"items": [dict(zip(HISTORY_KEYS, row)) for row in rows], "next_cursor": next_cursor}
+    
+    # Only history that live ingest no longer writes to is cached
+    upper = min((t for t in (to_time, cursor_time) if t is not None), default=None)
+    settled = datetime.utcnow() - timedelta(seconds=CACHE_HISTORY_SETTLE_SECONDS)
+    if upper is not None and upper < settled:
+        page = await response_cache.get_or_load(
+            "positions.history",
+            (vehicle_id, limit, skip, from_time, to_time, cursor, tolerance),
+            ("vehicles", positions_tag(vehicle_id)),
+            lambda: run_in_threadpool(lambda: jsonable_encoder(load()))
+        )
+    else:
+        page = await run_in_threadpool(load)
+    
+    if page is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Vehicle with id {vehicle_id} not found"
+        )
+    
+    if page["next_cursor"]:
+        response.headers["X-Next-Cursor"] = page["next_cursor"]
+    
+    return page["items"]
+
+
+def simplified_positions(rows: list, tolerance: float) -> dict:
+    """Simplify up to SIMPLIFY_MAX_POINTS history rows (HISTORY_COLUMNS order)"""
+    if not rows:
+        return {"items": [], "next_cursor": None}
+    
+    next_cursor = None
+    if len(rows) == SIMPLIFY_MAX_POINTS:
+        last = rows[-1]
+        next_cursor = encode_cursor(last[5], last[0])
+    
+    ids, vehicle_ids, lats, lngs, speeds, times = zip(*rows)
+    keep = simplify_mask(
+        np.fromiter(lats, dtype=float, count=len(rows)),
+        np.fromiter(lngs, dtype=float, count=len(rows)),
+        tolerance,
+        speed=np.fromiter((s or 0.0 for s in speeds), dtype=float, count=len(rows))
+    )
+    items = [
+        {
+            "id": ids[i],
+            "vehicle_id": vehicle_ids[i],
+            "lat": lats[i],
+            "lng": lngs[i],
+            "speed": speeds[i],
+            "recorded_at": times[i]
+        }
+        for i in np.flatnonzero(keep).tolist()
+    ]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@router.get("/positions/{vehicle_id}/latest", response_model=PositionOut)
+def get_latest_position(vehicle_id: int):
+    """Get the most recent position for a vehicle"""
+    position = live_positions.get(vehicle_id)
+    if not position:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No positions found for vehicle {vehicle_id}"
+        )
+    return position
+
+
+# ==================== TRIP ENDPOINTS ====================
+
+def _trip_overlaps(trip: dict, from_time: Optional[datetime], to_time: Optional[datetime]) -> bool:
+    if from_time and trip["start_at"] < from_time:
+        return False
+    if to_time and trip["start_at"] > to_time:
+        return False
+    return True
+
+
+@router.get("/trips/{vehicle_id}", response_model=List[TripOut])
+def list_trips(
+    vehicle_id: int,
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Get trips for a vehicle (most recent first), filtered by start time
+    The trip in progress, if any, is included with in_progress=true
+    """
+    from_time = naive_utc(from_time) if from_time else None
+    to_time = naive_utc(to_time) if to_time else None
+    
+    query = db.query(models.Trip).filter(models.Trip.vehicle_id == vehicle_id)
+    if from_time:
+        query = query.filter(models.Trip.start_at >= from_time)
+    if to_time:
+        query = query.filter(models.Trip.start_at <= to_time)
+    trips = query.order_by(models.Trip.start_at.desc()).limit(limit).all()
+    
+    output = [TripOut.model_validate(trip) for trip in trips]
+    current = trip_engine.open_trip(vehicle_id)
+    if current and _trip_overlaps(current, from_time, to_time):
+        output.insert(0, TripOut(**current, in_progress=True))
+        output = output[:limit]
+    return output
+
+
+@router.get("/trips/{vehicle_id}/distance", response_model=DistanceOut)
+def get_distance(
+    vehicle_id: int,
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Distance travelled by a vehicle, summed from its trips
+    Trips are attributed to the range their start time falls in
+    """
+    from_time = naive_utc(from_time) if from_time else None
+    to_time = naive_utc(to_time) if to_time else None
+    
+    query = db.query(
+        func.coalesce(func.sum(models.Trip.distance_km), 0.0),
+        func.count(models.Trip.id)
+    ).filter(models.Trip.vehicle_id == vehicle_id)
+    if from_time:
+        query = query.filter(models.Trip.start_at >= from_time)
+    if to_time:
+        query = query.filter(models.Trip.start_at <= to_time)
+    distance_km, trip_count = query.one()
+    
+    current = trip_engine.open_trip(vehicle_id)
+    if current and _trip_overlaps(current, from_time, to_time):
+        distance_km += current["distance_km"]
+        trip_count += 1
+    
+    return {
+        "vehicle_id": vehicle_id,
+        "distance_km": round(distance_km, 3),
+        "trip_count": trip_count,
+        "moving": trip_engine.is_moving(vehicle_id)
+    }
+
+
+# ==================== ANALYTICS ENDPOINTS ====================
+
+ANALYTICS_RANGES = {
+    "today": lambda now: now.replace(hour=0, minute=0, second=0, microsecond=0),
+    "week": lambda now: now - timedelta(days=7),
+    "month": lambda now: now - timedelta(days=30),
+}
+
+
+@router.get("/analytics")
+def get_analytics(
+    window: Optional[str] = Query(None, alias="range", description="today, week or month"),
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    vehicle_id: Optional[int] = None,
+    db: Session = Depends(get_read_db)
+):
+    """
+    Fleet-wide or per-vehicle analytics served from hourly/daily rollups
+    Totals, a per-vehicle breakdown and a per-bucket series
+    """
+    now = datetime.utcnow()
+    if window is not None:
+        if window not in ANALYTICS_RANGES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid range '{window}', expected one of {', '.join(ANALYTICS_RANGES)}"
+            )
+        from_time, to_time = ANALYTICS_RANGES[window](now), now
+    else:
+        from_time = naive_utc(from_time) if from_time else now - timedelta(days=1)
+        to_time = naive_utc(to_time) if to_time else now
+    
+    if from_time > to_time:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="'from' must be before 'to'"
+        )
+    
+    return query_rollups(db, from_time, to_time, vehicle_id)
+
+
+# ==================== EXPORT ENDPOINTS ====================
+
+@router.get("/export/positions")
+def export_positions_endpoint(
+    format: str = Query("ndjson", description="ndjson, csv or columnar"),
+    vehicle_ids: Optional[List[int]] = Query(None, alias="vehicle_id"),
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to")
+):
+    """
+    Stream position history for reporting jobs
+    Rows are streamed from a server-side cursor; repeat vehicle_id to
+    export several vehicles, omit it for the whole fleet
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid format '{format}', expected one of {', '.join(EXPORT_FORMATS)}"
+        )
+    
+    extension = {"ndjson": "ndjson", "csv": "csv", "columnar": "bin"}[format]
+    return StreamingResponse(
+        export_positions(
+            format,
+            vehicle_ids,
+            naive_utc(from_time) if from_time else None,
+            naive_utc(to_time) if to_time else None
+        ),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="positions.{extension}"'}
+    )
+
+
+# ==================== IMPORT ENDPOINTS ====================
+
+@router.post("/import/positions")
+async def import_positions(
+    request: Request,
+    format: Optional[str] = Query(None, description="ndjson or csv (default from Content-Type)"),
+    skip_records: int = Query(0, ge=0, description="Records to skip when resuming a failed import"),
+    job_id: Optional[str] = Query(None, description="Client-chosen job id to poll while uploading"),
+    token: str = Depends(verify_device_token)
+):
+    """
+    Bulk import historical positions for many devices
+    
+    Upload NDJSON or CSV (device_id, lat, lng, speed, timestamp) as the raw
+    request body. The body is streamed and committed in chunks; if a chunk
+    fails, re-upload with skip_records set to the job's resume_skip_records.
+    The response only comes once the import is done; to follow progress
+    meanwhile, pass your own job_id and poll /import/jobs/{job_id}.
+    Afterwards the imported vehicles' trips and rollups are rebuilt from
+    their full history (status "backfilling"), so analytics, trips and
+    distance include the imported range.
+    """
+    if format is None:
+        format = "csv" if "csv" in request.headers.get("content-type", "") else "ndjson"
+    try:
+        job = ImportJob(format, skip_records=skip_records, job_id=job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        register_job(job)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    
+    db = SessionLocal()
+    try:
+        async for line in aiter_lines(request.stream()):
+            if job.add_line(line):
+                await asyncio.to_thread(job.flush, db)
+        await asyncio.to_thread(job.flush, db)
+        await asyncio.to_thread(job.backfill, db)
+        job.finish()
+    except Exception as e:
+        print(f"Import {job.id} failed: {e}")
+        job.finish("failed", str(e))
+        await asyncio.to_thread(job.backfill_after_failure, db)
+        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=job.to_dict())
+    finally:
+        db.close()
+    
+    return job.to_dict()
+
+
+@router.get("/import/jobs/{job_id}")
+def get_import_job(job_id: str):
+    """Progress of a bulk import"""
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Import job {job_id} not found"
+        )
+    return job.to_dict()
+
+
+# ==================== GPS DEVICE ENDPOINTS ====================
+
+@router.post("/device/position", status_code=status.HTTP_201_CREATED)
+async def device_position_update(
+    payload: dict,
+    response: Response,
+    ack: Optional[str] = None,
+    token: str = Depends(verify_device_token),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Endpoint for GPS devices to send position updates
+    
+    When INGEST_MODE=queued the position goes through the write-behind
+    pipeline; ?ack=enqueue returns 202 once queued, ?ack=durable (default)
+    waits for the batch commit. A full queue answers 503 with Retry-After.
+    
+    A resent fix (same vehicle, timestamp and coordinates, or the same
+    optional "seq" number) is not stored again and answers with
+    "duplicate": true and no position_id.
+    
+    Expected payload formats:
+    1. Simple format:
+       {
+         "device_id": "ABC123",
+         "lat": 6.5244,
+         "lng": 3.3792,
+         "speed": 45.5,
+         "timestamp": "2024-01-01T12:00:00Z",  (optional)
+         "seq": 1234  (optional, device sequence number)
+       }
+    
+    2. Standard GPS format (various protocols):
+       {
+         "imei": "123456789012345",
+         "latitude": 6.5244,
+         "longitude": 3.3792,
+         "speed": 45.5,
+         "heading": 90,
+         "altitude": 100,
+         "timestamp": "2024-01-01T12:00:00Z",
+         "satellites": 8
+       }
+    """
+    
+    try:
+        # Parse different field names from various GPS devices
+        device_id, lat, lng, speed, timestamp = extract_fix(payload)
+        
+        if not device_id or lat is None or lng is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Missing required fields: device_id, lat, lng"
+            )
+        
+        # Checked before resolving, so a rejected ping never creates a vehicle
+        queued = ingest_pipeline.running
+        if queued:
+            ack = ack or INGEST_ACK
+            if ack not in (ACK_ENQUEUE, ACK_DURABLE):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Invalid ack '{ack}', expected '{ACK_ENQUEUE}' or '{ACK_DURABLE}'"
+                )
+        
+        # Find (or auto-create) vehicle by device_id (stored in plate_no or name)
+        vehicle_id = await device_resolver.aresolve(db, str(device_id))
+        if vehicle_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Unknown device '{device_id}'"
+            )
+        
+        row = {
+            "vehicle_id": vehicle_id,
+            "lat": float(lat),
+            "lng": float(lng),
+            "speed": float(speed),
+            "recorded_at": parse_timestamp(timestamp),
+            "seq": extract_seq(payload)
+        }
+        
+        # Queued mode: hand off to the write-behind pipeline
+        if queued:
+            # The pipeline writes on its own connection; don't hold this one
+            # (or a transaction on it) while waiting for the batch commit
+            await db.close()
+            try:
+                await ingest_pipeline.submit(row, ack=ack)
+            except IngestQueueFull as e:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=str(e),
+                    headers={"Retry-After": "1"}
+                )
+            
+            if ack == ACK_ENQUEUE:
+                response.status_code = status.HTTP_202_ACCEPTED
+                return {
+                    "status": "accepted",
+                    "message": "Position queued",
+                    "vehicle_id": vehicle_id,
+                    "position_id": None
+                }
+            
+            return position_response(row)
+        
+        # Direct mode: one transaction per ping
+        await db.run_sync(store_positions, [row])
+        await db.commit()
+        
+        # Broadcast to WebSocket clients
+        publish_positions([row])
+        
+        return position_response(row)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error processing device position: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to process position: {str(e)}"
+        )
+
+
+def position_response(row: dict) -> dict:
+    """Response to a single stored (or duplicate) device position"""
+    duplicate = row.get("duplicate", False)
+    return {
+        "status": "success",
+        "message": "Duplicate position ignored" if duplicate else "Position recorded",
+        "vehicle_id": row["vehicle_id"],
+        "position_id": row["id"],
+        "duplicate": duplicate
+    }
+
+
+def validate_batch(items: list, device_id: Optional[str] = None):
+    """
+    Validate batch items in one pass.
+    Returns (fixes, errors) where errors are {"index", "error"} per bad item.
+    """
+    fixes = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if device_id is not None and isinstance(item, dict):
+                item = {**item, "device_id": device_id}
+            fixes.append(validate_fix(item))
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+    return fixes, errors
+
+
+def batch_seqs(items: list, errors: list) -> List[Optional[int]]:
+    """Device sequence numbers of the items validate_batch accepted, in order"""
+    rejected = {error["index"] for error in errors}
+    return [
+        extract_seq(item) if isinstance(item, dict) else None
+        for index, item in enumerate(items) if index not in rejected
+    ]
+
+
+def reject_unknown_devices(fixes: list, errors: list, vehicle_ids: dict) -> list:
+    """
+    Move fixes whose device resolved to no vehicle (auto-create off) into
+    errors, keeping the item indexes; returns the remaining fixes.
+    """
+    if len(vehicle_ids) == len({fix[0] for fix in fixes}):
+        return fixes
+    rejected = {error["index"] for error in errors}
+    indexes = (i for i in range(len(fixes) + len(errors)) if i not in rejected)
+    known = []
+    for index, fix in zip(indexes, fixes):
+        if fix[0] in vehicle_ids:
+            known.append(fix)
+        else:
+            errors.append({"index": index, "error": f"Unknown device '{fix[0]}'"})
+    errors.sort(key=lambda error: error["index"])
+    return known
+
+
+async def store_batch(
+    db: AsyncSession,
+    fixes: list,
+    vehicle_ids: dict,
+    seqs: Optional[List[Optional[int]]] = None
+) -> List[dict]:
+    """
+    Insert validated fixes in one transaction and notify subscribers.
+    Returns the stored rows; duplicates are skipped.
+    """
+    rows = [
+        {
+            "vehicle_id": vehicle_ids[device_id],
+            "lat": lat,
+            "lng": lng,
+            "speed": speed,
+            "recorded_at": recorded_at
+        }
+        for device_id, lat, lng, speed, recorded_at in fixes
+    ]
+    if seqs is not None:
+        for row, seq in zip(rows, seqs):
+            row["seq"] = seq
+    stored = await db.run_sync(store_positions, rows)
+    await db.commit()
+    
+    # One notification per vehicle, carrying its newest point
+    publish_positions(rows)
+    return stored
+
+
+@router.post("/device/batch", status_code=status.HTTP_201_CREATED)
+async def device_batch_update(
+    payload: dict,
+    token: str = Depends(verify_device_token),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Batch endpoint for GPS devices to send multiple positions at once
+    
+    Payload:
+    {
+      "device_id": "ABC123",
+      "positions": [
+        {"lat": 6.5244, "lng": 3.3792, "speed": 45, "timestamp": "..."},
+        {"lat": 6.5245, "lng": 3.3793, "speed": 46, "timestamp": "..."}
+      ]
+    }
+    
+    Invalid positions are skipped and reported in "errors" by index.
+    Resent positions (see /device/position, including "seq") are skipped
+    and counted in "duplicates".
+    """
+    
+    device_id = payload.get("device_id")
+    positions_data = payload.get("positions", [])
+    
+    if not device_id or not positions_data or not isinstance(positions_data, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Missing device_id or positions"
+        )
+    
+    fixes, errors = validate_batch(positions_data, device_id=str(device_id))
+    
+    # Find or create vehicle
+    vehicle_id = await device_resolver.aresolve(db, str(device_id))
+    if vehicle_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Unknown device '{device_id}'"
+        )
+    
+    rows = await store_batch(
+        db, fixes, {str(device_id): vehicle_id}, batch_seqs(positions_data, errors)
+    )
+    
+    return {
+        "status": "success",
+        "message": f"Recorded {len(rows)} positions",
+        "vehicle_id": vehicle_id,
+        "count": len(rows),
+        "duplicates": len(fixes) - len(rows),
+        "rejected": len(errors),
+        "errors": errors
+    }
+
+
+@router.post("/device/gateway", status_code=status.HTTP_201_CREATED)
+async def gateway_batch_update(
+    payload: dict,
+    token: str = Depends(verify_device_token),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Batch endpoint for gateways forwarding positions from many devices
+    
+    Payload:
+    {
+      "positions": [
+        {"device_id": "ABC123", "lat": 6.5244, "lng": 3.3792, "speed": 45, "timestamp": "..."},
+        {"imei": "123456789012345", "latitude": 6.51, "longitude": 3.37, "timestamp": "..."}
+      ]
+    }
+    
+    Every item accepts the same fields as /device/position. Device ids are
+    resolved with one query, all valid positions are stored in one
+    transaction and invalid ones are reported in "errors" by index.
+    Resent positions are skipped and counted in "duplicates".
+    """
+    
+    positions_data = payload.get("positions")
+    
+    if not positions_data or not isinstance(positions_data, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Missing positions"
+        )
+    
+    if len(positions_data) > GATEWAY_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {GATEWAY_BATCH_MAX_ITEMS} positions per batch"
+        )
+    
+    fixes, errors = validate_batch(positions_data)
+    
+    vehicle_ids = await device_resolver.aresolve_many(db, {fix[0] for fix in fixes})
+    fixes = reject_unknown_devices(fixes, errors, vehicle_ids)
+    
+    rows = await store_batch(db, fixes, vehicle_ids, batch_seqs(positions_data, errors))
+    
+    return {
+        "status": "success" if not errors else "partial",
+        "message": f"Recorded {len(rows)} positions",
+        "count": len(rows),
+        "duplicates": len(fixes) - len(rows),
+        "rejected": len(errors),
+        "vehicles": vehicle_ids,
+        "errors": errors
+    }
+
+
+@router.post("/device/binary", status_code=status.HTTP_201_CREATED)
+async def device_binary_update(
+    request: Request,
+    token: str = Depends(verify_device_token),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Compact binary ingest for constrained trackers
+    
+    Body (Content-Type: application/vnd.fleet.positions): one or more
+    records of a header (device id, sample count) plus fixed-width samples,
+    see app/binary.py. Stored like a gateway batch.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type != BINARY_CONTENT_TYPE:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Expected Content-Type {BINARY_CONTENT_TYPE}"
+        )
+    
+    try:
+        fixes, errors = decode_fixes(await request.body())
+    except BinaryFormatError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    samples = len(fixes) + len(errors)
+    if not samples:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No samples in body"
+        )
+    if samples > GATEWAY_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {GATEWAY_BATCH_MAX_ITEMS} samples per batch"
+        )
+    
+    vehicle_ids = await device_resolver.aresolve_many(db, {fix[0] for fix in fixes})
+    fixes = reject_unknown_devices(fixes, errors, vehicle_ids)
+    
+    rows = await store_batch(db, fixes, vehicle_ids)
+    
+    return {
+        "status": "success" if not errors else "partial",
+        "count": len(rows),
+        "duplicates": len(fixes) - len(rows),
+        "rejected": len(errors),
+        "vehicles": vehicle_ids,
+        "errors": errors
+    }
+
+
+# ==================== WEBSOCKET ENDPOINT ====================
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """WebSocket endpoint for real-time updates"""
+    await manager.connect(websocket)
+    try:
+        while True:
+            # Receive messages from client
+            data = await websocket.receive_json()
+            
+            # Handle different message types
+            if data.get("type") == "subscribe":
+                vehicle_id = data.get("vehicle_id")
+                if vehicle_id:
+                    manager.subscribe_to_vehicle(vehicle_id, websocket)
+                    await manager.send_personal_message({
+                        "type": "subscribed",
+                        "vehicle_id": vehicle_id
+                    }, websocket)
+            
+            elif data.get("type") == "subscribe_bbox":
+                # Map viewport: {"type": "subscribe_bbox", "bbox": [south, west, north, east]}
+                try:
+                    bbox = parse_bbox(data.get("bbox"))
+                except (TypeError, ValueError) as e:
+                    await manager.send_personal_message({
+                        "type": "error",
+                        "message": f"Invalid bbox: {e}"
+                    }, websocket)
+                    continue
+                manager.subscribe_to_bbox(bbox, websocket)
+                await manager.send_personal_message({
+                    "type": "subscribed_bbox",
+                    "bbox": list(bbox)
+                }, websocket)
+            
+            elif data.get("type") == "unsubscribe_bbox":
+                manager.unsubscribe_bbox(websocket)
+            
+            elif data.get("type") == "subscribe_stats":
+                # Current stats now, then again whenever they change
+                manager.subscribe_stats(websocket)
+                await manager.send_personal_message({
+                    "type": "fleet_stats",
+                    "data": fleet_stats.snapshot()
+                }, websocket)
+            
+            elif data.get("type") == "unsubscribe_stats":
+                manager.unsubscribe_stats(websocket)
+            
+            elif data.get("type") == "ping":
+                await manager.send_personal_message({"type": "pong"}, websocket)
+                
+    except WebSocketDisconnect:
+        manager.disconnect(websocket)
+    except Exception as e:
+        print(f"WebSocket error: {e}")
         manager.disconnect(websocket)
\ No newline at end of file
@@ -0,0 +1,435 @@
+"""
+Compressed per-vehicle track segments.
+
+Positions older than TRACK_SEGMENT_AFTER_HOURS can be packed into
+TrackSegment rows, one per vehicle per closed UTC window
+(TRACK_SEGMENT_WINDOW_HOURS), and removed from positions. History pages,
+exports, the last-position store and rollup backfills merge segments with
+the remaining raw rows, so callers see one ordered track.
+
+Segment data (version 1), zlib-compressed:
+    u32 count n
+    5 columns: id, recorded_at (microseconds since epoch), lat * 1e7,
+    lng * 1e7, speed * 10, each as
+        i64 first value, u8 delta width w (1, 2, 4 or 8),
+        (n - 1) little-endian signed deltas of w bytes
+Coordinates keep 1e-7 degrees (~1 cm) and speed 0.1 km/h, as in the binary
+ingest format.
+
+Run `python -m app.segments compact --older-than-hours 48` by hand, or set
+TRACK_SEGMENT_AFTER_HOURS to compact periodically from the app.
+"""
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from sqlalchemy import delete, func, insert
+from sqlalchemy.orm import Session
+from . import models
+from .binary import COORD_SCALE, SPEED_SCALE
+import argparse
+import asyncio
+import heapq
+import os
+import struct
+import time
+import zlib
+import numpy as np
+
+# Compact windows that closed more than this many hours ago (0 = never)
+TRACK_SEGMENT_AFTER_HOURS = float(os.getenv("TRACK_SEGMENT_AFTER_HOURS", 0))
+
+# Length of the UTC window packed into one segment (a divisor of 24)
+TRACK_SEGMENT_WINDOW_HOURS = int(os.getenv("TRACK_SEGMENT_WINDOW_HOURS", 24))
+
+# Larger windows are split into several segments
+TRACK_SEGMENT_MAX_POINTS = int(os.getenv("TRACK_SEGMENT_MAX_POINTS", 50000))
+
+TRACK_SEGMENT_INTERVAL_SECONDS = int(os.getenv("TRACK_SEGMENT_INTERVAL_SECONDS", 3600))
+
+SEGMENT_VERSION = 1
+
+# (id, vehicle_id, lat, lng, speed, recorded_at), as HISTORY_COLUMNS / exports
+TrackRow = Tuple[int, int, float, float, float, datetime]
+
+_COUNT = struct.Struct("<I")
+_COLUMN = struct.Struct("<qB")
+_WIDTHS = ((1, "<i1"), (2, "<i2"), (4, "<i4"), (8, "<i8"))
+_DTYPES = dict(_WIDTHS)
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+# Delete positions in chunks (SQLite limits bound parameters per statement)
+_DELETE_CHUNK = 500
+
+
+# ==================== ENCODING ====================
+
+def _encode_column(values: np.ndarray) -> bytes:
+    deltas = np.diff(values)
+    span = int(np.abs(deltas).max()) if len(deltas) else 0
+    for width, dtype in _WIDTHS:
+        if span < 1 << (8 * width - 1):
+            break
+    return _COLUMN.pack(int(values[0]), width) + deltas.astype(dtype).tobytes()
+
+
+def _decode_column(view: memoryview, offset: int, count: int) -> Tuple[np.ndarray, int]:
+    first, width = _COLUMN.unpack_from(view, offset)
+    offset += _COLUMN.size
+    if width not in _DTYPES:
+        raise ValueError(f"Bad segment column width {width}")
+    deltas = np.frombuffer(view, dtype=_DTYPES[width], count=count - 1, offset=offset)
+    column = np.empty(count, dtype=np.int64)
+    column[0] = first
+    np.cumsum(deltas, out=column[1:])
+    column[1:] += first
+    return column, offset + width * (count - 1)
+
+
+def encode_segment(rows: Sequence[TrackRow]) -> bytes:
+    """Pack rows (ordered by recorded_at, id) into segment data"""
+    if not rows:
+        raise ValueError("Empty segment")
+    ids, _, lats, lngs, speeds, times = zip(*rows)
+    columns = (
+        np.asarray(ids, dtype=np.int64),
+        np.asarray([(t - _EPOCH) // _MICROSECOND for t in times], dtype=np.int64),
+        np.rint(np.asarray(lats, dtype=float) * COORD_SCALE).astype(np.int64),
+        np.rint(np.asarray(lngs, dtype=float) * COORD_SCALE).astype(np.int64),
+        np.rint(np.asarray([s or 0.0 for s in speeds], dtype=float) * SPEED_SCALE).astype(np.int64),
+    )
+    body = _COUNT.pack(len(rows)) + b"".join(_encode_column(column) for column in columns)
+    return zlib.compress(body, 6)
+
+
+def decode_segment(data: bytes) -> Dict[str, np.ndarray]:
+    """Segment data -> arrays id, recorded_at (datetime64[us]), lat, lng, speed"""
+    view = memoryview(zlib.decompress(data))
+    (count,) = _COUNT.unpack_from(view)
+    offset = _COUNT.size
+    columns = []
+    for _ in range(5):
+        column, offset = _decode_column(view, offset, count)
+        columns.append(column)
+    ids, micros, lats, lngs, speeds = columns
+    return {
+        "id": ids,
+        "recorded_at": micros.astype("datetime64[us]"),
+        "lat": lats / COORD_SCALE,
+        "lng": lngs / COORD_SCALE,
+        "speed": speeds / SPEED_SCALE,
+    }
+
+
+def segment_rows(
+    segment: models.TrackSegment,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None
+) -> List[TrackRow]:
+    """Rows of a segment within [from_time, to_time], oldest first"""
+    columns = decode_segment(segment.data)
+    times = columns["recorded_at"]
+    lo = 0 if from_time is None else int(np.searchsorted(times, np.datetime64(from_time, "us"), "left"))
+    hi = len(times) if to_time is None else int(np.searchsorted(times, np.datetime64(to_time, "us"), "right"))
+    vehicle_id = segment.vehicle_id
+    return list(zip(
+        columns["id"][lo:hi].tolist(),
+        [vehicle_id] * (hi - lo),
+        columns["lat"][lo:hi].tolist(),
+        columns["lng"][lo:hi].tolist(),
+        columns["speed"][lo:hi].tolist(),
+        times[lo:hi].astype(object).tolist()
+    ))
+
+
+# ==================== READING ====================
+
+def _segments_query(db: Session, vehicle_ids, from_time, to_time):
+    query = db.query(models.TrackSegment)
+    if vehicle_ids is not None:
+        query = query.filter(models.TrackSegment.vehicle_id.in_(list(vehicle_ids)))
+    if from_time is not None:
+        query = query.filter(models.TrackSegment.end_at >= from_time)
+    if to_time is not None:
+        query = query.filter(models.TrackSegment.start_at <= to_time)
+    return query
+
+
+def merge_history(
+    db: Session,
+    vehicle_id: int,
+    rows: Sequence[TrackRow],
+    count: int,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+    before: Optional[Tuple[datetime, int]] = None
+) -> List[TrackRow]:
+    """
+    The newest count rows of a vehicle's track, newest first.
+
+    rows are the newest (at most count) matching rows from positions;
+    segments are decoded newest first and only until none of the remaining
+    ones can reach the page. before=(recorded_at, id) is the exclusive
+    keyset bound of a cursor.
+    """
+    upper = to_time
+    if before is not None and (upper is None or before[0] < upper):
+        upper = before[0]
+    segments = (
+        _segments_query(db, (vehicle_id,), from_time, upper)
+        .order_by(models.TrackSegment.end_at.desc())
+    )
+
+    merged = [tuple(row) for row in rows]
+    floor = merged[-1][5] if len(merged) >= count else None
+    for segment in segments.yield_per(16):
+        if floor is not None and segment.end_at < floor:
+            break
+        points = segment_rows(segment, from_time, upper)
+        if before is not None:
+            points = [p for p in points if (p[5], p[0]) < before]
+        if not points:
+            continue
+        merged.extend(points)
+        merged.sort(key=lambda r: (r[5], r[0]), reverse=True)
+        del merged[count:]
+        if len(merged) >= count:
+            floor = merged[-1][5]
+    return merged
+
+
+def has_segments(
+    db: Session,
+    vehicle_ids: Optional[Iterable[int]] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None
+) -> bool:
+    return db.query(_segments_query(db, vehicle_ids, from_time, to_time).exists()).scalar()
+
+
+def iter_segment_points(
+    db: Session,
+    vehicle_ids: Optional[Iterable[int]] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None
+) -> Iterator[TrackRow]:
+    """Segment rows in (vehicle_id, recorded_at, id) order"""
+    segments = (
+        _segments_query(db, vehicle_ids, from_time, to_time)
+        .order_by(models.TrackSegment.vehicle_id, models.TrackSegment.start_at)
+        .yield_per(16)
+    )
+    # Segments of one vehicle may overlap (a late fix compacted later), so
+    # rows are only final once the next segment starts after them
+    pending: List[TrackRow] = []
+    keys: List[tuple] = []
+    for segment in segments:
+        cut = bisect_left(keys, (segment.vehicle_id, segment.start_at))
+        yield from pending[:cut]
+        rows = segment_rows(segment, from_time, to_time)
+        pending = pending[cut:]
+        pending = sorted(pending + rows, key=lambda r: (r[1], r[5], r[0])) if pending else rows
+        keys = [(r[1], r[5], r[0]) for r in pending]
+    yield from pending
+
+
+def segment_key(vehicle_id: int, recorded_at: datetime, lat: float, lng: float) -> tuple:
+    """A fix's identity at segment precision (coordinates in 1e-7 degrees)"""
+    return vehicle_id, recorded_at, round(lat * COORD_SCALE), round(lng * COORD_SCALE)
+
+
+def compacted_fixes(db: Session, rows: Sequence[dict]) -> set:
+    """
+    segment_key()s of the position rows that are already packed into a
+    segment. Rows in the still-open window cannot have been compacted, so
+    live traffic costs no query; late and imported fixes cost one.
+    """
+    open_from = window_start(datetime.utcnow())
+    stale = [row for row in rows if row["recorded_at"] < open_from]
+    if not stale:
+        return set()
+    wanted = {segment_key(r["vehicle_id"], r["recorded_at"], r["lat"], r["lng"]) for r in stale}
+    from_time = min(row["recorded_at"] for row in stale)
+    to_time = max(row["recorded_at"] for row in stale)
+    found = set()
+    segments = _segments_query(db, {row["vehicle_id"] for row in stale}, from_time, to_time)
+    for segment in segments.yield_per(16):
+        for _, vehicle_id, lat, lng, _, recorded_at in segment_rows(segment, from_time, to_time):
+            key = segment_key(vehicle_id, recorded_at, lat, lng)
+            if key in wanted:
+                found.add(key)
+    return found
+
+
+def merge_tracks(raw: Iterable[TrackRow], points: Iterable[TrackRow]) -> Iterator[TrackRow]:
+    """Merge two streams ordered by (vehicle_id, recorded_at, id)"""
+    return heapq.merge(raw, points, key=lambda r: (r[1], r[5], r[0]))
+
+
+def latest_points(db: Session) -> Dict[int, TrackRow]:
+    """Newest compressed row per vehicle"""
+    newest = (
+        db.query(
+            models.TrackSegment.vehicle_id,
+            func.max(models.TrackSegment.end_at).label("end_at")
+        )
+        .group_by(models.TrackSegment.vehicle_id)
+        .subquery()
+    )
+    segments = db.query(models.TrackSegment).join(
+        newest,
+        (models.TrackSegment.vehicle_id == newest.c.vehicle_id) &
+        (models.TrackSegment.end_at == newest.c.end_at)
+    )
+    latest = {}
+    for segment in segments:
+        row = segment_rows(segment)[-1]
+        current = latest.get(segment.vehicle_id)
+        if current is None or (row[5], row[0]) > (current[5], current[0]):
+            latest[segment.vehicle_id] = row
+    return latest
+
+
+# ==================== COMPACTION ====================
+
+def window_start(value: datetime, hours: int = TRACK_SEGMENT_WINDOW_HOURS) -> datetime:
+    day = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day + timedelta(hours=(value.hour // hours) * hours)
+
+
+def _store_segment(db: Session, vehicle_id: int, rows: List[TrackRow]) -> int:
+    data = encode_segment(rows)
+    db.execute(insert(models.TrackSegment), [{
+        "vehicle_id": vehicle_id,
+        "start_at": rows[0][5],
+        "end_at": rows[-1][5],
+        "point_count": len(rows),
+        "version": SEGMENT_VERSION,
+        "data": data
+    }])
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), _DELETE_CHUNK):
+        db.execute(delete(models.Position).where(models.Position.id.in_(ids[i:i + _DELETE_CHUNK])))
+    return len(data)
+
+
+def compact_positions(
+    db: Session,
+    before: datetime,
+    vehicle_ids: Optional[List[int]] = None,
+    window_hours: int = TRACK_SEGMENT_WINDOW_HOURS,
+    max_points: int = TRACK_SEGMENT_MAX_POINTS
+) -> dict:
+    """
+    Pack positions in windows that closed before `before` into segments,
+    one vehicle (one transaction) at a time. Returns counts and byte sizes.
+    """
+    cutoff = window_start(before, window_hours)
+    if vehicle_ids is None:
+        vehicle_ids = [
+            vid for (vid,) in
+            db.query(models.Position.vehicle_id)
+            .filter(models.Position.recorded_at < cutoff)
+            .distinct()
+        ]
+
+    stats = {"vehicles": 0, "segments": 0, "positions": 0, "bytes": 0, "compacted_vehicles": []}
+    for vehicle_id in vehicle_ids:
+        query = (
+            db.query(
+                models.Position.id,
+                models.Position.vehicle_id,
+                models.Position.lat,
+                models.Position.lng,
+                models.Position.speed,
+                models.Position.recorded_at
+            )
+            .filter(models.Position.vehicle_id == vehicle_id, models.Position.recorded_at < cutoff)
+            .order_by(models.Position.recorded_at, models.Position.id)
+            .limit(max_points)
+        )
+        packed = 0
+        # At most max_points rows in memory; each batch is one transaction
+        while True:
+            rows = [tuple(row) for row in query.all()]
+            if not rows:
+                break
+            windows = []
+            for row in rows:
+                row_window = window_start(row[5], window_hours)
+                if not windows or windows[-1][0] != row_window:
+                    windows.append((row_window, []))
+                windows[-1][1].append(row)
+            # A full batch may stop mid-window; leave that window for the next one
+            if len(rows) == max_points and len(windows) > 1:
+                windows.pop()
+            for _, window_rows in windows:
+                stats["bytes"] += _store_segment(db, vehicle_id, window_rows)
+                stats["segments"] += 1
+                packed += len(window_rows)
+            db.commit()
+            if len(rows) < max_points:
+                break
+
+        if packed:
+            stats["vehicles"] += 1
+            stats["positions"] += packed
+            stats["compacted_vehicles"].append(vehicle_id)
+    return stats
+
+
+def run_compaction(before: Optional[datetime] = None) -> dict:
+    """One compaction pass in its own session (for the app's periodic task)"""
+    from .cache import response_cache, positions_tag
+    from .db import SessionLocal
+
+    if before is None:
+        before = datetime.utcnow() - timedelta(hours=TRACK_SEGMENT_AFTER_HOURS)
+    db = SessionLocal()
+    try:
+        stats = compact_positions(db, before)
+    finally:
+        db.close()
+    # Compressed values are rounded, so cached pages would differ slightly
+    if stats["compacted_vehicles"]:
+        response_cache.invalidate_soon(*(positions_tag(vid) for vid in stats["compacted_vehicles"]))
+    return stats
+
+
+async def compaction_loop():
+    """Run compaction every TRACK_SEGMENT_INTERVAL_SECONDS (started by the app)"""
+    while True:
+        try:
+            started = time.perf_counter()
+            stats = await asyncio.to_thread(run_compaction)
+            if stats["positions"]:
+                print(f"Track segments: packed {stats['positions']} positions into {stats['segments']} "
+                      f"segments in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            print(f"Track segments: compaction failed: {e}")
+        await asyncio.sleep(TRACK_SEGMENT_INTERVAL_SECONDS)
+
+
+def main():
+    from .db import SessionLocal, engine as db_engine
+
+    parser = argparse.ArgumentParser(description="Compress old positions into track segments")
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("--older-than-hours", type=float, default=TRACK_SEGMENT_AFTER_HOURS or 48)
+    parser.add_argument("--vehicle", type=int, action="append", help="Limit to vehicle id (repeatable)")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=db_engine)
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        stats = compact_positions(db, datetime.utcnow() - timedelta(hours=args.older_than_hours), args.vehicle)
+        print(f"Packed {stats['positions']} positions of {stats['vehicles']} vehicles into "
+              f"{stats['segments']} segments ({stats['bytes'] / 1024:.0f} KiB) "
+              f"in {time.perf_counter() - started:.1f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
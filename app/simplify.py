@@ -0,0 +1,94 @@
+"""
+Server-side track simplification (Douglas-Peucker on NumPy arrays).
+
+Points are projected to local metres so the tolerance is a distance on
+the ground. Points where the speed changes sharply are always kept and
+split the track, so stops and accelerations survive simplification.
+"""
+from typing import Optional
+import math
+import numpy as np
+
+# Metres per pixel at zoom 0 on the equator (256px Web Mercator tiles)
+_METRES_PER_PIXEL_Z0 = 156543.03392
+
+# Speed jumps (km/h) between consecutive points that are always kept
+SPEED_CHANGE_KMH = 15.0
+
+_METRES_PER_DEG_LAT = 110540.0
+_METRES_PER_DEG_LNG = 111320.0
+
+
+def tolerance_for_zoom(zoom: int, pixels: float = 1.0) -> float:
+    """Tolerance in metres that is about `pixels` wide at a map zoom level"""
+    return _METRES_PER_PIXEL_Z0 / (2 ** zoom) * pixels
+
+
+def _project(lat: np.ndarray, lng: np.ndarray):
+    """Equirectangular projection to metres around the track's mean latitude"""
+    cos_lat = math.cos(math.radians(float(np.mean(lat))))
+    return lng * (_METRES_PER_DEG_LNG * cos_lat), lat * _METRES_PER_DEG_LAT
+
+
+def simplify_mask(
+    lat: np.ndarray,
+    lng: np.ndarray,
+    tolerance: float,
+    speed: Optional[np.ndarray] = None,
+    speed_change: float = SPEED_CHANGE_KMH
+) -> np.ndarray:
+    """
+    Boolean mask of the points to keep.
+
+    Douglas-Peucker with an explicit stack; each segment's farthest point is
+    found with one vectorized distance computation over its interior.
+    """
+    n = len(lat)
+    keep = np.zeros(n, dtype=bool)
+    if n <= 2:
+        keep[:] = True
+        return keep
+
+    x, y = _project(np.asarray(lat, dtype=float), np.asarray(lng, dtype=float))
+
+    # Anchors: endpoints plus every sharp speed change
+    anchors = [0, n - 1]
+    if speed is not None and speed_change > 0:
+        speed = np.asarray(speed, dtype=float)
+        jumps = np.nonzero(np.abs(np.diff(speed)) >= speed_change)[0]
+        # Keep both sides of each jump
+        anchors.extend(jumps.tolist())
+        anchors.extend((jumps + 1).tolist())
+    anchors = sorted(set(anchors))
+    keep[anchors] = True
+
+    stack = [(a, b) for a, b in zip(anchors[:-1], anchors[1:]) if b - a > 1]
+    tolerance_sq = tolerance * tolerance
+
+    while stack:
+        start, end = stack.pop()
+        x0, y0 = x[start], y[start]
+        dx, dy = x[end] - x0, y[end] - y0
+        px = x[start + 1:end] - x0
+        py = y[start + 1:end] - y0
+
+        seg_len_sq = dx * dx + dy * dy
+        if seg_len_sq == 0.0:
+            dist_sq = px * px + py * py
+        else:
+            # Distance to the segment (clamped projection), squared
+            t = np.clip((px * dx + py * dy) / seg_len_sq, 0.0, 1.0)
+            ex = px - t * dx
+            ey = py - t * dy
+            dist_sq = ex * ex + ey * ey
+
+        i = int(np.argmax(dist_sq))
+        if dist_sq[i] > tolerance_sq:
+            split = start + 1 + i
+            keep[split] = True
+            if split - start > 1:
+                stack.append((start, split))
+            if end - split > 1:
+                stack.append((split, end))
+
+    return keep
@@ -0,0 +1,355 @@
+"""
+Raw TCP/UDP listener for hardware trackers that cannot speak HTTPS.
+
+Runs on the app's event loop next to FastAPI (asyncio Protocols, no HTTP
+parsing) and feeds fixes into the same resolver and ingest path as
+/device/position.
+
+Frames (little-endian):
+    u16 length of the rest, u8 type, payload
+
+TCP, one device per connection:
+    LOGIN      0x01  device_id (UTF-8)             -> ACK 0x81 u8 status
+    DATA       0x02  u16 seq + packed samples      -> ACK 0x82 u16 seq + u8 status
+    HEARTBEAT  0x03  (empty)                       -> ACK 0x83 u8 status
+UDP, one frame per datagram (no login):
+    DATA_UDP   0x04  u8 id length + device_id + u16 seq + packed samples
+                                                   -> ACK 0x82 u16 seq + u8 status
+Samples use the 14-byte layout of app/binary.py. A DATA frame is ACKed once
+its fixes are stored, so trackers can retransmit anything left unacked.
+"""
+from collections import deque
+from typing import Optional
+from .binary import SAMPLE_SIZE, unpack_samples
+from .db import AsyncSessionLocal
+from .ingest import ingest_pipeline, ingest_positions
+from .resolver import device_resolver
+import asyncio
+import os
+import socket
+import struct
+
+TRACKER_HOST = os.getenv("TRACKER_HOST", "0.0.0.0")
+TRACKER_TCP_PORT = int(os.getenv("TRACKER_TCP_PORT", 0))
+TRACKER_UDP_PORT = int(os.getenv("TRACKER_UDP_PORT", 0))
+
+# Connections silent for this long are closed
+TRACKER_IDLE_TIMEOUT = float(os.getenv("TRACKER_IDLE_TIMEOUT", 300))
+
+# Frames buffered per connection before reading is paused
+TRACKER_MAX_PENDING_FRAMES = int(os.getenv("TRACKER_MAX_PENDING_FRAMES", 32))
+
+# UDP datagrams being handled at once; above this they are dropped unacked
+# (the tracker retransmits) instead of piling up as tasks
+TRACKER_UDP_MAX_INFLIGHT = int(os.getenv("TRACKER_UDP_MAX_INFLIGHT", 1024))
+
+# Receive buffer for the UDP socket, so bursts are not dropped by the kernel
+TRACKER_UDP_RCVBUF = int(os.getenv("TRACKER_UDP_RCVBUF", 4 * 1024 * 1024))
+
+# Concurrent database sessions used by the listeners (keep below the pool size)
+TRACKER_DB_CONCURRENCY = int(os.getenv("TRACKER_DB_CONCURRENCY", 8))
+
+FRAME_LOGIN = 0x01
+FRAME_DATA = 0x02
+FRAME_HEARTBEAT = 0x03
+FRAME_DATA_UDP = 0x04
+ACK_FLAG = 0x80
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_NOT_LOGGED_IN = 2
+
+_FRAME_HEADER = struct.Struct("<HB")
+_SEQ = struct.Struct("<H")
+
+
+def encode_frame(frame_type: int, payload: bytes = b"") -> bytes:
+    return _FRAME_HEADER.pack(len(payload) + 1, frame_type) + payload
+
+
+def parse_device_id(raw) -> str:
+    """Device id sent by a tracker (LOGIN or DATA_UDP), stripped and non-empty"""
+    device_id = str(raw, "utf-8").strip()
+    if not device_id:
+        raise ValueError("empty device id")
+    return device_id
+
+
+def ack_frame(frame_type: int, status: int, seq: Optional[int] = None) -> bytes:
+    payload = bytes([status]) if seq is None else _SEQ.pack(seq) + bytes([status])
+    return encode_frame(frame_type | ACK_FLAG, payload)
+
+
+_db_slots: Optional[asyncio.Semaphore] = None
+
+
+def _db_slot() -> asyncio.Semaphore:
+    """Bounds sessions opened by thousands of connections at once"""
+    global _db_slots
+    # Created lazily so it belongs to the running event loop
+    if _db_slots is None:
+        _db_slots = asyncio.Semaphore(TRACKER_DB_CONCURRENCY)
+    return _db_slots
+
+
+async def resolve_device(device_id: str) -> int:
+    """Vehicle id for a device, opening a session only on a cache miss"""
+    vehicle_id = device_resolver.get(device_id)
+    if vehicle_id is None:
+        async with _db_slot():
+            async with AsyncSessionLocal() as db:
+                vehicle_id = await device_resolver.aresolve(db, device_id)
+    if vehicle_id is None:
+        raise LookupError(f"unknown device {device_id}")
+    return vehicle_id
+
+
+async def store_samples(device_id: str, vehicle_id: int, samples: memoryview) -> int:
+    """Store packed samples for one vehicle; returns the number stored"""
+    if len(samples) % SAMPLE_SIZE:
+        raise ValueError("DATA payload is not a whole number of samples")
+    rows = [
+        {
+            "vehicle_id": vehicle_id,
+            "lat": fix[1],
+            "lng": fix[2],
+            "speed": fix[3],
+            "recorded_at": fix[4]
+        }
+        for fix in unpack_samples(device_id, samples) if fix is not None
+    ]
+    if ingest_pipeline.running:
+        # The pipeline batches across connections and bounds its own writes
+        await ingest_positions(rows)
+    else:
+        async with _db_slot():
+            await ingest_positions(rows)
+    return len(rows)
+
+
+class TrackerStats:
+    __slots__ = ("connections", "frames", "fixes", "errors", "dropped")
+
+    def __init__(self):
+        self.connections = 0
+        self.frames = 0
+        self.fixes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class TrackerProtocol(asyncio.Protocol):
+    """One TCP tracker connection: framing, login state and ACKs"""
+
+    def __init__(self, server: "TrackerServer"):
+        self.server = server
+        self.transport: Optional[asyncio.Transport] = None
+        self.device_id: Optional[str] = None
+        self.vehicle_id: Optional[int] = None
+        self._buffer = bytearray()
+        self._frames: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._idle: Optional[asyncio.TimerHandle] = None
+        self._paused = False
+        self._closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.stats.connections += 1
+        self.server.connections.add(self)
+        self._worker = asyncio.create_task(self._process())
+        self._touch()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self.server.stats.connections -= 1
+        self.server.connections.discard(self)
+        if self._idle is not None:
+            self._idle.cancel()
+        self._wakeup.set()
+
+    def _touch(self):
+        if self._idle is not None:
+            self._idle.cancel()
+        self._idle = asyncio.get_running_loop().call_later(
+            TRACKER_IDLE_TIMEOUT, self.transport.close
+        )
+
+    def data_received(self, data: bytes):
+        self._touch()
+        self._buffer.extend(data)
+        offset = 0
+        while len(self._buffer) - offset >= _FRAME_HEADER.size:
+            length, frame_type = _FRAME_HEADER.unpack_from(self._buffer, offset)
+            if length == 0:
+                self.server.stats.errors += 1
+                self.transport.close()
+                return
+            end = offset + 2 + length
+            if end > len(self._buffer):
+                break
+            self._frames.append((frame_type, bytes(self._buffer[offset + 3:end])))
+            offset = end
+        if offset:
+            del self._buffer[:offset]
+
+        if self._frames:
+            self._wakeup.set()
+            # Backpressure: stop reading while the writer catches up
+            if len(self._frames) >= TRACKER_MAX_PENDING_FRAMES and not self._paused:
+                self._paused = True
+                self.transport.pause_reading()
+
+    async def _process(self):
+        """Handle frames in order, one at a time"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self._frames and not self._closed:
+                frame_type, payload = self._frames.popleft()
+                if self._paused and len(self._frames) < TRACKER_MAX_PENDING_FRAMES // 2:
+                    self._paused = False
+                    self.transport.resume_reading()
+                self.server.stats.frames += 1
+                reply = await self._handle(frame_type, payload)
+                if reply is not None and not self._closed:
+                    self.transport.write(reply)
+            if self._closed:
+                return
+
+    async def _handle(self, frame_type: int, payload: bytes) -> Optional[bytes]:
+        if frame_type == FRAME_LOGIN:
+            try:
+                device_id = parse_device_id(payload)
+                self.vehicle_id = await resolve_device(device_id)
+            except Exception as e:
+                return self._error(FRAME_LOGIN, e)
+            self.device_id = device_id
+            return ack_frame(FRAME_LOGIN, STATUS_OK)
+
+        if frame_type == FRAME_DATA:
+            if len(payload) < _SEQ.size:
+                self.server.stats.errors += 1
+                return None
+            (seq,) = _SEQ.unpack_from(payload)
+            if self.vehicle_id is None:
+                return ack_frame(FRAME_DATA, STATUS_NOT_LOGGED_IN, seq)
+            try:
+                stored = await store_samples(
+                    self.device_id, self.vehicle_id, memoryview(payload)[_SEQ.size:]
+                )
+            except Exception as e:
+                return self._error(FRAME_DATA, e, seq)
+            self.server.stats.fixes += stored
+            return ack_frame(FRAME_DATA, STATUS_OK, seq)
+
+        if frame_type == FRAME_HEARTBEAT:
+            return ack_frame(FRAME_HEARTBEAT, STATUS_OK)
+
+        self.server.stats.errors += 1
+        return None
+
+    def _error(self, frame_type: int, error: Exception, seq: Optional[int] = None) -> bytes:
+        print(f"Tracker {self.device_id or 'unknown'}: error handling frame: {error}")
+        self.server.stats.errors += 1
+        return ack_frame(frame_type, STATUS_ERROR, seq)
+
+
+class TrackerDatagramProtocol(asyncio.DatagramProtocol):
+    """UDP trackers: each datagram is a self-contained DATA_UDP frame"""
+
+    def __init__(self, server: "TrackerServer", max_in_flight: int = TRACKER_UDP_MAX_INFLIGHT):
+        self.server = server
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        self.server.stats.frames += 1
+        if self.in_flight >= self.max_in_flight:
+            # Left unacked, so the tracker resends it once we have caught up
+            self.server.stats.dropped += 1
+            return
+        self.in_flight += 1
+        task = asyncio.create_task(self._handle(data, addr))
+        self.server.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self.in_flight -= 1
+        self.server.tasks.discard(task)
+
+    async def _handle(self, data: bytes, addr):
+        view = memoryview(data)
+        seq = None
+        try:
+            length, frame_type = _FRAME_HEADER.unpack_from(view)
+            if frame_type != FRAME_DATA_UDP or length + 2 != len(data):
+                raise ValueError("Not a DATA_UDP frame")
+            id_len = view[3]
+            (seq,) = _SEQ.unpack_from(view, 4 + id_len)
+            device_id = parse_device_id(view[4:4 + id_len])
+            vehicle_id = await resolve_device(device_id)
+            stored = await store_samples(device_id, vehicle_id, view[4 + id_len + _SEQ.size:])
+            self.server.stats.fixes += stored
+            status = STATUS_OK
+        except Exception as e:
+            print(f"Tracker datagram from {addr[0]}: {e}")
+            self.server.stats.errors += 1
+            if seq is None:
+                return
+            status = STATUS_ERROR
+        self.transport.sendto(ack_frame(FRAME_DATA, status, seq), addr)
+
+
+class TrackerServer:
+    """TCP and/or UDP listeners sharing the app's event loop"""
+
+    def __init__(self):
+        self.stats = TrackerStats()
+        self.connections = set()
+        self.tasks = set()
+        self._tcp: Optional[asyncio.AbstractServer] = None
+        self._udp: Optional[asyncio.DatagramTransport] = None
+
+    @property
+    def running(self) -> bool:
+        return self._tcp is not None or self._udp is not None
+
+    async def start(self, host: str = TRACKER_HOST, tcp_port: int = TRACKER_TCP_PORT, udp_port: int = TRACKER_UDP_PORT):
+        loop = asyncio.get_running_loop()
+        if tcp_port and self._tcp is None:
+            self._tcp = await loop.create_server(lambda: TrackerProtocol(self), host, tcp_port, backlog=4096)
+            print(f"Tracker TCP listener on {host}:{tcp_port}")
+        if udp_port and self._udp is None:
+            self._udp, _ = await loop.create_datagram_endpoint(
+                lambda: TrackerDatagramProtocol(self), local_addr=(host, udp_port)
+            )
+            sock = self._udp.get_extra_info("socket")
+            if sock is not None and TRACKER_UDP_RCVBUF:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TRACKER_UDP_RCVBUF)
+            print(f"Tracker UDP listener on {host}:{udp_port}")
+
+    async def stop(self):
+        if self._tcp is not None:
+            self._tcp.close()
+            for connection in list(self.connections):
+                connection.transport.close()
+            await self._tcp.wait_closed()
+            self._tcp = None
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        print("Tracker listeners stopped")
+
+
+tracker_server = TrackerServer()
@@ -0,0 +1,251 @@
+"""
+Incremental trip/stop segmentation.
+
+Each ingested position advances a small per-vehicle state machine:
+running haversine distance, moving vs stopped, and trip start/end by speed
+and dwell thresholds. Finished trips are returned so the caller can persist
+them in the same transaction as the positions. If that transaction does not
+commit, the vehicles' states are put back so a retried batch is seen again.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+from . import models
+import math
+import os
+import threading
+
+# At or above this speed (km/h) a vehicle counts as moving
+TRIP_MOVING_SPEED_KMH = float(os.getenv("TRIP_MOVING_SPEED_KMH", 5))
+
+# A trip ends after the vehicle has been stopped this long
+TRIP_STOP_DWELL_SECONDS = int(os.getenv("TRIP_STOP_DWELL_SECONDS", 300))
+
+# Trips shorter than this are discarded as GPS jitter
+TRIP_MIN_DISTANCE_KM = float(os.getenv("TRIP_MIN_DISTANCE_KM", 0.2))
+
+# Gaps between fixes longer than this are capped when summing moving time
+TRIP_MAX_GAP_SECONDS = float(os.getenv("TRIP_MAX_GAP_SECONDS", 300))
+
+_EARTH_RADIUS_KM = 6371.0088
+
+# Session.info key of the trip states to restore if the transaction does not commit
+_UNDO_KEY = "trip_undo"
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class VehicleTripState:
+    """Per-vehicle segmentation state"""
+    __slots__ = ("last", "moving", "stopped_since", "trip")
+
+    def __init__(self):
+        self.last: Optional[dict] = None
+        self.moving = False
+        self.stopped_since: Optional[datetime] = None
+        self.trip: Optional[dict] = None
+
+    def copy(self) -> "VehicleTripState":
+        state = VehicleTripState()
+        state.last = self.last
+        state.moving = self.moving
+        state.stopped_since = self.stopped_since
+        state.trip = dict(self.trip) if self.trip is not None else None
+        return state
+
+
+class TripEngine:
+    def __init__(
+        self,
+        moving_speed: float = TRIP_MOVING_SPEED_KMH,
+        stop_dwell_seconds: int = TRIP_STOP_DWELL_SECONDS,
+        min_distance_km: float = TRIP_MIN_DISTANCE_KM
+    ):
+        self.moving_speed = moving_speed
+        self.stop_dwell = timedelta(seconds=stop_dwell_seconds)
+        self.min_distance_km = min_distance_km
+        self._states: Dict[int, VehicleTripState] = {}
+        self._lock = threading.Lock()
+
+    def load(self, last_positions: Dict[int, dict]):
+        """Seed each vehicle's last point (open trips are not recovered)"""
+        with self._lock:
+            for vehicle_id, position in last_positions.items():
+                state = self._states.setdefault(vehicle_id, VehicleTripState())
+                state.last = position
+
+    def forget(self, vehicle_id: int):
+        with self._lock:
+            self._states.pop(vehicle_id, None)
+
+    def is_moving(self, vehicle_id: int) -> bool:
+        state = self._states.get(vehicle_id)
+        return bool(state and state.moving)
+
+    def open_trip(self, vehicle_id: int) -> Optional[dict]:
+        """Copy of the trip in progress for a vehicle, if any"""
+        state = self._states.get(vehicle_id)
+        if state is None or state.trip is None:
+            return None
+        return dict(state.trip)
+
+    def observe_many(
+        self,
+        rows: List[dict],
+        undo: Optional[Dict[int, tuple]] = None
+    ) -> Tuple[List[dict], List[dict]]:
+        """
+        Advance state for rows (any vehicle mix).
+        Returns (finished trips, one step per row) where a step carries the
+        distance and moving time since the vehicle's previous fix.
+        With undo, each vehicle's state is replaced by a copy before it first
+        changes and undo[vehicle_id] = (previous state, copy), for restore().
+        """
+        finished = []
+        steps = []
+        with self._lock:
+            for row in sorted(rows, key=lambda r: r["recorded_at"]):
+                vehicle_id = row["vehicle_id"]
+                if undo is not None and vehicle_id not in undo:
+                    previous = self._states.get(vehicle_id)
+                    current = previous.copy() if previous is not None else VehicleTripState()
+                    self._states[vehicle_id] = current
+                    undo[vehicle_id] = (previous, current)
+                step = {
+                    "vehicle_id": row["vehicle_id"],
+                    "recorded_at": row["recorded_at"],
+                    "speed": row.get("speed") or 0.0,
+                    "distance_km": 0.0,
+                    "moving_seconds": 0.0
+                }
+                trip = self._observe(row, step)
+                steps.append(step)
+                if trip is not None:
+                    finished.append(trip)
+        return finished, steps
+
+    def restore(self, undo: Dict[int, tuple]):
+        """Put back the states saved by observe_many (its rows were not committed)"""
+        with self._lock:
+            for vehicle_id, (previous, current) in undo.items():
+                # A later batch already moved on from this state; keep its result
+                if self._states.get(vehicle_id) is not current:
+                    continue
+                if previous is None:
+                    del self._states[vehicle_id]
+                else:
+                    self._states[vehicle_id] = previous
+
+    def _observe(self, row: dict, step: dict) -> Optional[dict]:
+        state = self._states.get(row["vehicle_id"])
+        if state is None:
+            state = self._states[row["vehicle_id"]] = VehicleTripState()
+
+        last = state.last
+        # Out-of-order fixes do not move the state machine backwards
+        if last is not None and row["recorded_at"] < last["recorded_at"]:
+            return None
+
+        step_km = 0.0
+        seconds = 0.0
+        implied_speed = 0.0
+        if last is not None:
+            step_km = haversine_km(last["lat"], last["lng"], row["lat"], row["lng"])
+            seconds = (row["recorded_at"] - last["recorded_at"]).total_seconds()
+            if seconds > 0:
+                implied_speed = step_km / seconds * 3600
+        state.last = row
+
+        speed = row.get("speed") or 0.0
+        moving = speed >= self.moving_speed or (speed == 0 and implied_speed >= self.moving_speed)
+        state.moving = moving
+
+        step["distance_km"] = step_km
+        if moving and last is not None:
+            # Long reporting gaps are not counted as time on the move
+            step["moving_seconds"] = min(seconds, TRIP_MAX_GAP_SECONDS)
+
+        trip = state.trip
+        if trip is None:
+            if moving:
+                start = last if last is not None else row
+                state.trip = {
+                    "vehicle_id": row["vehicle_id"],
+                    "start_at": start["recorded_at"],
+                    "end_at": row["recorded_at"],
+                    "start_lat": start["lat"],
+                    "start_lng": start["lng"],
+                    "end_lat": row["lat"],
+                    "end_lng": row["lng"],
+                    "distance_km": step_km,
+                    "max_speed": speed,
+                    "point_count": 2 if last is not None else 1
+                }
+                state.stopped_since = None
+            return None
+
+        trip["distance_km"] += step_km
+        trip["point_count"] += 1
+        trip["max_speed"] = max(trip["max_speed"], speed)
+
+        if moving:
+            state.stopped_since = None
+            trip["end_at"] = row["recorded_at"]
+            trip["end_lat"] = row["lat"]
+            trip["end_lng"] = row["lng"]
+            return None
+
+        if state.stopped_since is None:
+            state.stopped_since = row["recorded_at"]
+            trip["end_at"] = row["recorded_at"]
+            trip["end_lat"] = row["lat"]
+            trip["end_lng"] = row["lng"]
+            return None
+
+        if row["recorded_at"] - state.stopped_since < self.stop_dwell:
+            return None
+
+        # Dwell exceeded: the trip ended where the vehicle stopped
+        state.trip = None
+        state.stopped_since = None
+        if trip["distance_km"] < self.min_distance_km:
+            return None
+        return trip
+
+
+def record_trips(db: Session, rows: List[dict]) -> List[dict]:
+    """
+    Feed stored rows to the engine and persist any trips they finish.
+    Returns the per-row steps for other incremental aggregates.
+    The engine changes are undone unless db's transaction commits.
+    """
+    finished, steps = trip_engine.observe_many(rows, db.info.setdefault(_UNDO_KEY, {}))
+    if finished:
+        db.execute(insert(models.Trip), finished)
+    return steps
+
+
+@event.listens_for(Session, "after_commit")
+def _keep_trip_states(session: Session):
+    session.info.pop(_UNDO_KEY, None)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _undo_trip_states(session: Session, transaction):
+    # Rolled back or closed without commit (after_commit already popped otherwise)
+    if transaction.parent is not None:
+        return
+    undo = session.info.pop(_UNDO_KEY, None)
+    if undo:
+        trip_engine.restore(undo)
+
+
+trip_engine = TripEngine()
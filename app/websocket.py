@@ -1,73 +1,389 @@
-from fastapi import WebSocket, WebSocketDisconnect
-from typing import List, Dict
-import json
-import asyncio
-
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.vehicle_subscribers: Dict[int, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        print(f"Client connected. Total connections: {len(self.active_connections)}")
-
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        # Remove from vehicle subscribers
-        for vehicle_id in list(self.vehicle_subscribers.keys()):
-            if websocket in self.vehicle_subscribers[vehicle_id]:
-                self.vehicle_subscribers[vehicle_id].remove(websocket)
-        print(f"Client disconnected. Total connections: {len(self.active_connections)}")
-
-    async def broadcast(self, message: dict):
-        """Send message to all connected clients"""
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                print(f"Error sending message: {e}")
-                disconnected.append(connection)
-        
-        # Clean up disconnected clients
-        for conn in disconnected:
-            self.disconnect(conn)
-
-    async def send_personal_message(self, message: dict, websocket: WebSocket):
-        """Send message to specific client"""
-        try:
-            await websocket.send_json(message)
-        except Exception as e:
-            print(f"Error sending personal message: {e}")
-            self.disconnect(websocket)
-
-    def subscribe_to_vehicle(self, vehicle_id: int, websocket: WebSocket):
-        """Subscribe a client to updates for specific vehicle"""
-        if vehicle_id not in self.vehicle_subscribers:
-            self.vehicle_subscribers[vehicle_id] = []
-        if websocket not in self.vehicle_subscribers[vehicle_id]:
-            self.vehicle_subscribers[vehicle_id].append(websocket)
-
-    async def notify_vehicle_update(self, vehicle_id: int, data: dict):
-        """Notify subscribers about vehicle position update"""
-        if vehicle_id in self.vehicle_subscribers:
-            disconnected = []
-            for websocket in self.vehicle_subscribers[vehicle_id]:
-                try:
-                    await websocket.send_json({
-                        "type": "position_update",
-                        "vehicle_id": vehicle_id,
-                        "data": data
-                    })
-                except Exception:
-                    disconnected.append(websocket)
-            
-            # Clean up
-            for conn in disconnected:
-                if conn in self.vehicle_subscribers[vehicle_id]:
-                    self.vehicle_subscribers[vehicle_id].remove(conn)
-
-manager = ConnectionManager()
\ No newline at end of file
+from fastapi import WebSocket, WebSocketDisconnect
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+from .broker import InMemoryBroker, create_broker
+from .metrics import Gauge, ws_messages_sent, ws_positions_coalesced, ws_slow_disconnects
+import json
+import asyncio
+import math
+import os
+
+# Max queued non-position messages per client before it is considered stuck
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256))
+
+# A single send taking longer than this disconnects the client
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 5.0))
+
+# Close code sent to clients dropped for being too slow ("try again later")
+WS_CLOSE_SLOW_CONSUMER = 1013
+
+# Viewport subscriptions are indexed on a lat/lng grid of this cell size
+WS_GRID_CELL_DEG = float(os.getenv("WS_GRID_CELL_DEG", 0.25))
+
+# Viewports covering more cells than this are checked on every update instead
+WS_GRID_MAX_CELLS = int(os.getenv("WS_GRID_MAX_CELLS", 1024))
+
+# Seconds between fleet stats pushes to subscribe_stats clients (sent only when changed)
+FLEET_STATS_PUSH_SECONDS = float(os.getenv("FLEET_STATS_PUSH_SECONDS", 2.0))
+
+# Send-queue key of a client's pending fleet stats message
+STATS_KEY = "fleet_stats"
+
+# (south, west, north, east) in degrees; west > east crosses the antimeridian
+BBox = Tuple[float, float, float, float]
+
+
+def serialize(message: dict) -> str:
+    """Serialize a message once, in the same compact form send_json uses"""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class ClientConnection:
+    """
+    One WebSocket client with its own send queue and writer task.
+
+    Position updates are coalesced per vehicle: if the client has not yet
+    received an update for a vehicle, a newer one replaces it in place.
+    """
+
+    def __init__(self, websocket: WebSocket, manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.manager = manager
+        self.vehicle_ids: Set[int] = set()
+        self.bbox: Optional[BBox] = None
+        self.dropped = 0
+        self.closed = False
+        self._control: Deque[str] = deque()
+        # Keyed by vehicle id (or STATS_KEY)
+        self._positions: "OrderedDict[object, str]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def queue_depth(self) -> int:
+        return len(self._control) + len(self._positions)
+
+    def enqueue(self, text: str) -> bool:
+        """Queue a pre-serialized message; False if the queue is full"""
+        if self.closed:
+            return True
+        if len(self._control) >= WS_SEND_QUEUE_SIZE:
+            return False
+        self._control.append(text)
+        self._wakeup.set()
+        return True
+
+    def enqueue_position(self, vehicle_id: int, text: str):
+        """Queue a position update, replacing any unsent one for the vehicle"""
+        if self.closed:
+            return
+        if vehicle_id in self._positions:
+            self.dropped += 1
+            ws_positions_coalesced.inc()
+        self._positions[vehicle_id] = text
+        self._wakeup.set()
+
+    def enqueue_stats(self, text: str):
+        """Queue fleet stats, replacing any unsent stats message"""
+        if self.closed:
+            return
+        self._positions[STATS_KEY] = text
+        self._wakeup.set()
+
+    async def _writer(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._control or self._positions:
+                    if self._control:
+                        text = self._control.popleft()
+                    else:
+                        _, text = self._positions.popitem(last=False)
+                    await asyncio.wait_for(
+                        self.websocket.send_text(text),
+                        timeout=WS_SEND_TIMEOUT
+                    )
+                    ws_messages_sent.inc()
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            print("Client too slow, disconnecting")
+            ws_slow_disconnects.inc()
+            self.manager.disconnect(self.websocket, code=WS_CLOSE_SLOW_CONSUMER)
+        except Exception as e:
+            print(f"Error sending message: {e}")
+            self.manager.disconnect(self.websocket)
+
+    def close(self, code: Optional[int] = None):
+        """Stop the writer task and optionally close the socket"""
+        if self.closed:
+            return
+        self.closed = True
+        self._control.clear()
+        self._positions.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        if code is not None:
+            asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+def parse_bbox(value) -> BBox:
+    """
+    Accept [south, west, north, east] or a dict with those keys.
+    Raises ValueError for anything else.
+    """
+    if isinstance(value, dict):
+        value = [value.get("south"), value.get("west"), value.get("north"), value.get("east")]
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        raise ValueError("bbox must be [south, west, north, east]")
+    south, west, north, east = (float(v) for v in value)
+    if not all(math.isfinite(v) for v in (south, west, north, east)):
+        raise ValueError("bbox values must be finite")
+    if south > north:
+        raise ValueError("bbox south must be <= north")
+    south, north = max(south, -90.0), min(north, 90.0)
+    # Normalise longitudes into [-180, 180]
+    if east - west >= 360:
+        west, east = -180.0, 180.0
+    else:
+        west = ((west + 180.0) % 360.0) - 180.0
+        east = ((east + 180.0) % 360.0) - 180.0 if east != 180.0 else 180.0
+    return (south, west, north, east)
+
+
+def bbox_contains(bbox: BBox, lat: float, lng: float) -> bool:
+    south, west, north, east = bbox
+    if lat < south or lat > north:
+        return False
+    if west <= east:
+        return west <= lng <= east
+    return lng >= west or lng <= east
+
+
+class ViewportIndex:
+    """
+    Grid index of client viewports.
+
+    Each viewport is registered in every grid cell it overlaps, so matching
+    a position is one dict lookup plus an exact check on the few clients in
+    that cell. Very large viewports are kept in a separate "wide" set.
+    """
+
+    def __init__(self, cell_deg: float = WS_GRID_CELL_DEG, max_cells: int = WS_GRID_MAX_CELLS):
+        self.cell_deg = cell_deg
+        self.max_cells = max_cells
+        self._cells: Dict[Tuple[int, int], Set[ClientConnection]] = {}
+        self._client_cells: Dict[ClientConnection, Set[Tuple[int, int]]] = {}
+        self._wide: Set[ClientConnection] = set()
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def _cells_for(self, bbox: BBox) -> Optional[Set[Tuple[int, int]]]:
+        """Cells overlapped by bbox, or None if there are too many"""
+        south, west, north, east = bbox
+        lng_ranges: List[Tuple[float, float]] = (
+            [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+        )
+        rows = range(self._cell(south, 0)[0], self._cell(north, 0)[0] + 1)
+        cols: List[int] = []
+        for lo, hi in lng_ranges:
+            cols.extend(range(self._cell(0, lo)[1], self._cell(0, hi)[1] + 1))
+        if len(rows) * len(cols) > self.max_cells:
+            return None
+        return {(r, c) for r in rows for c in cols}
+
+    def put(self, client: ClientConnection, bbox: BBox):
+        """Add or move a client's viewport, touching only the changed cells"""
+        new_cells = self._cells_for(bbox)
+        old_cells = self._client_cells.get(client, set())
+
+        if new_cells is None:
+            self._discard_cells(client, old_cells)
+            self._client_cells.pop(client, None)
+            self._wide.add(client)
+        else:
+            self._wide.discard(client)
+            self._discard_cells(client, old_cells - new_cells)
+            for cell in new_cells - old_cells:
+                self._cells.setdefault(cell, set()).add(client)
+            self._client_cells[client] = new_cells
+        client.bbox = bbox
+
+    def remove(self, client: ClientConnection):
+        self._discard_cells(client, self._client_cells.pop(client, set()))
+        self._wide.discard(client)
+        client.bbox = None
+
+    def _discard_cells(self, client: ClientConnection, cells: Iterable[Tuple[int, int]]):
+        for cell in cells:
+            members = self._cells.get(cell)
+            if members is not None:
+                members.discard(client)
+                if not members:
+                    del self._cells[cell]
+
+    def match(self, lat: float, lng: float) -> Set[ClientConnection]:
+        """Clients whose viewport contains the point"""
+        matched = set()
+        candidates = self._cells.get(self._cell(lat, lng))
+        if candidates:
+            matched.update(c for c in candidates if bbox_contains(c.bbox, lat, lng))
+        if self._wide:
+            matched.update(c for c in self._wide if bbox_contains(c.bbox, lat, lng))
+        return matched
+
+
+class ConnectionManager:
+    def __init__(self, broker: Optional[InMemoryBroker] = None):
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        self.vehicle_subscribers: Dict[int, Set[ClientConnection]] = {}
+        self.viewports = ViewportIndex()
+        self.stats_subscribers: Set[ClientConnection] = set()
+        self.broker = broker or InMemoryBroker()
+        self.broker.bind(self.deliver_vehicle_update, self.deliver_broadcast)
+
+    async def start(self):
+        """Connect the broker to other workers (call from the app's startup event)"""
+        await self.broker.start()
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        client = ClientConnection(websocket, self)
+        self.active_connections[websocket] = client
+        client.start()
+        print(f"Client connected. Total connections: {len(self.active_connections)}")
+
+    def disconnect(self, websocket: WebSocket, code: Optional[int] = None):
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return
+        # Remove from vehicle subscribers
+        for vehicle_id in client.vehicle_ids:
+            subscribers = self.vehicle_subscribers.get(vehicle_id)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.vehicle_subscribers[vehicle_id]
+        if client.bbox is not None:
+            self.viewports.remove(client)
+        self.stats_subscribers.discard(client)
+        client.close(code)
+        print(f"Client disconnected. Total connections: {len(self.active_connections)}")
+
+    async def broadcast(self, message: dict):
+        """Send message to all connected clients (on every worker)"""
+        self.broker.publish_broadcast(message)
+
+    def deliver_broadcast(self, message: dict):
+        """Send message to this process's clients"""
+        text = serialize(message)
+        stuck = []
+        for websocket, client in self.active_connections.items():
+            if not client.enqueue(text):
+                stuck.append(websocket)
+
+        # Drop clients whose queues stayed full
+        for websocket in stuck:
+            ws_slow_disconnects.inc()
+            self.disconnect(websocket, code=WS_CLOSE_SLOW_CONSUMER)
+
+    async def send_personal_message(self, message: dict, websocket: WebSocket):
+        """Send message to specific client"""
+        client = self.active_connections.get(websocket)
+        if client is not None and not client.enqueue(serialize(message)):
+            ws_slow_disconnects.inc()
+            self.disconnect(websocket, code=WS_CLOSE_SLOW_CONSUMER)
+
+    def subscribe_to_vehicle(self, vehicle_id: int, websocket: WebSocket):
+        """Subscribe a client to updates for specific vehicle"""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        self.vehicle_subscribers.setdefault(vehicle_id, set()).add(client)
+        client.vehicle_ids.add(vehicle_id)
+
+    def subscribe_to_bbox(self, bbox: BBox, websocket: WebSocket):
+        """Subscribe a client to every vehicle inside its map viewport"""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self.viewports.put(client, bbox)
+
+    def unsubscribe_bbox(self, websocket: WebSocket):
+        client = self.active_connections.get(websocket)
+        if client is not None and client.bbox is not None:
+            self.viewports.remove(client)
+
+    def subscribe_stats(self, websocket: WebSocket):
+        """Push fleet stats to a client whenever they change"""
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self.stats_subscribers.add(client)
+
+    def unsubscribe_stats(self, websocket: WebSocket):
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            self.stats_subscribers.discard(client)
+
+    def deliver_stats(self, stats: dict):
+        """Send fleet stats to this process's stats subscribers"""
+        text = serialize({"type": "fleet_stats", "data": stats})
+        for client in self.stats_subscribers:
+            client.enqueue_stats(text)
+
+    async def stats_push_loop(self, read: Callable[[], dict], interval: float = FLEET_STATS_PUSH_SECONDS):
+        """Every interval, push read() to stats subscribers if it changed"""
+        last = None
+        while True:
+            await asyncio.sleep(interval)
+            if not self.stats_subscribers:
+                last = None
+                continue
+            stats = read()
+            if stats != last:
+                self.deliver_stats(stats)
+                last = stats
+
+    async def notify_vehicle_update(self, vehicle_id: int, data: dict):
+        """Notify subscribers about vehicle position update (on every worker)"""
+        self.broker.publish_position(vehicle_id, data)
+
+    def deliver_vehicle_update(self, vehicle_id: int, data: dict):
+        """Notify this process's subscribers about a position update"""
+        subscribers = self.vehicle_subscribers.get(vehicle_id)
+        lat, lng = data.get("lat"), data.get("lng")
+        if lat is not None and lng is not None:
+            in_view = self.viewports.match(lat, lng)
+            if in_view:
+                subscribers = in_view.union(subscribers) if subscribers else in_view
+        if not subscribers:
+            return
+        text = serialize({
+            "type": "position_update",
+            "vehicle_id": vehicle_id,
+            "data": data
+        })
+        for client in subscribers:
+            client.enqueue_position(vehicle_id, text)
+
+    def queue_depths(self) -> List[int]:
+        return [client.queue_depth() for client in self.active_connections.values()]
+
+manager = ConnectionManager(create_broker())
+
+Gauge("websocket_connections", "Open WebSocket connections on this worker", lambda: len(manager.active_connections))
+Gauge("websocket_send_queue_depth_total", "Messages queued for all clients", lambda: sum(manager.queue_depths()))
+Gauge("websocket_send_queue_depth_max", "Messages queued for the most backed-up client",
+      lambda: max(manager.queue_depths(), default=0))
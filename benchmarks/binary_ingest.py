@@ -0,0 +1,112 @@
+"""
+Decode throughput of the binary ingest format against the JSON paths.
+
+Decodes the same samples as:
+- json-single: one JSON document per fix, as sent to /device/position
+- json-batch: one gateway batch document, as sent to /device/gateway
+- binary: records in the compact binary format (/device/binary)
+and reports wire bytes per sample and samples decoded per second.
+No database or HTTP is involved; this measures parsing and validation only.
+
+Usage (from the repo root):
+    python -m benchmarks.binary_ingest --samples 100000 --devices 100
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# The app modules read DATABASE_URL at import time
+_tmpdir = tempfile.mkdtemp(prefix="fleet-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.binary import decode_fixes, encode_record  # noqa: E402
+from app.ingest import validate_fix  # noqa: E402
+
+
+def make_samples(count: int, devices: int):
+    start = datetime(2024, 1, 1)
+    per_device = {f"IMEI{86000000000000 + d}": [] for d in range(devices)}
+    device_ids = list(per_device)
+    for i in range(count):
+        per_device[device_ids[i % devices]].append((
+            start + timedelta(seconds=i),
+            6.4 + random.random() * 0.2,
+            3.3 + random.random() * 0.2,
+            round(random.random() * 120, 1)
+        ))
+    return per_device
+
+
+def json_documents(per_device):
+    return [
+        json.dumps({
+            "imei": device_id,
+            "latitude": lat,
+            "longitude": lng,
+            "speed": speed,
+            "timestamp": recorded_at.isoformat() + "Z"
+        }).encode()
+        for device_id, samples in per_device.items()
+        for recorded_at, lat, lng, speed in samples
+    ]
+
+
+def decode_json_single(documents):
+    return [validate_fix(json.loads(doc)) for doc in documents]
+
+
+def decode_json_batch(document):
+    return [validate_fix(item) for item in json.loads(document)["positions"]]
+
+
+def timed(fn, *args, repeat: int = 3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--devices", type=int, default=100)
+    args = parser.parse_args()
+
+    random.seed(1)
+    per_device = make_samples(args.samples, args.devices)
+
+    singles = json_documents(per_device)
+    batch = b'{"positions":[' + b",".join(singles) + b"]}"
+    binary = b"".join(
+        encode_record(device_id, samples[i:i + 0xFFFF])
+        for device_id, samples in per_device.items()
+        for i in range(0, len(samples), 0xFFFF)
+    )
+
+    results = []
+    seconds, fixes = timed(decode_json_single, singles)
+    results.append(("json-single", sum(map(len, singles)), seconds, len(fixes)))
+    seconds, fixes = timed(decode_json_batch, batch)
+    results.append(("json-batch", len(batch), seconds, len(fixes)))
+    seconds, (fixes, _) = timed(decode_fixes, binary)
+    results.append(("binary", len(binary), seconds, len(fixes)))
+
+    print(f"{args.samples} samples from {args.devices} devices")
+    print(f"{'format':<12} {'bytes/sample':>12} {'samples/s':>12} {'speedup':>8}")
+    baseline = results[0][2]
+    for name, size, seconds, decoded in results:
+        assert decoded == args.samples, name
+        print(f"{name:<12} {size / args.samples:>12.1f} {decoded / seconds:>12,.0f} {baseline / seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Event-loop latency while ingest is under load.
+
+Runs the app in-process and fires concurrent /api/device/position requests
+while a probe coroutine measures how late asyncio.sleep() wakes up. Compares
+the AsyncSession ingest route with the old pattern of a sync Session used
+directly inside an async route.
+
+Usage (from the repo root):
+    python -m benchmarks.event_loop_latency --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Point the app at a throwaway SQLite database before importing it
+_tmpdir = tempfile.mkdtemp(prefix="fleet-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from fastapi import Depends  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from app import db as app_db  # noqa: E402
+from app.auth import DEVICE_API_KEY, verify_device_token  # noqa: E402
+from app.ingest import parse_timestamp, store_positions  # noqa: E402
+from app.main import app  # noqa: E402
+from app.resolver import device_resolver  # noqa: E402
+
+PROBE_INTERVAL = 0.005
+
+
+@app.post("/bench/sync-in-loop", include_in_schema=False)
+async def sync_in_loop(
+    payload: dict,
+    token: str = Depends(verify_device_token),
+    db: Session = Depends(app_db.get_db)
+):
+    """The pre-AsyncSession pattern: blocking DB calls inside async def"""
+    vehicle_id = device_resolver.resolve(db, str(payload["device_id"]))
+    row = {
+        "vehicle_id": vehicle_id,
+        "lat": float(payload["lat"]),
+        "lng": float(payload["lng"]),
+        "speed": float(payload.get("speed", 0)),
+        "recorded_at": parse_timestamp(payload.get("timestamp"))
+    }
+    store_positions(db, [row])
+    db.commit()
+    return {"status": "success", "position_id": row["id"]}
+
+
+async def probe(stop: asyncio.Event, lags: list):
+    """Record how late each short sleep wakes up"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append((loop.time() - start - PROBE_INTERVAL) * 1000)
+
+
+async def run_load(client: httpx.AsyncClient, path: str, total: int, concurrency: int, devices: int):
+    counter = iter(range(total))
+    headers = {"X-Device-Token": DEVICE_API_KEY}
+
+    async def worker():
+        for i in counter:
+            await client.post(path, headers=headers, json={
+                "device_id": f"BENCH-{i % devices}",
+                "lat": 6.5 + (i % 100) * 0.001,
+                "lng": 3.3 + (i % 100) * 0.001,
+                "speed": i % 80
+            })
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def scenario(name: str, path: str, args) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        stop = asyncio.Event()
+        lags = []
+        probe_task = asyncio.create_task(probe(stop, lags))
+        started = time.perf_counter()
+        await run_load(client, path, args.requests, args.concurrency, args.devices)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe_task
+
+    return {
+        "scenario": name,
+        "req_per_sec": args.requests / elapsed,
+        "lag_p50_ms": statistics.median(lags) if lags else 0.0,
+        "lag_p99_ms": percentile(lags, 99),
+        "lag_max_ms": max(lags) if lags else 0.0,
+        "probes": len(lags)
+    }
+
+
+async def main(args):
+    app_db.engine.echo = False
+    app_db.async_engine.echo = False
+
+    async with app.router.lifespan_context(app):
+        results = [
+            await scenario("sync Session in async route", "/bench/sync-in-loop", args),
+            await scenario("AsyncSession route", "/api/device/position", args),
+        ]
+
+    print(f"{'scenario':<30} {'req/s':>8} {'lag p50':>9} {'lag p99':>9} {'lag max':>9}")
+    for r in results:
+        print(f"{r['scenario']:<30} {r['req_per_sec']:>8.0f} "
+              f"{r['lag_p50_ms']:>7.2f}ms {r['lag_p99_ms']:>7.2f}ms {r['lag_max_ms']:>7.2f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--devices", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
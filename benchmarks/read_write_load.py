@@ -0,0 +1,177 @@
+"""
+Ingest throughput with and without concurrent history reads.
+
+Runs the app in-process on a throwaway SQLite database, seeds some history,
+then measures /api/device/position throughput twice for the same duration:
+once alone and once while reader processes (like extra uvicorn workers on
+the same database) page through /api/positions/{id}. With WAL (the default)
+ingest should hold up; compare with the old rollback journal using
+--journal-mode DELETE.
+
+Usage (from the repo root):
+    python -m benchmarks.read_write_load --seconds 10 --writers 20 --readers 4
+    python -m benchmarks.read_write_load --journal-mode DELETE
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def quiet_engines(app_db):
+    for engine in [app_db.engine, app_db.async_engine.sync_engine] + app_db.read_engines + [
+        replica.sync_engine for replica in app_db.async_read_engines
+    ]:
+        engine.echo = False
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def writer(client, headers, devices: int, deadline: float, counters: dict):
+    while time.perf_counter() < deadline:
+        i = counters["writes"]
+        counters["writes"] += 1
+        response = await client.post("/api/device/position", headers=headers, json={
+            "device_id": f"LOAD-{i % devices}",
+            "lat": 6.5 + random.random() * 0.1,
+            "lng": 3.3 + random.random() * 0.1,
+            "speed": random.random() * 80
+        })
+        if response.status_code != 201:
+            counters["write_errors"] += 1
+            if counters["write_errors"] <= 5:
+                print(f"write failed: {response.status_code} {response.text[:200]}")
+
+
+async def read_history(vehicle_ids: list, limit: int, seconds: float, ready):
+    import httpx
+    from app import db as app_db
+    from app.main import app
+
+    quiet_engines(app_db)
+    # Start together with the writers, after the slow imports
+    await asyncio.to_thread(ready.wait)
+    latencies = []
+    errors = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await client.get(f"/api/positions/{random.choice(vehicle_ids)}", params={"limit": limit})
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+    return latencies, errors
+
+
+def reader_process(vehicle_ids: list, limit: int, seconds: float, ready, results):
+    """One reader worker: its own process, engine and event loop"""
+    results.put(asyncio.run(read_history(vehicle_ids, limit, seconds, ready)))
+
+
+async def phase(client, headers, args, vehicle_ids: list, readers: int) -> dict:
+    counters = {"writes": 0, "write_errors": 0}
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    ready = context.Barrier(readers + 1)
+    processes = [
+        context.Process(target=reader_process, args=(vehicle_ids, args.page, args.seconds, ready, results))
+        for _ in range(readers)
+    ]
+    for process in processes:
+        process.start()
+    if processes:
+        await asyncio.to_thread(ready.wait)
+
+    started = time.perf_counter()
+    deadline = started + args.seconds
+    await asyncio.gather(*(writer(client, headers, args.devices, deadline, counters) for _ in range(args.writers)))
+    elapsed = time.perf_counter() - started
+
+    latencies = []
+    read_errors = 0
+    for _ in processes:
+        process_latencies, process_errors = await asyncio.to_thread(results.get)
+        latencies += process_latencies
+        read_errors += process_errors
+    for process in processes:
+        process.join()
+    return {
+        "fixes_per_sec": counters["writes"] / elapsed,
+        "reads_per_sec": len(latencies) / elapsed,
+        "read_p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "read_p99_ms": percentile(latencies, 99) * 1000,
+        "errors": counters["write_errors"] + read_errors
+    }
+
+
+async def main(args):
+    import httpx
+    from app import db as app_db
+    from app.auth import DEVICE_API_KEY
+    from app.main import app
+
+    quiet_engines(app_db)
+    headers = {"X-Device-Token": DEVICE_API_KEY}
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            # Seed history so reads have full pages to scan
+            per_device = args.history // args.devices
+            vehicle_ids = []
+            for d in range(args.devices):
+                response = await client.post("/api/device/batch", headers=headers, json={
+                    "device_id": f"LOAD-{d}",
+                    "positions": [
+                        {"lat": 6.5 + i * 1e-4, "lng": 3.3, "speed": 40, "timestamp": f"2024-01-01T00:00:{i % 60:02d}Z"}
+                        for i in range(per_device)
+                    ]
+                })
+                vehicle_ids.append(response.json()["vehicle_id"])
+
+            alone = await phase(client, headers, args, vehicle_ids, readers=0)
+            mixed = await phase(client, headers, args, vehicle_ids, readers=args.readers)
+
+    # Reader processes also compete for CPU; on few cores that dominates
+    print(f"journal_mode={app_db.SQLITE_JOURNAL_MODE}, {args.writers} writers, {args.seconds:.0f}s per phase, "
+          f"{args.history} seeded fixes, {os.cpu_count()} CPUs")
+    print(f"{'phase':<24} {'fixes/s':>9} {'reads/s':>9} {'read p50':>10} {'read p99':>10} {'errors':>7}")
+    for name, r in (("ingest only", alone), (f"ingest + {args.readers} readers", mixed)):
+        print(f"{name:<24} {r['fixes_per_sec']:>9.0f} {r['reads_per_sec']:>9.0f} "
+              f"{r['read_p50_ms']:>8.1f}ms {r['read_p99_ms']:>8.1f}ms {r['errors']:>7}")
+    print(f"ingest kept {mixed['fixes_per_sec'] / alone['fixes_per_sec']:.0%} of its throughput under reads")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writers", type=int, default=20)
+    parser.add_argument("--readers", type=int, default=4, help="Reader processes")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--history", type=int, default=50000, help="Fixes seeded before measuring")
+    parser.add_argument("--page", type=int, default=1000, help="History page size")
+    parser.add_argument("--journal-mode", default="WAL", help="SQLite journal mode (WAL, DELETE)")
+    args = parser.parse_args()
+
+    # The app reads its settings at import time
+    _tmpdir = tempfile.mkdtemp(prefix="fleet-bench-")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+    os.environ["SQLITE_JOURNAL_MODE"] = args.journal_mode
+    # Measure the database, not the response cache
+    os.environ.setdefault("CACHE_BACKEND", "off")
+    random.seed(1)
+    asyncio.run(main(args))
@@ -0,0 +1,467 @@
+"""
+Reproducible load and micro-benchmarks, saved as JSON for comparison.
+
+`load` starts the app with uvicorn in a subprocess (a throwaway SQLite
+database unless --database-url is given), then for --seconds:
+- N simulated devices post to /api/device/position, and a share of them
+  (--batch-ratio) to /api/device/batch
+- M WebSocket clients on /api/ws subscribe to every vehicle
+It reports ingest requests/s and fixes/s, p50/p99 request latency per
+endpoint, and ingest-to-WebSocket latency: from sending a fix to a client
+receiving it (the newest fix of each request is tracked).
+
+`micro` times the hot paths: device payload parsing, batch validation,
+binary decoding, WebSocket message and history page serialization.
+
+Each run is written to benchmarks/results/ (or --output); `compare` shows
+two runs side by side.
+
+Usage (from the repo root):
+    python -m benchmarks.run all --devices 200 --clients 20 --seconds 20
+    python -m benchmarks.run load --database-url postgresql://fleet@localhost/bench --workers 4
+    python -m benchmarks.run load --env INGEST_MODE=queued --label queued
+    python -m benchmarks.run micro
+    python -m benchmarks.run compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def latency_summary(seconds: list) -> dict:
+    """Latencies in seconds -> count and milliseconds percentiles"""
+    return {
+        "count": len(seconds),
+        "p50_ms": statistics.median(seconds) * 1000 if seconds else 0.0,
+        "p90_ms": percentile(seconds, 90) * 1000,
+        "p99_ms": percentile(seconds, 99) * 1000,
+        "max_ms": max(seconds) * 1000 if seconds else 0.0
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+# ==================== SERVER ====================
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir: str):
+    """uvicorn app.main:app in a subprocess; returns (process, base_url, log path)"""
+    port = args.port or free_port()
+    env = dict(os.environ)
+    env["DATABASE_URL"] = args.database_url or f"sqlite:///{workdir}/bench.db"
+    env.setdefault("DEVICE_API_KEY", "bench-device-key")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    log_path = os.path.join(workdir, "server.log")
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"
+    ]
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, f"127.0.0.1:{port}", log_path, env["DEVICE_API_KEY"]
+
+
+async def wait_ready(client, process, log_path: str, timeout: float = 60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    with open(log_path) as log:
+        tail = log.read()[-2000:]
+    raise RuntimeError(f"Server did not become ready; log tail:\n{tail}")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# ==================== LOAD ====================
+
+class LoadState:
+    """Counters and samples shared by devices and WebSocket clients"""
+
+    def __init__(self):
+        self.measuring = False
+        # (vehicle_id, recorded_at iso) -> perf_counter() when the request was sent
+        self.sent = {}
+        self.latency = {"position": [], "batch": []}
+        self.requests = {"position": 0, "batch": 0}
+        self.fixes = 0
+        self.errors = 0
+        self.delivery = []
+        self.deliveries = 0
+
+
+def fix(lat: float, lng: float, recorded_at: datetime) -> dict:
+    return {
+        "lat": round(lat, 7),
+        "lng": round(lng, 7),
+        "speed": round(random.uniform(0, 90), 1),
+        "timestamp": recorded_at.isoformat() + "Z"
+    }
+
+
+async def device(client, headers, name: str, vehicle_id: int, args, state: LoadState, deadline: float):
+    lat, lng = 6.4 + random.random() * 0.2, 3.3 + random.random() * 0.2
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    # Spread devices over the first interval instead of firing together
+    next_send = time.perf_counter() + random.random() * interval
+    while True:
+        if interval:
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+            next_send += interval
+        if time.perf_counter() >= deadline:
+            return
+        lat += random.uniform(-1, 1) * 1e-4
+        lng += random.uniform(-1, 1) * 1e-4
+        now = datetime.utcnow()
+        if random.random() < args.batch_ratio:
+            kind = "batch"
+            # Oldest first, ending at now: only the newest is published
+            positions = [
+                fix(lat, lng, now - timedelta(milliseconds=args.batch_size - 1 - i))
+                for i in range(args.batch_size)
+            ]
+            request = client.post("/api/device/batch", headers=headers, json={"device_id": name, "positions": positions})
+        else:
+            kind = "position"
+            positions = [fix(lat, lng, now)]
+            request = client.post("/api/device/position", headers=headers, json={"device_id": name, **positions[0]})
+        started = time.perf_counter()
+        if state.measuring:
+            state.sent[(vehicle_id, now.isoformat())] = started
+        try:
+            response = await request
+            ok = response.status_code in (200, 201, 202)
+        except Exception:
+            ok = False
+        if state.measuring:
+            state.requests[kind] += 1
+            if ok:
+                state.fixes += len(positions)
+                state.latency[kind].append(time.perf_counter() - started)
+            else:
+                state.errors += 1
+
+
+async def ws_client(url: str, vehicle_ids: list, state: LoadState, subscribed: list):
+    import websockets
+
+    async with websockets.connect(url, max_size=None) as ws:
+        for vehicle_id in vehicle_ids:
+            await ws.send(json.dumps({"type": "subscribe", "vehicle_id": vehicle_id}))
+        pending = len(vehicle_ids)
+        async for raw in ws:
+            now = time.perf_counter()
+            message = json.loads(raw)
+            kind = message.get("type")
+            if kind == "subscribed":
+                pending -= 1
+                if pending == 0:
+                    subscribed.append(url)
+            elif kind == "position_update" and state.measuring:
+                sent = state.sent.get((message["vehicle_id"], message["data"]["recorded_at"]))
+                if sent is not None:
+                    state.deliveries += 1
+                    state.delivery.append(now - sent)
+
+
+async def run_load(args) -> dict:
+    import httpx
+
+    workdir = tempfile.mkdtemp(prefix="fleet-bench-")
+    process, host, log_path, token = start_server(args, workdir)
+    headers = {"X-Device-Token": token}
+    state = LoadState()
+    limits = httpx.Limits(max_connections=args.devices, max_keepalive_connections=args.devices)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://{host}", timeout=30, limits=limits) as client:
+            await wait_ready(client, process, log_path)
+
+            # Register the devices (auto-creates their vehicles)
+            names = [f"BENCH-{i}" for i in range(args.devices)]
+            vehicle_ids = []
+            for name in names:
+                response = await client.post("/api/device/position", headers=headers, json={
+                    "device_id": name, "lat": 6.5, "lng": 3.3, "speed": 0
+                })
+                response.raise_for_status()
+                vehicle_ids.append(response.json()["vehicle_id"])
+
+            subscribed = []
+            clients = [
+                asyncio.create_task(ws_client(f"ws://{host}/api/ws", vehicle_ids, state, subscribed))
+                for _ in range(args.clients)
+            ]
+            deadline = time.perf_counter() + 30
+            while len(subscribed) < args.clients and time.perf_counter() < deadline:
+                failed = [task for task in clients if task.done()]
+                if failed:
+                    failed[0].result()
+                await asyncio.sleep(0.05)
+
+            end = time.perf_counter() + args.warmup + args.seconds
+            devices = [
+                asyncio.create_task(device(client, headers, name, vid, args, state, end))
+                for name, vid in zip(names, vehicle_ids)
+            ]
+            await asyncio.sleep(args.warmup)
+            state.measuring = True
+            started = time.perf_counter()
+            await asyncio.gather(*devices)
+            elapsed = time.perf_counter() - started
+            # Let the last deliveries arrive before closing the clients
+            await asyncio.sleep(1.0)
+            state.measuring = False
+            for task in clients:
+                task.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
+    finally:
+        stop_server(process)
+
+    total = sum(state.requests.values())
+    all_latency = state.latency["position"] + state.latency["batch"]
+    expected = len(state.sent) * args.clients
+    return {
+        "requests": total,
+        "requests_per_sec": total / elapsed,
+        "fixes_per_sec": state.fixes / elapsed,
+        "errors": state.errors,
+        "latency": latency_summary(all_latency),
+        "latency_position": latency_summary(state.latency["position"]),
+        "latency_batch": latency_summary(state.latency["batch"]),
+        "websocket": {
+            "clients": args.clients,
+            "deliveries": state.deliveries,
+            "deliveries_per_sec": state.deliveries / elapsed,
+            # Below 1.0 when updates were coalesced for slow clients (or lost)
+            "delivered_ratio": state.deliveries / expected if expected else 0.0,
+            "latency": latency_summary(state.delivery)
+        },
+        "seconds": elapsed
+    }
+
+
+# ==================== MICRO ====================
+
+def timeit(fn, number: int, repeat: int = 5) -> dict:
+    """Best of repeat runs of fn() number times"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - started)
+    return {"ops_per_sec": number / best, "us_per_op": best / number * 1e6}
+
+
+def run_micro(args) -> dict:
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='fleet-bench-')}/bench.db")
+    from pydantic import TypeAdapter
+    from typing import List
+    from app.binary import decode_fixes, encode_record
+    from app.ingest import extract_fix, parse_timestamp, position_payload, validate_fix
+    from app.routes import validate_batch
+    from app.pagination import decode_cursor, encode_cursor
+    from app.schemas import PositionOut
+    from app.websocket import serialize
+
+    random.seed(1)
+    now = datetime(2024, 1, 1, 12)
+    body = json.dumps({"device_id": "BENCH-1", **fix(6.5, 3.3, now)}).encode()
+    batch = [fix(6.5 + i * 1e-5, 3.3, now + timedelta(seconds=i)) for i in range(100)]
+    binary = encode_record("BENCH-1", [
+        (now + timedelta(seconds=i), 6.5 + i * 1e-5, 3.3, 40.0) for i in range(100)
+    ])
+    row = {"id": 1, "vehicle_id": 1, "lat": 6.5, "lng": 3.3, "speed": 40.0, "recorded_at": now}
+    page = [dict(row, id=i, recorded_at=now + timedelta(seconds=i)) for i in range(1000)]
+    history = TypeAdapter(List[PositionOut])
+    n = args.iterations
+
+    def parse_position():
+        payload = json.loads(body)
+        device_id, lat, lng, speed, timestamp = extract_fix(payload)
+        return float(lat), float(lng), float(speed), parse_timestamp(timestamp)
+
+    return {
+        "parse_device_position": timeit(parse_position, n),
+        "validate_fix": timeit(lambda: validate_fix({"device_id": "BENCH-1", **batch[0]}), n),
+        "validate_batch_100": timeit(lambda: validate_batch(batch, device_id="BENCH-1"), max(1, n // 100)),
+        "decode_binary_100": timeit(lambda: decode_fixes(binary), max(1, n // 100)),
+        "serialize_ws_update": timeit(lambda: serialize({
+            "type": "position_update", "vehicle_id": 1, "data": position_payload(row)
+        }), n),
+        "serialize_history_page_1000": timeit(
+            lambda: history.dump_json(history.validate_python(page)), max(1, n // 1000)
+        ),
+        "cursor_roundtrip": timeit(lambda: decode_cursor(encode_cursor(now, 12345)), n)
+    }
+
+
+# ==================== OUTPUT ====================
+
+def print_load(load: dict):
+    ws = load["websocket"]
+    print(f"ingest: {load['requests_per_sec']:.0f} req/s, {load['fixes_per_sec']:.0f} fixes/s, "
+          f"{load['errors']} errors")
+    for name in ("latency_position", "latency_batch"):
+        s = load[name]
+        if s["count"]:
+            print(f"  {name[8:]:<9} p50 {s['p50_ms']:7.1f}ms  p99 {s['p99_ms']:7.1f}ms  max {s['max_ms']:7.1f}ms")
+    s = ws["latency"]
+    print(f"websocket: {ws['clients']} clients, {ws['deliveries_per_sec']:.0f} deliveries/s "
+          f"({ws['delivered_ratio']:.0%} of tracked fixes)")
+    print(f"  ingest->ws p50 {s['p50_ms']:7.1f}ms  p99 {s['p99_ms']:7.1f}ms  max {s['max_ms']:7.1f}ms")
+
+
+def print_micro(micro: dict):
+    for name, r in micro.items():
+        print(f"  {name:<30} {r['ops_per_sec']:>12,.0f} ops/s  {r['us_per_op']:>10.2f} us/op")
+
+
+def flatten(data: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(paths):
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    before, after = (flatten(run.get("results", {})) for run in runs)
+    for name, path, run in zip("AB", paths, runs):
+        print(f"{name}: {path} ({run.get('label')}, commit {run.get('commit') or '?'}, {run.get('created_at')})")
+    print(f"{'metric':<48} {'A':>12} {'B':>12} {'change':>8}")
+    for key in sorted(set(before) | set(after)):
+        a, b = before.get(key), after.get(key)
+        change = f"{(b - a) / a:+.1%}" if a and b is not None else ""
+        a_text = "-" if a is None else f"{a:.6g}"
+        b_text = "-" if b is None else f"{b:.6g}"
+        print(f"{key:<48} {a_text:>12} {b_text:>12} {change:>8}")
+
+
+def save(args, results: dict) -> str:
+    record = {
+        "label": args.label,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("command", "output")},
+        "results": results
+    }
+    path = args.output
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{stamp}-{args.label}.json")
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--label", default="run", help="Name stored with (and in the file name of) the results")
+    common.add_argument("--output", help="Results file (default benchmarks/results/<time>-<label>.json)")
+
+    load = argparse.ArgumentParser(add_help=False)
+    load.add_argument("--devices", type=int, default=100)
+    load.add_argument("--clients", type=int, default=10, help="WebSocket clients, each subscribed to every vehicle")
+    load.add_argument("--rate", type=float, default=1.0, help="Requests per device per second (0 = as fast as possible)")
+    load.add_argument("--batch-ratio", type=float, default=0.1, help="Share of requests sent to /device/batch")
+    load.add_argument("--batch-size", type=int, default=20, help="Fixes per batch request")
+    load.add_argument("--seconds", type=float, default=20)
+    load.add_argument("--warmup", type=float, default=3)
+    load.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    load.add_argument("--port", type=int, default=0)
+    load.add_argument("--database-url", help="Database for the server (default: throwaway SQLite)")
+    load.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra server setting")
+
+    micro = argparse.ArgumentParser(add_help=False)
+    micro.add_argument("--iterations", type=int, default=20000)
+
+    sub.add_parser("all", parents=[common, load, micro], help="Load test, then micro-benchmarks")
+    sub.add_parser("load", parents=[common, load], help="Ingest and WebSocket fan-out under load")
+    sub.add_parser("micro", parents=[common, micro], help="Parsing and serialization hot paths")
+    compare_parser = sub.add_parser("compare", help="Compare two saved runs")
+    compare_parser.add_argument("files", nargs=2)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.files)
+        return
+
+    random.seed(1)
+    results = {}
+    if args.command in ("all", "load"):
+        print(f"load: {args.devices} devices at {args.rate or 'max'} req/s each, {args.clients} WebSocket clients, "
+              f"{args.seconds:.0f}s, {args.workers} worker(s), {os.cpu_count()} CPUs")
+        results["load"] = asyncio.run(run_load(args))
+        print_load(results["load"])
+    if args.command in ("all", "micro"):
+        print("micro:")
+        results["micro"] = run_micro(args)
+        print_micro(results["micro"])
+    print(f"saved {save(args, results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Storage size and decode speed of compressed track segments (app/segments.py).
+
+Fills a throwaway SQLite database with simulated tracks (a fix every
+--interval seconds per vehicle), measures the file size, compacts everything
+into segments and measures again (both after VACUUM). Then compares reading
+one day of a vehicle's track from raw rows against decoding its segment.
+
+Usage (from the repo root):
+    python -m benchmarks.track_segments --vehicles 20 --days 7
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# The app modules read DATABASE_URL at import time
+_tmpdir = tempfile.mkdtemp(prefix="fleet-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert  # noqa: E402
+from app import models  # noqa: E402
+from app.db import SessionLocal, engine  # noqa: E402
+from app.segments import compact_positions, decode_segment, segment_rows  # noqa: E402
+
+
+def simulate(vehicle_id: int, start: datetime, count: int, interval: int):
+    lat, lng = 6.4 + random.random(), 3.3 + random.random()
+    speed = 0.0
+    for i in range(count):
+        speed = max(0.0, min(120.0, speed + random.uniform(-8, 8)))
+        lat += random.uniform(-1, 1) * speed * 1e-6
+        lng += random.uniform(-1, 1) * speed * 1e-6
+        yield {
+            "vehicle_id": vehicle_id,
+            "lat": lat,
+            "lng": lng,
+            "speed": round(speed, 1),
+            "recorded_at": start + timedelta(seconds=i * interval)
+        }
+
+
+def database_bytes(db) -> int:
+    db.commit()
+    # VACUUM cannot run in a transaction; the raw connection is in autocommit
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("VACUUM")
+        cursor.execute("PRAGMA page_count")
+        pages = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_size")
+        return pages * cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def timed(fn, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vehicles", type=int, default=20)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--interval", type=int, default=10, help="Seconds between fixes")
+    args = parser.parse_args()
+
+    random.seed(1)
+    engine.echo = False
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    start = datetime(2024, 1, 1)
+    per_vehicle = args.days * 86400 // args.interval
+    try:
+        for v in range(args.vehicles):
+            vehicle = models.Vehicle(name=f"BENCH-{v}")
+            db.add(vehicle)
+            db.flush()
+            rows = list(simulate(vehicle.id, start, per_vehicle, args.interval))
+            for i in range(0, len(rows), 10000):
+                db.execute(insert(models.Position), rows[i:i + 10000])
+            db.commit()
+        total = per_vehicle * args.vehicles
+        raw_bytes = database_bytes(db)
+
+        # One day of vehicle 1 from raw rows
+        day_end = start + timedelta(days=1)
+        raw_seconds, raw_rows = timed(lambda: db.query(
+            models.Position.id, models.Position.vehicle_id, models.Position.lat,
+            models.Position.lng, models.Position.speed, models.Position.recorded_at
+        ).filter(
+            models.Position.vehicle_id == 1,
+            models.Position.recorded_at >= start,
+            models.Position.recorded_at < day_end
+        ).order_by(models.Position.recorded_at, models.Position.id).all())
+
+        started = time.perf_counter()
+        stats = compact_positions(db, start + timedelta(days=args.days + 1))
+        compact_seconds = time.perf_counter() - started
+        segment_bytes = database_bytes(db)
+
+        segment = (
+            db.query(models.TrackSegment)
+            .filter(models.TrackSegment.vehicle_id == 1)
+            .order_by(models.TrackSegment.start_at)
+            .first()
+        )
+        decode_seconds, columns = timed(lambda: decode_segment(segment.data))
+        rows_seconds, rows = timed(lambda: segment_rows(segment))
+        assert len(columns["id"]) == len(rows) == len(raw_rows)
+    finally:
+        db.close()
+
+    print(f"{total} fixes: {args.vehicles} vehicles x {args.days} days, one every {args.interval}s")
+    print(f"  database with raw rows   {raw_bytes / 2**20:8.1f} MiB  ({raw_bytes / total:.1f} bytes/fix incl. indexes)")
+    print(f"  database with segments   {segment_bytes / 2**20:8.1f} MiB  ({segment_bytes / total:.1f} bytes/fix), "
+          f"{raw_bytes / segment_bytes:.1f}x smaller")
+    print(f"  segment payloads         {stats['bytes'] / 2**20:8.1f} MiB  ({stats['bytes'] / total:.2f} bytes/fix) "
+          f"in {stats['segments']} segments, compacted in {compact_seconds:.1f}s")
+    print(f"one day of one vehicle ({len(rows)} fixes):")
+    print(f"  SELECT raw rows          {len(rows) / raw_seconds:>12,.0f} fixes/s")
+    print(f"  decode segment (arrays)  {len(rows) / decode_seconds:>12,.0f} fixes/s")
+    print(f"  decode segment (rows)    {len(rows) / rows_seconds:>12,.0f} fixes/s")
+
+
+if __name__ == "__main__":
+    main()
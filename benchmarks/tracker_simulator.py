@@ -0,0 +1,222 @@
+"""
+Simulated hardware trackers for the raw TCP/UDP listener (app/tracker.py).
+
+Opens one connection per device (TCP) or one socket per device (UDP), logs
+in, sends DATA frames of packed samples and waits for each ACK. Reports
+fixes stored per second and ACK latency percentiles.
+
+Against a running server (TRACKER_TCP_PORT / TRACKER_UDP_PORT set):
+    python -m benchmarks.tracker_simulator --port 5023 --devices 2000
+Self-contained, with an in-process listener on a throwaway SQLite DB:
+    python -m benchmarks.tracker_simulator --serve --devices 2000 --queued
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_HEADER = struct.Struct("<HB")
+
+
+def raise_fd_limit():
+    """Thousands of sockets need more than the usual 1024 descriptors"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def make_samples(start: datetime, count: int, lat: float, lng: float):
+    return [
+        (start + timedelta(seconds=i * 5), lat + i * 1e-4, lng + random.random() * 1e-4, random.random() * 90)
+        for i in range(count)
+    ]
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    length, frame_type = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return frame_type, await reader.readexactly(length - 1)
+
+
+async def tcp_device(args, index: int, connect_slots: asyncio.Semaphore, latencies: list, counters: dict):
+    from app.binary import pack_samples
+    from app.tracker import FRAME_LOGIN, FRAME_DATA, STATUS_OK, encode_frame
+
+    device_id = f"SIM{index:06d}"
+    # Limit the handshake burst, not the number of open connections
+    async with connect_slots:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        writer.write(encode_frame(FRAME_LOGIN, device_id.encode()))
+        _, payload = await read_frame(reader)
+        if payload[-1] != STATUS_OK:
+            counters["errors"] += 1
+            return
+
+        start = datetime(2024, 1, 1) + timedelta(minutes=index)
+        for seq in range(args.frames):
+            samples = make_samples(start + timedelta(seconds=seq * 5 * args.samples), args.samples,
+                                   6.4 + index * 1e-3, 3.3)
+            sent = time.perf_counter()
+            writer.write(encode_frame(FRAME_DATA, struct.pack("<H", seq) + pack_samples(samples)))
+            _, payload = await read_frame(reader)
+            latencies.append(time.perf_counter() - sent)
+            if payload[-1] == STATUS_OK:
+                counters["fixes"] += args.samples
+            else:
+                counters["errors"] += 1
+            if args.interval:
+                await asyncio.sleep(args.interval)
+    finally:
+        writer.close()
+
+
+class _UdpClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.acks = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.acks.put_nowait(data)
+
+    async def wait_ack(self, seq: int) -> bytes:
+        """Next ACK for seq, skipping late ACKs of earlier frames"""
+        while True:
+            ack = await self.acks.get()
+            if struct.unpack_from("<H", ack, _HEADER.size)[0] == seq:
+                return ack
+
+
+async def udp_device(args, index: int, connect_slots: asyncio.Semaphore, latencies: list, counters: dict):
+    from app.binary import pack_samples
+    from app.tracker import FRAME_DATA_UDP, STATUS_OK, encode_frame
+
+    device_bytes = f"SIMU{index:06d}".encode()
+    loop = asyncio.get_running_loop()
+    async with connect_slots:
+        transport, client = await loop.create_datagram_endpoint(
+            _UdpClient, remote_addr=(args.host, args.udp_port)
+        )
+    try:
+        start = datetime(2024, 1, 1) + timedelta(minutes=index)
+        for seq in range(args.frames):
+            samples = make_samples(start + timedelta(seconds=seq * 5 * args.samples), args.samples,
+                                   6.4 + index * 1e-3, 3.3)
+            payload = bytes([len(device_bytes)]) + device_bytes + struct.pack("<H", seq) + pack_samples(samples)
+            sent = time.perf_counter()
+            transport.sendto(encode_frame(FRAME_DATA_UDP, payload))
+            try:
+                ack = await asyncio.wait_for(client.wait_ack(seq), timeout=args.udp_timeout)
+            except asyncio.TimeoutError:
+                # UDP is lossy; the frame (or its ACK) never arrived in time
+                counters["lost"] += 1
+                continue
+            latencies.append(time.perf_counter() - sent)
+            if ack[-1] == STATUS_OK:
+                counters["fixes"] += args.samples
+            else:
+                counters["errors"] += 1
+            if args.interval:
+                await asyncio.sleep(args.interval)
+    finally:
+        transport.close()
+
+
+async def serve(args):
+    """Start an in-process listener on a throwaway SQLite database"""
+    tmpdir = tempfile.mkdtemp(prefix="fleet-sim-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{tmpdir}/sim.db"
+    if args.queued:
+        os.environ["INGEST_MODE"] = "queued"
+
+    from app import db as app_db
+    from app.db import Base
+    from app.ingest import ingest_pipeline
+    from app.tracker import tracker_server
+
+    app_db.engine.echo = False
+    app_db.async_engine.echo = False
+    Base.metadata.create_all(bind=app_db.engine)
+    if args.queued:
+        await ingest_pipeline.start()
+    await tracker_server.start("127.0.0.1", args.port, args.udp_port if args.udp else 0)
+    return tracker_server, ingest_pipeline
+
+
+async def run(args):
+    server = pipeline = None
+    if args.serve:
+        server, pipeline = await serve(args)
+    else:
+        os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/unused.db")
+
+    latencies = []
+    counters = {"fixes": 0, "errors": 0, "lost": 0}
+    device = udp_device if args.udp else tcp_device
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+
+    async def one(index):
+        try:
+            await device(args, index, connect_slots, latencies, counters)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            counters["errors"] += 1
+            if counters["errors"] <= 5:
+                print(f"device {index}: {e!r}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.devices)))
+    elapsed = time.perf_counter() - started
+
+    if server is not None:
+        from app.db import async_engine
+        await server.stop()
+        if args.queued:
+            await pipeline.stop()
+        await async_engine.dispose()
+
+    print(f"{'udp' if args.udp else 'tcp'}: {args.devices} devices x {args.frames} frames x {args.samples} samples")
+    print(f"  stored {counters['fixes']} fixes in {elapsed:.1f}s ({counters['fixes'] / elapsed:,.0f} fixes/s), "
+          f"{counters['errors']} errors" + (f", {counters['lost']} frames unacked" if args.udp else ""))
+    if latencies:
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"  ack latency p50 {statistics.median(latencies) * 1000:.1f}ms  p99 {p99 * 1000:.1f}ms")
+    if server is not None:
+        print(f"  server: {server.stats.to_dict()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate GPS trackers against the TCP/UDP listener")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5023, help="TCP port (UDP too unless --udp-port)")
+    parser.add_argument("--udp-port", type=int, default=0)
+    parser.add_argument("--udp", action="store_true", help="Simulate UDP trackers")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--frames", type=int, default=10, help="DATA frames per device")
+    parser.add_argument("--samples", type=int, default=5, help="Samples per DATA frame")
+    parser.add_argument("--interval", type=float, default=0.0, help="Seconds between frames")
+    parser.add_argument("--udp-timeout", type=float, default=5.0, help="Seconds to wait for a UDP ACK")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--serve", action="store_true", help="Run an in-process listener")
+    parser.add_argument("--queued", action="store_true", help="With --serve, use INGEST_MODE=queued")
+    args = parser.parse_args()
+    if args.udp and not args.udp_port:
+        args.udp_port = args.port
+
+    raise_fd_limit()
+    random.seed(1)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import axios from 'axios'
+import { createFleetSync } from '../fleetSync'
 import './Dashboard.css'
 
 const API_BASE = import.meta.env.VITE_API_BASE || 'http://localhost:8000/api'
@@ -15,6 +16,7 @@ export default function Dashboard() {
     avgSpeed: 0
   })
   const [recentActivity, setRecentActivity] = useState([])
+  const syncFleet = useRef(createFleetSync(API_BASE))
 
   useEffect(() => {
     loadDashboardData()
@@ -24,25 +26,21 @@ export default function Dashboard() {
 
   const loadDashboardData = async () => {
     try {
-      const response = await axios.get(`${API_BASE}/vehicles/with-last-position`)
-      const data = response.data
+      const [data, statsResponse] = await Promise.all([
+        syncFleet.current(),
+        axios.get(`${API_BASE}/fleet/stats`)
+      ])
       
       setVehicles(data)
       
-      // Calculate stats
-      const active = data.filter(v => v.last_position).length
-      const moving = data.filter(v => v.last_position && v.last_position.speed > 5).length
-      const idle = active - moving
-      const avgSpeed = data
-        .filter(v => v.last_position)
-        .reduce((sum, v) => sum + v.last_position.speed, 0) / (active || 1)
-      
+      // Counts are maintained by the server as positions arrive
+      const fleetStats = statsResponse.data
       setStats({
-        total: data.length,
-        active,
-        moving,
-        idle,
-        avgSpeed: avgSpeed.toFixed(1)
+        total: fleetStats.total,
+        active: fleetStats.active,
+        moving: fleetStats.moving,
+        idle: fleetStats.idle,
+        avgSpeed: fleetStats.avg_speed.toFixed(1)
       })
       
       // Recent activity (mock for now)
@@ -1,6 +1,6 @@
 import { useJsApiLoader, GoogleMap, Marker } from '@react-google-maps/api'
 import { useState, useEffect, useCallback, useRef } from 'react'
-import axios from 'axios'
+import { createFleetSync } from '../fleetSync'
 import './MapViewGoogle.css'
 
 const API_BASE = 'http://localhost:8000/api'
@@ -21,6 +21,7 @@ export default function MapViewGoogle() {
   const [zoom, setZoom] = useState(13)
   
   const mapRef = useRef(null)
+  const syncFleet = useRef(createFleetSync(API_BASE))
 
   // Load Google Maps
   const { isLoaded, loadError } = useJsApiLoader({
@@ -37,8 +38,7 @@ export default function MapViewGoogle() {
 
   const loadVehicles = async () => {
     try {
-      const response = await axios.get(`${API_BASE}/vehicles/with-last-position`)
-      const data = response.data
+      const data = await syncFleet.current()
       
       const vehiclesList = []
       const positionsMap = {}
@@ -0,0 +1,23 @@
+import axios from 'axios'
+
+// Keeps a local copy of /vehicles/with-last-position up to date by asking
+// only for vehicles that changed since the last poll (the `since` token)
+export function createFleetSync(apiBase) {
+  let seq = '0'
+  const vehicles = new Map()
+
+  return async function syncFleet() {
+    const response = await axios.get(`${apiBase}/vehicles/with-last-position`, {
+      params: { since: seq }
+    })
+    const data = response.data
+
+    // A full snapshot replaces everything (first poll, server restart, other worker)
+    if (data.full) vehicles.clear()
+    data.vehicles.forEach(vehicle => vehicles.set(vehicle.id, vehicle))
+    data.deleted.forEach(id => vehicles.delete(id))
+    seq = data.seq
+
+    return Array.from(vehicles.values()).sort((a, b) => a.id - b.id)
+  }
+}
@@ -0,0 +1,59 @@
+"""
+Shared fixtures. The app reads its settings at import time, so the
+environment is set up here before anything from app/ is imported: a
+throwaway SQLite database, no Redis, direct ingest.
+"""
+import os
+import sys
+import tempfile
+
+_tmpdir = tempfile.mkdtemp(prefix="fleet-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/test.db"
+os.environ["CACHE_BACKEND"] = "off"
+os.environ["INGEST_MODE"] = "direct"
+os.environ["WS_BROKER"] = "memory"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from app import models  # noqa: E402
+from app.auth import DEVICE_API_KEY  # noqa: E402
+from app.db import SessionLocal, engine  # noqa: E402
+from app.ingest import recent_fixes  # noqa: E402
+from app.main import app  # noqa: E402
+from app.resolver import device_resolver  # noqa: E402
+from app.trips import trip_engine  # noqa: E402
+
+DEVICE_HEADERS = {"X-Device-Token": DEVICE_API_KEY}
+
+
+def reset_state():
+    """Empty database and in-memory state (the app keeps module-level singletons)"""
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    device_resolver.clear()
+    recent_fixes._keys.clear()
+    trip_engine._states.clear()
+
+
+@pytest.fixture
+def client():
+    reset_state()
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def db():
+    reset_state()
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def device_headers():
+    return dict(DEVICE_HEADERS)
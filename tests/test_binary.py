@@ -0,0 +1,46 @@
+from datetime import datetime
+from app.binary import BINARY_CONTENT_TYPE, BinaryFormatError, decode_fixes, encode_record
+import pytest
+
+T = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def test_round_trip():
+    body = encode_record("DEV-1", [(T, 6.5244, 3.3792, 42.5)]) + encode_record("DEV-2", [(T, -1.5, -2.5, 0)])
+    fixes, errors = decode_fixes(body)
+    assert errors == []
+    assert [f[0] for f in fixes] == ["DEV-1", "DEV-2"]
+    device_id, lat, lng, speed, recorded_at = fixes[0]
+    assert (round(lat, 7), round(lng, 7), speed, recorded_at) == (6.5244, 3.3792, 42.5, T)
+
+
+def test_out_of_range_sample_is_reported_by_index():
+    body = encode_record("DEV-1", [(T, 1.0, 2.0, 0), (T, 1.0, 200.0, 0), (T, 1.0, 2.0, 0)])
+    fixes, errors = decode_fixes(body)
+    assert len(fixes) == 2
+    assert errors == [{"index": 1, "error": "lat/lng out of range"}]
+
+
+@pytest.mark.parametrize("body", [
+    b"XX\x01\x05DEV-1\x00\x00",
+    b"FP\x02\x05DEV-1\x00\x00",
+    b"FP\x01",
+    b"FP\x01\x00\x00\x00",
+    encode_record("DEV-1", [(T, 1.0, 2.0, 0)])[:-1],
+])
+def test_malformed_body(body):
+    with pytest.raises(BinaryFormatError):
+        decode_fixes(body)
+
+
+def test_binary_endpoint_rejects_malformed_body(client, device_headers):
+    response = client.post(
+        "/api/device/binary", content=b"garbage",
+        headers={**device_headers, "Content-Type": BINARY_CONTENT_TYPE}
+    )
+    assert response.status_code == 400
+
+
+def test_binary_endpoint_requires_its_content_type(client, device_headers):
+    response = client.post("/api/device/binary", headers=device_headers, json={"device_id": "DEV-1"})
+    assert response.status_code == 415
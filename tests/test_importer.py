@@ -0,0 +1,113 @@
+import json
+from app import models
+from app.importer import ImportJob
+
+
+def lines(count: int, device_id: str = "IMP-1"):
+    return [
+        json.dumps({"device_id": device_id, "lat": 6.0 + i * 0.001, "lng": 3.0, "speed": 30,
+                    "timestamp": f"2026-01-01T08:{i:02d}:00Z"})
+        for i in range(count)
+    ]
+
+
+def test_import_resume_after_failure(db):
+    records = lines(5)
+
+    # The first run commits one chunk of two, then dies before the next flush
+    first = ImportJob("ndjson", chunk_rows=2)
+    for line in records[:3]:
+        if first.add_line(line):
+            first.flush(db)
+    assert first.committed_records == 2
+
+    resumed = ImportJob("ndjson", skip_records=first.committed_records, chunk_rows=2)
+    for line in records:
+        if resumed.add_line(line):
+            resumed.flush(db)
+    resumed.flush(db)
+
+    assert resumed.rows_imported == 3
+    assert resumed.committed_records == 5
+    assert db.query(models.Position).count() == 5
+
+
+def test_import_skips_stored_fixes(db):
+    job = ImportJob("ndjson")
+    for line in lines(3) + lines(3):
+        job.add_line(line)
+    job.add_line('{"device_id": "IMP-1"}')
+    job.flush(db)
+    assert (job.rows_imported, job.rows_duplicate, job.rows_rejected) == (3, 3, 1)
+
+
+def test_imported_fix_becomes_latest(client, device_headers):
+    body = "\n".join(lines(3) + lines(1)) + "\n"
+    job = client.post(
+        "/api/import/positions", content=body.encode(),
+        headers={**device_headers, "Content-Type": "application/x-ndjson"}
+    ).json()
+    assert (job["status"], job["rows_imported"], job["rows_duplicate"]) == ("completed", 3, 1)
+
+    vehicle_id = client.get("/api/vehicles").json()[0]["id"]
+    latest = client.get(f"/api/positions/{vehicle_id}/latest")
+    assert latest.status_code == 200
+    assert latest.json()["recorded_at"] == "2026-01-01T08:02:00"
+    stored_ids = {p["id"] for p in client.get(f"/api/positions/{vehicle_id}").json()}
+    assert latest.json()["id"] in stored_ids
+
+    fleet = client.get("/api/vehicles/with-last-position").json()
+    assert fleet[0]["last_position"]["id"] == latest.json()["id"]
+
+
+def test_import_rebuilds_trips_and_rollups(client, db, device_headers):
+    # Drive ~1.1 km in 10 minutes, then stand still past the stop dwell
+    records = lines(11)
+    records += [
+        json.dumps({"device_id": "IMP-1", "lat": 6.010, "lng": 3.0, "speed": 0,
+                    "timestamp": f"2026-01-01T08:{11 + i:02d}:00Z"})
+        for i in range(7)
+    ]
+    job = client.post(
+        "/api/import/positions", content=("\n".join(records) + "\n").encode(),
+        headers={**device_headers, "Content-Type": "application/x-ndjson"}
+    ).json()
+    assert job["status"] == "completed"
+
+    trips = db.query(models.Trip).all()
+    assert len(trips) == 1
+    assert abs(trips[0].distance_km - 1.112) < 0.01
+    hourly = db.query(models.VehicleHourlyRollup).one()
+    assert hourly.point_count == 18
+
+
+def test_reimport_after_compaction_skips_compacted_fixes(db):
+    from datetime import datetime
+    from app.segments import compact_positions
+
+    first = ImportJob("ndjson")
+    for line in lines(3):
+        first.add_line(line)
+    first.flush(db)
+    compact_positions(db, datetime.utcnow())
+
+    again = ImportJob("ndjson")
+    for line in lines(4):
+        again.add_line(line)
+    again.flush(db)
+    assert (again.rows_imported, again.rows_duplicate) == (1, 3)
+
+
+def test_import_with_client_job_id(client, device_headers):
+    from app.importer import register_job
+
+    headers = {**device_headers, "Content-Type": "application/x-ndjson"}
+    body = ("\n".join(lines(2)) + "\n").encode()
+    job = client.post("/api/import/positions?job_id=upload-1", content=body, headers=headers).json()
+    assert job["job_id"] == "upload-1"
+    assert client.get("/api/import/jobs/upload-1").json()["rows_imported"] == 2
+
+    # An id in use by a running job, or a malformed one, is refused up front
+    register_job(ImportJob("ndjson", job_id="upload-2"))
+    assert client.post("/api/import/positions?job_id=upload-2", content=body, headers=headers).status_code == 409
+    assert client.post("/api/import/positions?job_id=../x", content=body, headers=headers).status_code == 400
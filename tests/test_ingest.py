@@ -0,0 +1,160 @@
+from app.ingest import ingest_pipeline
+
+FIX = {"device_id": "DEV-1", "lat": 6.5244, "lng": 3.3792, "speed": 42.0, "timestamp": "2026-01-01T10:00:00Z"}
+
+
+def post_fix(client, headers, **overrides):
+    return client.post("/api/device/position", headers=headers, json={**FIX, **overrides})
+
+
+def test_direct_position_is_stored_and_latest(client, device_headers):
+    response = post_fix(client, device_headers)
+    assert response.status_code == 201
+    body = response.json()
+    assert body["duplicate"] is False
+    assert body["position_id"] is not None
+
+    latest = client.get(f"/api/positions/{body['vehicle_id']}/latest")
+    assert latest.status_code == 200
+    assert latest.json()["id"] == body["position_id"]
+    assert latest.json()["recorded_at"] == "2026-01-01T10:00:00"
+
+
+def test_queued_ack_modes(client, device_headers):
+    client.portal.call(ingest_pipeline.start)
+    try:
+        durable = post_fix(client, device_headers, timestamp="2026-01-01T10:00:00Z")
+        assert durable.status_code == 201
+        assert durable.json()["position_id"] is not None
+
+        queued = client.post(
+            "/api/device/position?ack=enqueue", headers=device_headers,
+            json={**FIX, "timestamp": "2026-01-01T10:01:00Z"}
+        )
+        assert queued.status_code == 202
+        assert queued.json()["status"] == "accepted"
+        assert queued.json()["position_id"] is None
+    finally:
+        client.portal.call(ingest_pipeline.stop)
+
+    # Stopping flushes the queue, so both positions are stored
+    vehicle_id = durable.json()["vehicle_id"]
+    history = client.get(f"/api/positions/{vehicle_id}")
+    assert [p["recorded_at"] for p in history.json()] == ["2026-01-01T10:01:00", "2026-01-01T10:00:00"]
+
+
+def test_queued_durable_for_registered_vehicle(client, device_headers):
+    # A cold resolver cache makes the request read the vehicle itself
+    vehicle = client.post("/api/vehicles", json={"name": "Van 1", "plate_no": "DEV-1"}).json()
+    client.portal.call(ingest_pipeline.start)
+    try:
+        response = post_fix(client, device_headers)
+    finally:
+        client.portal.call(ingest_pipeline.stop)
+    assert response.status_code == 201
+    assert response.json()["vehicle_id"] == vehicle["id"]
+    assert response.json()["position_id"] is not None
+
+
+def test_invalid_ack_creates_no_vehicle(client, device_headers):
+    client.portal.call(ingest_pipeline.start)
+    try:
+        response = client.post("/api/device/position?ack=never", headers=device_headers, json=FIX)
+    finally:
+        client.portal.call(ingest_pipeline.stop)
+    assert response.status_code == 400
+    assert client.get("/api/vehicles").json() == []
+
+
+def test_duplicate_single_fix(client, device_headers):
+    first = post_fix(client, device_headers).json()
+    again = post_fix(client, device_headers).json()
+    assert again["duplicate"] is True
+    assert again["position_id"] is None
+    assert len(client.get(f"/api/positions/{first['vehicle_id']}").json()) == 1
+
+
+def test_duplicate_seq(client, device_headers):
+    fix = {"device_id": "DEV-1", "lat": 1.0, "lng": 2.0, "seq": 7}
+    assert client.post("/api/device/position", headers=device_headers, json=fix).json()["duplicate"] is False
+    # No timestamp: the resend gets a new server time but the same seq
+    assert client.post("/api/device/position", headers=device_headers, json=fix).json()["duplicate"] is True
+
+
+def test_seq_after_counter_reset_is_stored(client, device_headers):
+    first = post_fix(client, device_headers, seq=1).json()
+    # Rebooted an hour later: the counter starts over, the fix is new
+    again = post_fix(client, device_headers, seq=1, lat=6.6, timestamp="2026-01-01T11:00:00Z").json()
+    assert again["duplicate"] is False
+    assert again["position_id"] != first["position_id"]
+
+
+def test_batch_and_gateway_duplicate_counts(client, device_headers):
+    post_fix(client, device_headers)
+    positions = [
+        {k: v for k, v in FIX.items() if k != "device_id"},
+        {**FIX, "timestamp": "2026-01-01T10:05:00Z"},
+        {**FIX, "timestamp": "2026-01-01T10:05:00Z"},
+        {"lat": "not a number"}
+    ]
+    batch = client.post(
+        "/api/device/batch", headers=device_headers,
+        json={"device_id": "DEV-1", "positions": positions}
+    ).json()
+    assert (batch["count"], batch["duplicates"], batch["rejected"]) == (1, 2, 1)
+
+    gateway = client.post(
+        "/api/device/gateway", headers=device_headers,
+        json={"positions": [FIX, {**FIX, "device_id": "DEV-2"}]}
+    ).json()
+    assert (gateway["count"], gateway["duplicates"]) == (1, 1)
+
+
+def test_out_of_order_fix_is_stored_but_not_latest(client, device_headers):
+    vehicle_id = post_fix(client, device_headers).json()["vehicle_id"]
+    late = post_fix(client, device_headers, timestamp="2026-01-01T09:00:00Z").json()
+    assert late["duplicate"] is False
+
+    assert client.get(f"/api/positions/{vehicle_id}/latest").json()["recorded_at"] == "2026-01-01T10:00:00"
+    assert len(client.get(f"/api/positions/{vehicle_id}").json()) == 2
+
+
+def test_resent_fix_after_compaction_is_duplicate(client, db, device_headers):
+    from datetime import datetime
+    from app.ingest import recent_fixes
+    from app.segments import compact_positions
+
+    vehicle_id = post_fix(client, device_headers).json()["vehicle_id"]
+    assert compact_positions(db, datetime.utcnow())["segments"] == 1
+    recent_fixes._keys.clear()
+
+    again = post_fix(client, device_headers).json()
+    assert again["duplicate"] is True
+    assert len(client.get(f"/api/positions/{vehicle_id}").json()) == 1
+
+
+def test_stop_keeps_submits_blocked_on_a_full_queue():
+    import asyncio
+    from datetime import datetime
+    from app.ingest import IngestPipeline
+
+    async def run(spins: int):
+        pipeline = IngestPipeline(maxsize=1, batch_size=1, flush_interval_ms=1)
+        # Stand-in for the database write; the race is in the queue
+        pipeline._write = lambda rows: [row.update(id=row["n"]) for row in rows]
+        await pipeline.start()
+        submits = [
+            asyncio.create_task(pipeline.submit({
+                "n": n, "vehicle_id": 1, "lat": 6.0, "lng": 3.0, "speed": 0.0,
+                "recorded_at": datetime(2026, 1, 1, 8, 0, n)
+            }))
+            for n in range(6)
+        ]
+        # Stop while some submits are still waiting for room in the queue
+        for _ in range(spins):
+            await asyncio.sleep(0)
+        await pipeline.stop()
+        return await asyncio.wait_for(asyncio.gather(*submits), 5)
+
+    for spins in range(1, 13):
+        assert asyncio.run(run(spins)) == list(range(6))
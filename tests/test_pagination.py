@@ -0,0 +1,49 @@
+from datetime import datetime
+from app.pagination import InvalidCursor, decode_cursor, encode_cursor
+import pytest
+
+
+def test_cursor_round_trip():
+    recorded_at = datetime(2026, 1, 1, 12, 30, 15, 250000)
+    assert decode_cursor(encode_cursor(recorded_at, 42)) == (recorded_at, 42)
+
+
+def test_invalid_cursor():
+    with pytest.raises(InvalidCursor):
+        decode_cursor("not-a-cursor")
+
+
+def test_history_pages_by_cursor(client, device_headers):
+    # Two fixes share a timestamp so the id tiebreak is exercised
+    positions = [
+        {"lat": 1 + i * 0.001, "lng": 2.0, "timestamp": f"2026-01-01T10:{i // 2:02d}:00Z"}
+        for i in range(25)
+    ]
+    body = client.post(
+        "/api/device/batch", headers=device_headers,
+        json={"device_id": "PAGER", "positions": positions}
+    ).json()
+    vehicle_id = body["vehicle_id"]
+
+    seen = []
+    cursor = None
+    while True:
+        url = f"/api/positions/{vehicle_id}?limit=10" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(url)
+        assert response.status_code == 200
+        seen.extend(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert len(seen) == 25
+    assert len({p["id"] for p in seen}) == 25
+    keys = [(p["recorded_at"], p["id"]) for p in seen]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_history_rejects_bad_cursor(client, device_headers):
+    vehicle_id = client.post(
+        "/api/device/position", headers=device_headers, json={"device_id": "PAGER", "lat": 1, "lng": 2}
+    ).json()["vehicle_id"]
+    assert client.get(f"/api/positions/{vehicle_id}?cursor=garbage").status_code == 400
@@ -0,0 +1,42 @@
+import pytest
+from app.resolver import device_resolver
+
+FIX = {"device_id": "DEV-1", "lat": 6.5244, "lng": 3.3792, "speed": 42.0, "timestamp": "2026-01-01T10:00:00Z"}
+
+
+@pytest.fixture
+def lookup_only(monkeypatch):
+    monkeypatch.setattr(device_resolver, "auto_create", False)
+
+
+def test_unknown_device_is_rejected_without_auto_create(client, device_headers, lookup_only):
+    response = client.post("/api/device/position", headers=device_headers, json=FIX)
+    assert response.status_code == 404
+    assert client.get("/api/vehicles").json() == []
+    assert device_resolver.is_known_missing("DEV-1")
+
+    # Registering the vehicle clears the negative entry
+    client.post("/api/vehicles", json={"name": "Van 1", "plate_no": "DEV-1"})
+    assert not device_resolver.is_known_missing("DEV-1")
+    assert client.post("/api/device/position", headers=device_headers, json=FIX).status_code == 201
+
+
+def test_gateway_rejects_unknown_devices_by_index(client, device_headers, lookup_only):
+    client.post("/api/vehicles", json={"name": "Van 1", "plate_no": "DEV-1"})
+    body = client.post(
+        "/api/device/gateway", headers=device_headers,
+        json={"positions": [{"lat": "bad"}, {**FIX, "device_id": "DEV-2"}, FIX]}
+    ).json()
+    assert (body["count"], body["rejected"]) == (1, 2)
+    assert [error["index"] for error in body["errors"]] == [0, 1]
+    assert list(body["vehicles"]) == ["DEV-1"]
+
+
+def test_auto_create_once_per_device(client, device_headers):
+    first = client.post("/api/device/position", headers=device_headers, json=FIX).json()
+    body = client.post(
+        "/api/device/gateway", headers=device_headers,
+        json={"positions": [{**FIX, "device_id": "DEV-2"}, {**FIX, "timestamp": "2026-01-01T10:01:00Z"}]}
+    ).json()
+    assert body["vehicles"]["DEV-1"] == first["vehicle_id"]
+    assert len(client.get("/api/vehicles").json()) == 2
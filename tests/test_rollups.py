@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+from app import models
+from app.ingest import store_positions
+
+START = datetime(2026, 1, 1, 8, 0, 0)
+
+
+def rows(start: int, count: int):
+    return [
+        {"vehicle_id": 1, "lat": 6.0 + i * 0.001, "lng": 3.0, "speed": 40.0,
+         "recorded_at": START + timedelta(seconds=10 * i)}
+        for i in range(start, start + count)
+    ]
+
+
+def test_retry_after_rollback_keeps_distance(db):
+    db.add(models.Vehicle(name="ROLLUP"))
+    db.commit()
+
+    store_positions(db, rows(0, 2))
+    db.commit()
+    store_positions(db, rows(2, 2))
+    db.rollback()
+    store_positions(db, rows(2, 2))
+    db.commit()
+
+    hourly = db.query(models.VehicleHourlyRollup).one()
+    daily = db.query(models.VehicleDailyRollup).one()
+    # Three 0.001 degree steps of latitude, 10 s apart
+    assert abs(hourly.distance_km - 3 * 0.1112) < 0.001
+    assert hourly.moving_seconds == 30
+    assert abs(daily.distance_km - hourly.distance_km) < 1e-9
+
+
+def test_analytics_range_query(client):
+    assert client.get("/api/analytics?range=week").status_code == 200
+    bad = client.get("/api/analytics?range=decade")
+    assert bad.status_code == 400
+    assert "decade" in bad.json()["detail"]
@@ -0,0 +1,48 @@
+import asyncio
+import struct
+from app import models
+from app.tracker import (
+    FRAME_DATA, FRAME_DATA_UDP, STATUS_ERROR, TrackerDatagramProtocol, TrackerServer, ack_frame, encode_frame
+)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+
+def test_datagrams_above_in_flight_cap_are_dropped():
+    server = TrackerServer()
+
+    async def burst():
+        protocol = TrackerDatagramProtocol(server, max_in_flight=2)
+        for _ in range(5):
+            protocol.datagram_received(b"\x00", ("127.0.0.1", 9))
+        assert protocol.in_flight == 2
+        await asyncio.gather(*server.tasks)
+        return protocol
+
+    protocol = asyncio.run(burst())
+    assert protocol.in_flight == 0
+    assert not server.tasks
+    assert (server.stats.frames, server.stats.dropped) == (5, 3)
+
+
+def test_datagram_with_blank_device_id_is_refused(db):
+    server = TrackerServer()
+    transport = FakeTransport()
+
+    async def send(device_id: bytes):
+        protocol = TrackerDatagramProtocol(server)
+        protocol.connection_made(transport)
+        payload = bytes([len(device_id)]) + device_id + struct.pack("<H", 7)
+        protocol.datagram_received(encode_frame(FRAME_DATA_UDP, payload), ("127.0.0.1", 9))
+        await asyncio.gather(*server.tasks)
+
+    asyncio.run(send(b""))
+    asyncio.run(send(b"   "))
+    assert transport.sent == [ack_frame(FRAME_DATA, STATUS_ERROR, 7)] * 2
+    assert db.query(models.Vehicle).count() == 0
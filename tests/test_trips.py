@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+from app.trips import TripEngine
+
+START = datetime(2026, 1, 1, 8, 0, 0)
+
+
+def fix(i: int, speed: float, lat: float):
+    return {"vehicle_id": 1, "lat": lat, "lng": 3.0, "speed": speed, "recorded_at": START + timedelta(seconds=30 * i)}
+
+
+def test_trip_ends_after_dwell():
+    engine = TripEngine(moving_speed=5, stop_dwell_seconds=120, min_distance_km=0.2)
+    # Drive north ~1.1 km, then stand still for 3 minutes
+    rows = [fix(i, 40, 6.0 + i * 0.001) for i in range(11)]
+    rows += [fix(11 + i, 0, 6.010) for i in range(7)]
+    finished, steps = engine.observe_many(rows)
+
+    assert len(steps) == len(rows)
+    assert len(finished) == 1
+    trip = finished[0]
+    assert trip["start_at"] == START
+    assert trip["end_at"] == START + timedelta(seconds=30 * 11)
+    assert abs(trip["distance_km"] - 1.112) < 0.01
+    assert engine.open_trip(1) is None
+
+
+def test_short_trip_is_discarded():
+    engine = TripEngine(moving_speed=5, stop_dwell_seconds=60, min_distance_km=0.5)
+    rows = [fix(0, 20, 6.0), fix(1, 20, 6.0005)]
+    rows += [fix(2 + i, 0, 6.0005) for i in range(4)]
+    finished, _ = engine.observe_many(rows)
+    assert finished == []
+    assert engine.open_trip(1) is None
+
+
+def test_out_of_order_fix_does_not_move_state():
+    engine = TripEngine()
+    engine.observe_many([fix(0, 40, 6.0), fix(2, 40, 6.002)])
+    _, steps = engine.observe_many([fix(1, 40, 6.001)])
+    assert steps[0]["distance_km"] == 0.0
+    assert engine.open_trip(1)["end_at"] == START + timedelta(seconds=60)
+
+
+def test_rolled_back_batch_is_seen_again(db):
+    from app import models
+    from app.ingest import store_positions
+    from app.trips import trip_engine
+
+    db.add(models.Vehicle(name="TRIPS"))
+    db.commit()
+    rows = lambda start, count: [{**fix(i, 40, 6.0 + i * 0.001), "vehicle_id": 1} for i in range(start, start + count)]
+
+    store_positions(db, rows(0, 2))
+    db.commit()
+    store_positions(db, rows(2, 2))
+    db.rollback()
+    assert trip_engine.open_trip(1)["point_count"] == 2
+
+    # Closing without commit undoes the engine state too
+    store_positions(db, rows(2, 2))
+    db.close()
+    assert trip_engine.open_trip(1)["point_count"] == 2
+
+    stored = store_positions(db, rows(2, 2))
+    db.commit()
+    assert len(stored) == 2
+    assert trip_engine.open_trip(1)["point_count"] == 4